@@ -5,12 +5,17 @@ Discovered via browser DevTools showing XHR requests on port 8444
 """
 
 import os
+import time
+import functools
 import requests
 import urllib3
 import json
 import sys
+import socket
 from typing import Dict, Any, Tuple, Optional
 
+from ic3000_trace import NULL_TRACER, TracingAdapter
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def _default_timeout() -> int:
@@ -21,21 +26,85 @@ def _default_timeout() -> int:
         return 30
 
 
+def timed_phase(name: str):
+    """Decorator: add the wall time of each call to self.timings[name] (seconds) and trace it as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                with self.tracer.span(name):
+                    return func(self, *args, **kwargs)
+            finally:
+                self.timings[name] = self.timings.get(name, 0.0) + time.monotonic() - start
+        return wrapper
+    return decorator
+
+
+class _CancelledAdapter(requests.adapters.BaseAdapter):
+    """Transport adapter mounted by IC3000APIClient.cancel() to refuse further requests"""
+
+    def send(self, request, **kwargs):
+        raise requests.exceptions.ConnectionError("Request cancelled (device deadline exceeded or run interrupted)")
+
+    def close(self):
+        pass
+
+
 class IC3000APIClient:
     """REST API client for IC3000 devices"""
     
-    def __init__(self, ip: str, username: str, password: str, timeout: Optional[int] = None):
+    def __init__(self, ip: str, username: str, password: str, timeout: Optional[int] = None,
+                 login_timeout: Optional[int] = None):
         self.ip = ip
         self.username = username
         self.password = password
         self.timeout = timeout if timeout is not None else _default_timeout()
+        self.login_timeout = login_timeout if login_timeout is not None else self.timeout
         self.session = requests.Session()
         self.session.verify = False
+        self.session.hooks['response'].append(self._note_status)
+        self.last_status = None  # HTTP status of the last response (e.g. 401 when the token expired)
         self.base_url = f"https://{ip}:8444"  # API port, not web UI port (8443)
         self.auth_url = f"https://{ip}:8443"  # Auth endpoint on port 8443
         self.authenticated = False
         self.auth_token = None  # X-IDA-AUTH-TOKEN
+        self.cancelled = False
+        self.connection_failed = False  # the last check_reachable()/login() could not connect at all
+        self.timings = {}  # phase name -> seconds, filled by @timed_phase
+        self.queued_since = None  # set while waiting for a pipeline stage (ic3000_pipeline)
+        self.log = print  # Progress output; bulk runs route this to their RunLogger
+        self.tracer = NULL_TRACER  # Span tracing, see enable_tracing()
+        self.transport = None  # Adapter set by use_transport() (cassette record/replay), None = plain HTTPS
+    
+    def _note_status(self, response, *args, **kwargs):
+        self.last_status = response.status_code
+    
+    def use_transport(self, adapter):
+        """Send every request, and the reachability probe, through `adapter` (see ic3000_cassette)"""
+        self.transport = adapter
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def enable_tracing(self, tracer):
+        """Record phase spans and one span per HTTP request (login steps, PUT/GET) on tracer"""
+        self.tracer = tracer
+        self.session.mount("https://", TracingAdapter(tracer, self.transport))
+        self.session.mount("http://", TracingAdapter(tracer, self.transport))
+    
+    def cancel(self):
+        """
+        Abort this client from another thread
+        
+        Closes pooled connections and mounts an adapter that fails every further
+        request immediately, so a worker stuck between steps gives up at once.
+        """
+        self.cancelled = True
+        self.session.close()
+        self.session.mount("https://", _CancelledAdapter())
+        self.session.mount("http://", _CancelledAdapter())
     
+    @timed_phase('login')
     def login(self) -> Tuple[bool, str]:
         """
         Authenticate with the device
@@ -48,6 +117,7 @@ class IC3000APIClient:
         
         Returns: (success: bool, message: str)
         """
+        self.connection_failed = False
         try:
             # Step 1: Login to web UI on port 8443 to establish session
             login_payload = {
@@ -61,14 +131,14 @@ class IC3000APIClient:
             login_response = self.session.post(
                 self.auth_url,  # https://IP:8443
                 data=login_payload,
-                timeout=self.timeout,
+                timeout=self.login_timeout,
                 allow_redirects=True
             )
             
             # Verify we can access admin page (validates session)
             admin_check = self.session.get(
                 f"{self.auth_url}/admin",
-                timeout=self.timeout
+                timeout=self.login_timeout
             )
             
             if admin_check.status_code != 200:
@@ -89,7 +159,7 @@ class IC3000APIClient:
                     "Content-Type": "application/x-www-form-urlencoded",
                     "X-Requested-With": "XMLHttpRequest"
                 },
-                timeout=self.timeout
+                timeout=self.login_timeout
             )
             
             if token_response.status_code != 200:
@@ -152,7 +222,7 @@ class IC3000APIClient:
                     "Origin": f"https://{self.ip}:8443",
                     "Referer": f"https://{self.ip}:8443/"
                 },
-                timeout=self.timeout
+                timeout=self.login_timeout
             )
             
             if test_response.status_code == 200:
@@ -162,12 +232,36 @@ class IC3000APIClient:
                 return False, f"Token validation failed (status: {test_response.status_code})"
                 
         except requests.exceptions.ConnectionError as e:
+            # Includes ConnectTimeout; a read timeout means the device did answer
+            self.connection_failed = not self.cancelled
             return False, f"Connection failed: {str(e)[:100]}"
         except requests.exceptions.Timeout:
             return False, "Connection timeout"
         except Exception as e:
             return False, f"Login error: {str(e)[:100]}"
     
+    @timed_phase('reachability')
+    def check_reachable(self) -> Tuple[bool, str]:
+        """
+        Cheap pre-login check: open a TCP connection to the web UI port (8443)
+        Returns: (reachable: bool, message: str)
+        """
+        self.connection_failed = False
+        if self.cancelled:
+            return False, "Request cancelled"
+        try:
+            if self.transport is not None:
+                self.transport.probe(self.ip, 8443, self.login_timeout)
+            else:
+                socket.create_connection((self.ip, 8443), timeout=self.login_timeout).close()
+            return True, "Port 8443 reachable"
+        except socket.timeout:
+            self.connection_failed = True
+            return False, "Unreachable: connection timeout"
+        except OSError as e:
+            self.connection_failed = True
+            return False, f"Unreachable: {str(e)[:100]}"
+    
     def check_api_availability(self) -> Tuple[bool, str]:
         """
         Check if the REST API is available on port 8444
@@ -194,6 +288,7 @@ class IC3000APIClient:
         except Exception as e:
             return False, f"Error: {str(e)}"
     
+    @timed_phase('get_ntp')
     def get_ntp_config(self) -> Tuple[bool, Any]:
         """
         Get current NTP configuration
@@ -230,6 +325,7 @@ class IC3000APIClient:
         except Exception as e:
             return False, f"GET error: {str(e)}"
     
+    @timed_phase('set_ntp')
     def set_ntp_config(self, ntp_server: str) -> Tuple[bool, str]:
         """
         Set NTP server configuration
@@ -292,6 +388,7 @@ class IC3000APIClient:
         except Exception as e:
             return False, f"PUT error: {str(e)}"
     
+    @timed_phase('system_info')
     def get_system_info(self) -> Tuple[bool, Any]:
         """
         Get system information
@@ -331,6 +428,114 @@ class IC3000APIClient:
         return False, "Could not retrieve system info"
 
 
+def run_jsonl_batch(source, execute, concurrency: int = 10, out=None) -> int:
+    """
+    Run JSONL commands concurrently (one device and action per line)
+    
+    Each result is written to `out` as one JSON line as soon as it completes, in
+    completion order; "line" refers back to the input line. Credentials are never
+    echoed. execute(command) -> (success, result) runs one command.
+    
+    Returns: number of commands that failed
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    
+    out = out or sys.stdout
+    failed = 0
+    lock = threading.Lock()  # results are written from worker threads
+    slots = threading.BoundedSemaphore(concurrency)  # at most `concurrency` commands read ahead
+    
+    def write(record):
+        nonlocal failed
+        with lock:
+            if not record["success"]:
+                failed += 1
+            out.write(json.dumps(record, default=str) + "\n")
+            out.flush()
+    
+    def timed(command):
+        start = time.monotonic()
+        try:
+            success, result = execute(command)
+        except Exception as e:
+            success, result = False, f"Error: {str(e)[:200]}"
+        return success, result, round((time.monotonic() - start) * 1000, 1)
+    
+    def report(line_no, command, future):
+        # Done callback: runs in the worker thread the moment the command finishes
+        try:
+            success, result, elapsed_ms = future.result()
+            write({
+                "line": line_no,
+                "ip": command['ip'],
+                "action": command['action'],
+                "success": success,
+                "result": result,
+                "elapsed_ms": elapsed_ms,
+            })
+        finally:
+            slots.release()
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Input is read lazily so results stream out while stdin is still open
+        for line_no, line in enumerate(source, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                command = json.loads(line)
+                if not isinstance(command, dict) or not command.get('ip') or not command.get('action'):
+                    raise ValueError('each line needs a JSON object with "ip" and "action"')
+            except ValueError as e:
+                write({"line": line_no, "success": False, "result": f"Invalid command: {e}"})
+                continue
+            slots.acquire()
+            future = executor.submit(timed, command)
+            future.add_done_callback(functools.partial(report, line_no, command))
+    
+    return failed
+
+
+def open_batch_source(path: str):
+    """--batch argument to a line iterator; exits with an error if the file is missing"""
+    if path == '-':
+        return sys.stdin
+    if not os.path.exists(path):
+        print(f"✗ Error: Batch file not found: {path}", file=sys.stderr)
+        sys.exit(1)
+    return open(path, 'r')
+
+
+def execute_batch_command(command: Dict, timeout: Optional[int] = None) -> Tuple[bool, Any]:
+    """Run one --batch command: check, get-ntp, set-ntp or system-info"""
+    action = command['action']
+    if action not in ('check', 'get-ntp', 'set-ntp', 'system-info'):
+        return False, f"Unknown action: {action}"
+    
+    client = IC3000APIClient(
+        command['ip'],
+        command.get('username', ''),
+        command.get('password', ''),
+        timeout=command.get('timeout', timeout)
+    )
+    
+    if action == 'check':
+        return client.check_api_availability()
+    
+    success, message = client.login()
+    if not success:
+        return False, f"Auth: {message}"
+    
+    if action == 'get-ntp':
+        return client.get_ntp_config()
+    if action == 'set-ntp':
+        if not command.get('ntp_server'):
+            return False, 'Missing "ntp_server"'
+        return client.set_ntp_config(command['ntp_server'])
+    return client.get_system_info()
+
+
 def main():
     import argparse
     
@@ -353,10 +558,15 @@ Examples:
   
   # Get system information
   python3 ic3000_api_client.py 192.168.69.142 admin password --system-info
+  
+  # Batch: JSONL commands from stdin (or a file), JSONL results on stdout
+  # actions: check, get-ntp, set-ntp (needs "ntp_server"), system-info
+  echo '{"ip": "192.168.69.142", "username": "admin", "password": "pw", "action": "get-ntp"}' | \\
+      python3 ic3000_api_client.py --batch - --concurrency 20
         """
     )
     
-    parser.add_argument('ip', help='Device IP address')
+    parser.add_argument('ip', nargs='?', help='Device IP address')
     parser.add_argument('username', nargs='?', help='Username (if authentication required)')
     parser.add_argument('password', nargs='?', help='Password (if authentication required)')
     
@@ -371,9 +581,21 @@ Examples:
                        help='Set NTP server')
     parser.add_argument('--system-info', action='store_true',
                        help='Get system information')
+    parser.add_argument('--batch', metavar='FILE',
+                       help='Read JSONL commands from FILE ("-" for stdin), write JSONL results to stdout')
+    parser.add_argument('--concurrency', type=int, default=10,
+                       help='Parallel devices in --batch mode (default: 10)')
     
     args = parser.parse_args()
     
+    if args.batch:
+        source = open_batch_source(args.batch)
+        failed = run_jsonl_batch(source, lambda cmd: execute_batch_command(cmd, args.timeout), args.concurrency)
+        sys.exit(1 if failed else 0)
+    
+    if not args.ip:
+        parser.error('ip is required unless --batch is used')
+    
     # Create client (optional timeout for slow devices)
     client = IC3000APIClient(
         args.ip,
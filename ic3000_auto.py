@@ -6,14 +6,32 @@ import sys
 import csv
 import yaml
 import time
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import queue
+import hashlib
+import heapq
+import threading
+import itertools
+from datetime import datetime, timedelta
 from typing import List, Dict, Any
 import argparse
 
 # Import our API clients
 from ic3000_api_client import IC3000APIClient
 from ic3000_upgrade_api import IC3000UpgradeClient
+from ic3000_log import RunLogger
+from ic3000_history import RunHistory, default_db_path
+from ic3000_schedule import DeviceScheduler, parse_until
+from ic3000_rollout import FailureBreaker, SiteBreaker, AvailabilityGroups, plan_cohorts, spread_key, FAILURE_STATUSES
+from ic3000_estimate import (load_history_model, load_results_model, image_sizes, subnet_key, estimate,
+                             recommend, percentile, format_duration)
+from ic3000_profile import RunProfiler
+from ic3000_trace import SpanTracer, NULL_TRACER
+from ic3000_firmware import FirmwareCatalog, running_version, format_version, parse_version, compare_versions
+from ic3000_cassette import Cassette, CassetteRecorder, RecordingAdapter, ReplayAdapter
+from ic3000_pipeline import StagePipeline, StageCancelled, STAGES, DEFAULT_LIMITS, queued_seconds
+from ic3000_records import (DeviceResult, read_devices, RESULT_FIELDS, OPERATION_LABELS,
+                            SUCCESS, WARNING, FAILED, TIMEOUT, SKIPPED, CANCELLED, SITE_UNREACHABLE)
 
 
 class IC3000Config:
@@ -39,11 +57,23 @@ class IC3000Config:
     def default_config(self):
         return {
             'devices_csv': 'ic3000_devices.csv',
-            'software': {'firmware_path': '', 'firmware_name': ''},
+            'software': {'firmware_path': '', 'firmware_name': '', 'catalog_dir': '', 'catalog_pattern': '*.SPA',
+                         'target_version': '', 'upgrade_paths': {}},
             'ntp': {'default_server': '192.168.69.254'},
-            'parallel': {'max_workers_upgrade': 3, 'max_workers_ntp': 10, 'batch_size': 0, 'batch_delay': 60},
-            'timeouts': {'connection': 30, 'upload': 600, 'install': 120},
-            'output': {'results_dir': 'results', 'verbose': True, 'show_progress': True},
+            'parallel': {'max_workers_upgrade': 3, 'max_workers_ntp': 10, 'max_workers_apply': 3,
+                         'max_workers_stage': 2, 'max_workers_install': 20, 'batch_size': 0, 'batch_delay': 60},
+            'apply': {'verify': ['ntp']},
+            'pipeline': {'enabled': False, 'max_in_flight': 0, 'verify_timeout': 900, 'verify_interval': 30,
+                         'verify_poll': 5, 'relogin_after': 600},
+            'history': {'enabled': True, 'db': '', 'full_sweep_days': 7},
+            'rollout': {'enabled': False, 'canary_size': 3, 'spread_by': 'Site', 'ramp_factor': 2,
+                        'canary_max_failures': 0, 'max_failure_rate': 0.25, 'failure_window': 20,
+                        'min_samples': 5, 'max_failures': 0},
+            'availability': {'group_by': 'Group', 'max_unavailable': 1, 'group_limits': {}, 'max_workers': 20},
+            'site_breaker': {'enabled': False, 'group_by': 'Site', 'threshold': 3, 'cooldown': 120, 'max_probes': 2},
+            'timeouts': {'login': 15, 'api_call': 30, 'upload': 300, 'install': 60, 'device': 900},
+            'replay': {'speed': 1.0},
+            'output': {'results_dir': 'results', 'verbose': 1, 'show_progress': True, 'json_log': '', 'trace': False},
             'safety': {'require_confirmation': True, 'test_mode_default': False, 'prompt_between_batches': True}
         }
     
@@ -65,6 +95,98 @@ class IC3000Manager:
         self.config = config
         self.results_dir = config.get('output.results_dir', 'results')
         os.makedirs(self.results_dir, exist_ok=True)
+        # Clients currently in use, keyed by worker thread id, so the dispatcher can cancel them
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self.interrupted = False
+        self.logger = RunLogger(
+            verbose=config.get('output.verbose', 1),
+            show_progress=config.get('output.show_progress', True),
+            json_path=config.get('output.json_log') or None
+        )
+        self.tracer = NULL_TRACER  # run() swaps in a SpanTracer with --trace / output.trace
+        self.recorder = None  # CassetteRecorder with --record
+        self.cassette = None  # Cassette served instead of the network with --replay
+        self.replay_speed = 1.0
+        self.history = None
+        self.run_id = None
+        self._fingerprints = {}  # ip -> desired-state fingerprint of this run, saved on success
+        if config.get('history.enabled', True):
+            self.history = RunHistory(default_db_path(config))
+    
+    def _new_client(self, client_class, device):
+        """Create an API client with the configured per-phase timeouts and register it for cancellation"""
+        kwargs = {
+            'timeout': self.config.get('timeouts.api_call', 30),
+            'login_timeout': self.config.get('timeouts.login', 15),
+        }
+        if issubclass(client_class, IC3000UpgradeClient):
+            kwargs['upload_timeout'] = self.config.get('timeouts.upload', 300)
+            kwargs['install_timeout'] = self.config.get('timeouts.install', 60)
+        
+        client = client_class(device.ip, device.username, device.password, **kwargs)
+        client.log = self.logger.device_logger(device.ip)
+        if self.cassette is not None:
+            client.use_transport(ReplayAdapter(self.cassette, device.ip, self.replay_speed))
+        elif self.recorder is not None:
+            client.use_transport(RecordingAdapter(self.recorder, device.ip, secrets=(device.password,)))
+        if self.tracer.enabled:
+            client.enable_tracing(self.tracer)
+        with self._clients_lock:
+            self._clients[threading.get_ident()] = client
+        return client
+    
+    def _queued_time(self, thread_id):
+        """Seconds the device on this worker thread spent waiting in pipeline stage queues"""
+        with self._clients_lock:
+            client = self._clients.get(thread_id)
+        return queued_seconds(client) if client is not None else 0.0
+    
+    def _cancel_client(self, thread_id):
+        with self._clients_lock:
+            client = self._clients.pop(thread_id, None)
+        if client is not None:
+            client.cancel()
+    
+    def _run_device_task(self, task_id, slot, operation, device, func, args, done_queue, target=''):
+        """
+        Worker thread body: run one device operation and hand the result to the dispatcher
+        
+        The result is stamped with its total duration and the per-phase timings
+        collected by the device's API client. `slot` is the worker slot, used
+        as the trace track; `target` fills the Target of a failure the
+        operation did not report itself.
+        """
+        start = time.monotonic()
+        result = None
+        self.tracer.set_track(slot)
+        with self.tracer.span(device.name, cat='device', ip=device.ip, operation=operation) as span_args:
+            try:
+                result = func(device, *args)
+            except Exception as e:
+                result = self._failure_result(device, operation, FAILED, str(e)[:100], target=target)
+            finally:
+                with self._clients_lock:
+                    client = self._clients.pop(threading.get_ident(), None)
+                # Always report back, even on BaseException, so the dispatcher never waits on a dead worker
+                if result is None:
+                    result = self._failure_result(device, operation, FAILED, 'Worker aborted', target=target)
+                result.duration = round(time.monotonic() - start, 2)
+                result.phases = {k: round(v, 3) for k, v in client.timings.items()} if client else {}
+                if client is not None and client.connection_failed:
+                    result.unreachable = True
+                result.finished_at = datetime.now().isoformat(timespec='seconds')
+                span_args['status'] = result.status
+                done_queue.put((task_id, result))
+    
+    def _failure_result(self, device, operation, status, message, duration=None, target=''):
+        result = DeviceResult(device, OPERATION_LABELS.get(operation, operation), target=target, status=status,
+                              message=message)
+        if duration is not None:
+            result.duration = round(duration, 2)
+        result.phases = {}
+        result.finished_at = datetime.now().isoformat(timespec='seconds')
+        return result
     
     def load_devices(self, csv_file=None, test_mode=False, limit=None):
         if csv_file is None:
@@ -73,8 +195,8 @@ class IC3000Manager:
         if not os.path.exists(csv_file):
             raise FileNotFoundError(f'Device CSV not found: {csv_file}')
         
-        with open(csv_file, 'r') as f:
-            devices = list(csv.DictReader(f))
+        # Rows become compact Device records as they are read
+        devices = read_devices(csv_file)
         
         if test_mode:
             devices = devices[:3]
@@ -85,155 +207,982 @@ class IC3000Manager:
         
         return devices
     
-    def configure_ntp(self, device):
-        device_name = device.get('DeviceName') or device.get('Hostname') or device['IPAddress']
-        ip = device['IPAddress']
-        username = device['Username']
-        password = device['Password']
+    def operation_target(self, device, operation, firmware_path=None, catalog=None):
+        """
+        Target column of a device's result (NTP servers, firmware image)
         
+        The operation functions report the same; the dispatcher uses this for
+        devices it records itself (Timeout, Cancelled, Skipped, ...). With a
+        catalog the image depends on the running version, so the target
+        version stands in for it.
+        """
+        if operation == 'ntp':
+            return device.ntp_server or self.config.get('ntp.default_server')  # Keep full list for display
+        if operation == 'apply':
+            ntp_server = device.ntp_server or self.config.get('ntp.default_server')
+            firmware_path = device.firmware or firmware_path
+            targets = []
+            if ntp_server:
+                targets.append(f'NTP={ntp_server}')
+            if firmware_path:
+                targets.append(f'FW={os.path.basename(firmware_path)}')
+            return '; '.join(targets)
+        if catalog is not None and not firmware_path:
+            return format_version(catalog.device_target(device))
+        return os.path.basename(firmware_path) if firmware_path else ''
+    
+    def configure_ntp(self, device):
         # Support multiple NTP servers: comma-separated
-        ntp_server = device.get('NTPServer', self.config.get('ntp.default_server'))
-        
-        result = {
-            'DeviceName': device_name,
-            'IPAddress': ip,
-            'Operation': 'NTP',
-            'Target': ntp_server,  # Keep full list for display
-            'Status': 'Failed',
-            'Message': ''
-        }
+        ntp_server = device.ntp_server or self.config.get('ntp.default_server')
+        
+        result = DeviceResult(device, OPERATION_LABELS['ntp'], target=self.operation_target(device, 'ntp'))
         
         try:
-            client = IC3000APIClient(ip, username, password)
+            client = self._new_client(IC3000APIClient, device)
             success, message = client.login()
             if not success:
-                result['Message'] = f'Auth: {message}'
+                result.message = f'Auth: {message}'
                 return result
             
             success, message = client.set_ntp_config(ntp_server)
             if not success:
-                result['Message'] = message
+                result.message = message
                 return result
             
             success, config = client.get_ntp_config()
             if success:
-                result['Status'] = 'Success'
-                result['Message'] = 'NTP configured and verified'
+                result.status = SUCCESS
+                result.message = 'NTP configured and verified'
             else:
-                result['Status'] = 'Warning'
-                result['Message'] = 'Configured but verification failed'
+                result.status = WARNING
+                result.message = 'Configured but verification failed'
         
         except Exception as e:
-            result['Message'] = f'Exception: {str(e)[:100]}'
+            result.message = f'Exception: {str(e)[:100]}'
         
         return result
     
-    def upgrade_firmware(self, device, firmware_path):
-        device_name = device.get('DeviceName') or device.get('Hostname') or device['IPAddress']
-        ip = device['IPAddress']
-        username = device['Username']
-        password = device['Password']
-        
-        filename = os.path.basename(firmware_path)
-        
-        result = {
-            'DeviceName': device_name,
-            'IPAddress': ip,
-            'Operation': 'Upgrade',
-            'Target': filename,
-            'Status': 'Failed',
-            'Message': ''
-        }
+    def upgrade_firmware(self, device, firmware_path, catalog=None, verify_timeout=0):
+        """
+        Login, upload, install; with a FirmwareCatalog the image follows the running version
+        
+        With verify_timeout, wait until the device is back online after the
+        install (availability groups count it as unavailable until then).
+        """
+        filename = os.path.basename(firmware_path) if firmware_path else ''
+        
+        result = DeviceResult(device, OPERATION_LABELS['upgrade'], target=filename)
         
         try:
-            client = IC3000UpgradeClient(ip, username, password)
+            client = self._new_client(IC3000UpgradeClient, device)
             success, message = client.login()
             if not success:
-                result['Message'] = f'Auth: {message}'
+                result.message = f'Auth: {message}'
                 return result
             
+            if catalog is not None:
+                image = self._select_image(client, device, catalog, result)
+                if image is None:
+                    return result
+                firmware_path, filename = image.path, image.name
+            
             success, message = client.upload_firmware(firmware_path)
             if not success:
-                result['Message'] = f'Upload: {message}'
+                result.message = f'Upload: {message}'
                 return result
             
             success, message = client.install_firmware(filename)
             if not success:
-                result['Status'] = 'Warning'
-                result['Message'] = f'Uploaded but install failed: {message}'
+                result.status = WARNING
+                result.message = f'Uploaded but install failed: {message}'
+                return result
+            
+            if verify_timeout:
+                success, message = self._verify_after_install(client, verify_timeout, parse_version(filename))
+                if not success:
+                    result.status = WARNING
+                    result.message = f'Upgrade initiated but {message}'
+                    return result
+                result.status = SUCCESS
+                result.message = 'Upgrade installed, device back online'
+            else:
+                result.status = SUCCESS
+                result.message = 'Upgrade initiated (device will reboot)'
+        
+        except Exception as e:
+            result.message = f'Exception: {str(e)[:100]}'
+        
+        return result
+    
+    def load_catalog(self, directory, target_version=None):
+        """Index a firmware catalog directory (digests cached in the results directory)"""
+        return FirmwareCatalog(
+            directory,
+            os.path.join(self.results_dir, 'ic3000_firmware_index.json'),
+            pattern=self.config.get('software.catalog_pattern', '*.SPA'),
+            target=target_version or self.config.get('software.target_version') or None,
+            upgrade_paths=self.config.get('software.upgrade_paths', {})
+        )
+    
+    def _select_image(self, client, device, catalog, result):
+        """
+        Catalog image for a logged-in device, from its running version
+        
+        Returns None when there is nothing to install; result then holds the
+        outcome (Success for a device already on target, else Failed).
+        """
+        success, info = client.get_system_info()
+        if not success:
+            result.message = f'System info: {info}'
+            return None
+        target = catalog.device_target(device)
+        image, up_to_date, message = catalog.select(running_version(info), target)
+        if image is None:
+            result.target = format_version(target)
+            if up_to_date:
+                result.status = SUCCESS
+                result.message = f'{message}, upload and install skipped'
+            else:
+                result.message = message
+            return None
+        result.target = image.name
+        client.log(f'      Catalog: {message} ({image.name})')
+        return image
+    
+    def pipeline_limits(self, upload_workers=None):
+        """Per-stage concurrency limits (pipeline.stages); --workers sets the upload stage"""
+        limits = dict(DEFAULT_LIMITS)
+        limits['upload'] = self.config.get('parallel.max_workers_upgrade', limits['upload'])
+        limits.update(self.config.get('pipeline.stages', {}) or {})
+        if upload_workers:
+            limits['upload'] = upload_workers
+        return limits
+    
+    def pipeline_in_flight(self, limits):
+        """Devices in flight for a pipelined run (pipeline.max_in_flight, default login + upload limits)"""
+        # Enough to keep login and upload busy; more would only queue logged-in devices at upload.
+        # Devices rebooting after their upload do not count, so they never idle the upload stage
+        return self.config.get('pipeline.max_in_flight', 0) or limits['login'] + limits['upload']
+    
+    def availability_groups(self, operation, devices, max_unavailable=None):
+        """AvailabilityGroups for a run, or None when the operation reboots nothing or no device has a group"""
+        group_by = self.config.get('availability.group_by', 'Group')
+        if operation not in ('upgrade', 'install', 'apply') or not group_by or not any(d.get(group_by) for d in devices):
+            return None
+        if max_unavailable is None:
+            max_unavailable = self.config.get('availability.max_unavailable', 1)
+        return AvailabilityGroups(
+            max_unavailable=max_unavailable,
+            group_by=group_by,
+            limits=self.config.get('availability.group_limits', {}) or {}
+        )
+    
+    def group_workers(self, groups, devices):
+        """Default worker count with availability groups: as many as the groups let reboot at once"""
+        return max(1, min(self.config.get('availability.max_workers', 20), groups.capacity(devices)))
+    
+    def upgrade_pipelined(self, device, firmware_path, pipeline, catalog=None):
+        """
+        upgrade_firmware split into pipeline stages, each behind its own limit
+        
+        reachability (TCP connect) and login run ahead of the bandwidth-bound
+        upload stage; verify waits for the device to come back after install
+        (skipped when pipeline.verify_timeout is 0). Once uploaded, the device
+        no longer counts against max_in_flight. A session older than
+        pipeline.relogin_after by the time the upload slot frees up logs in
+        again, so a long upload queue never uploads with a stale token.
+        """
+        filename = os.path.basename(firmware_path) if firmware_path else ''
+        verify_timeout = self.config.get('pipeline.verify_timeout', 900)
+        relogin_after = self.config.get('pipeline.relogin_after', 600)
+        
+        result = DeviceResult(device, OPERATION_LABELS['upgrade'], target=filename)
+        
+        try:
+            client = self._new_client(IC3000UpgradeClient, device)
+            with pipeline.stage('reachability', client):
+                success, message = client.check_reachable()
+            if not success:
+                result.message = message
+                return result
+            
+            with pipeline.stage('login', client):
+                success, message = client.login()
+                logged_in = time.monotonic()
+                image = None
+                if success and catalog is not None:
+                    image = self._select_image(client, device, catalog, result)
+            if not success:
+                result.message = f'Auth: {message}'
+                return result
+            if catalog is not None:
+                if image is None:
+                    return result
+                firmware_path, filename = image.path, image.name
+            
+            with pipeline.stage('upload', client):
+                if relogin_after and time.monotonic() - logged_in > relogin_after:
+                    client.authenticated = False
+                    success, message = client.login()
+                    if not success:
+                        result.message = f'Auth (before upload): {message}'
+                        return result
+                success, message = client.upload_firmware(firmware_path)
+            if not success:
+                result.message = f'Upload: {message}'
+                return result
+            pipeline.mark_uploaded()
+            
+            with pipeline.stage('install', client):
+                success, message = client.install_firmware(filename)
+            if not success:
+                result.status = WARNING
+                result.message = f'Uploaded but install failed: {message}'
+                return result
+            
+            if verify_timeout:
+                with pipeline.stage('verify', client):
+                    success, message = self._verify_after_install(client, verify_timeout, parse_version(filename))
+                if not success:
+                    result.status = WARNING
+                    result.message = f'Upgrade initiated but {message}'
+                    return result
+                result.status = SUCCESS
+                result.message = 'Upgrade installed, device back online'
+            else:
+                result.status = SUCCESS
+                result.message = 'Upgrade initiated (device will reboot)'
+        
+        except StageCancelled as e:
+            result.message = f'Cancelled while queued for {e}'
+        except Exception as e:
+            result.message = f'Exception: {str(e)[:100]}'
+        finally:
+            pipeline.unmark()
+        
+        return result
+    
+    def _verify_after_install(self, client, timeout, expected=None):
+        """
+        Wait for a rebooting device to come back after its install
+        
+        A device that still answers right after the install may not have
+        started its reboot yet, so an answer alone proves nothing. The device
+        counts as back once it was seen going down (port 8443 unreachable,
+        probed every pipeline.verify_poll seconds) and then accepts a new
+        login and answers system info, or, when the installed version
+        `expected` is known, once system info reports that version (covers a
+        reboot too quick to observe).
+        """
+        interval = self.config.get('pipeline.verify_interval', 30)
+        poll = min(interval, self.config.get('pipeline.verify_poll', 5))
+        deadline = time.monotonic() + timeout
+        seen_down = False
+        next_login = time.monotonic() + interval
+        while time.monotonic() < deadline:
+            next_probe = min(time.monotonic() + (interval if seen_down else poll), deadline)
+            while time.monotonic() < next_probe:
+                if client.cancelled:
+                    return False, 'verification cancelled'
+                time.sleep(min(1.0, max(0.0, next_probe - time.monotonic())))
+            if not seen_down:
+                if not client.check_reachable()[0]:
+                    if client.cancelled:
+                        return False, 'verification cancelled'
+                    seen_down = True
+                    continue
+                # Still up: only a version check can tell a finished reboot from one not started yet
+                if expected is None or time.monotonic() < next_login:
+                    continue
+                next_login = time.monotonic() + interval
+            client.authenticated = False
+            if not client.login()[0]:
+                continue
+            success, info = client.get_system_info()
+            if not success:
+                continue
+            version = running_version(info)
+            if expected is not None and version is not None:
+                if compare_versions(version, expected) >= 0:
+                    return True, f'device back online on {format_version(version)}'
+                if seen_down:
+                    return False, f'device came back on {format_version(version)}, expected {format_version(expected)}'
+            elif seen_down:
+                return True, 'device back online'
+        if not seen_down:
+            return False, f'device not seen rebooting within {timeout}s'
+        return False, f'device not back online after {timeout}s'
+    
+    def stage_firmware(self, device, firmware_path):
+        """Phase 1 of a two-phase rollout: upload firmware without installing it"""
+        result = DeviceResult(device, OPERATION_LABELS['stage'], target=os.path.basename(firmware_path))
+        
+        try:
+            client = self._new_client(IC3000UpgradeClient, device)
+            success, message = client.login()
+            if not success:
+                result.message = f'Auth: {message}'
+                return result
+            
+            success, message = client.upload_firmware(firmware_path)
+            if not success:
+                result.message = f'Upload: {message}'
                 return result
             
-            result['Status'] = 'Success'
-            result['Message'] = 'Upgrade initiated (device will reboot)'
+            result.status = SUCCESS
+            result.message = 'Firmware staged (not installed)'
         
         except Exception as e:
-            result['Message'] = f'Exception: {str(e)[:100]}'
+            result.message = f'Exception: {str(e)[:100]}'
+        
+        return result
+    
+    def install_staged(self, device, filename, verify_timeout=0):
+        """Phase 2 of a two-phase rollout: install firmware that was staged earlier (verify_timeout: see upgrade_firmware)"""
+        result = DeviceResult(device, OPERATION_LABELS['install'], target=filename)
+        
+        try:
+            client = self._new_client(IC3000UpgradeClient, device)
+            success, message = client.login()
+            if not success:
+                result.message = f'Auth: {message}'
+                return result
+            
+            success, message = client.install_firmware(filename)
+            if not success:
+                result.message = f'Install: {message}'
+                return result
+            
+            if verify_timeout:
+                success, message = self._verify_after_install(client, verify_timeout, parse_version(filename))
+                if not success:
+                    result.status = WARNING
+                    result.message = f'Install initiated but {message}'
+                    return result
+                result.status = SUCCESS
+                result.message = 'Upgrade installed, device back online'
+            else:
+                result.status = SUCCESS
+                result.message = 'Upgrade initiated (device will reboot)'
+        
+        except Exception as e:
+            result.message = f'Exception: {str(e)[:100]}'
+        
+        return result
+    
+    def staged_record_path(self):
+        return self.config.get('software.staged_record') or os.path.join(self.results_dir, 'staged_firmware.json')
+    
+    def load_staged(self):
+        """Staging record: {firmware filename: {ip: {'DeviceName', 'StagedAt'}}}"""
+        path = self.staged_record_path()
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+    
+    def update_staged(self, results, filename):
+        """Record successful stages and forget devices whose staged image was installed"""
+        staged = self.load_staged()
+        devices = staged.setdefault(filename, {})
+        for r in results:
+            if r.status != SUCCESS:
+                continue
+            if r.operation == OPERATION_LABELS['stage']:
+                devices[r.ip] = {'DeviceName': r.device_name, 'StagedAt': datetime.now().isoformat(timespec='seconds')}
+            elif r.operation == OPERATION_LABELS['install']:
+                devices.pop(r.ip, None)
+        if not devices:
+            del staged[filename]
+        
+        path = self.staged_record_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(staged, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    
+    def apply_config(self, device, firmware_path=None, verify_timeout=0):
+        """
+        Bring one device to its desired state in a single authenticated session
+        
+        Steps always run in this order, skipping any the device does not ask for:
+        1. NTP servers (NTPServer column, else ntp.default_server)
+        2. Verification steps (Verify column, else apply.verify): 'ntp' reads the
+           NTP config back, 'system_info' checks the system info endpoint answers
+        3. Firmware upload and install (Firmware column, else --firmware).
+           Install reboots the device, so it is always last; with verify_timeout
+           the step ends once the device is back online.
+        """
+        ntp_server = device.ntp_server or self.config.get('ntp.default_server')
+        firmware_path = device.firmware or firmware_path
+        if device.verify is not None:
+            verify_steps = [v.strip() for v in device.verify.split(',') if v.strip()]
+        else:
+            verify_steps = self.config.get('apply.verify', ['ntp'])
+        
+        result = DeviceResult(device, OPERATION_LABELS['apply'], target=self.operation_target(device, 'apply', firmware_path))
+        done = []
+        
+        try:
+            client = self._new_client(IC3000UpgradeClient, device)
+            success, message = client.login()
+            if not success:
+                result.message = f'Auth: {message}'
+                return result
+            
+            if ntp_server:
+                success, message = client.set_ntp_config(ntp_server)
+                if not success:
+                    result.message = f'NTP: {message}'
+                    return result
+                done.append('ntp')
+            
+            warnings = []
+            with self.tracer.span('verify', steps=','.join(verify_steps)):
+                for step in verify_steps:
+                    if step == 'ntp':
+                        success, _ = client.get_ntp_config()
+                    elif step == 'system_info':
+                        success, _ = client.get_system_info()
+                    else:
+                        result.message = f'Unknown verification step: {step}'
+                        return result
+                    if success:
+                        done.append(f'verify {step}')
+                    else:
+                        warnings.append(f'verify {step} failed')
+            
+            if firmware_path:
+                success, message = client.upload_firmware(firmware_path)
+                if not success:
+                    result.message = '; '.join(done + [f'Upload: {message}'])
+                    return result
+                done.append('upload')
+                
+                success, message = client.install_firmware(os.path.basename(firmware_path))
+                if not success:
+                    result.status = WARNING
+                    result.message = '; '.join(done + [f'install failed: {message}'])
+                    return result
+                if verify_timeout:
+                    done.append('install')
+                    success, message = self._verify_after_install(
+                        client, verify_timeout, parse_version(os.path.basename(firmware_path)))
+                    if not success:
+                        result.status = WARNING
+                        result.message = '; '.join(done + [message])
+                        return result
+                    done.append(message)
+                else:
+                    done.append('install (device will reboot)')
+            
+            result.status = WARNING if warnings else SUCCESS
+            result.message = '; '.join(done + warnings)
+        
+        except Exception as e:
+            result.message = '; '.join(done + [f'Exception: {str(e)[:100]}'])
         
         return result
     
     def process_batch(self, devices, operation, **kwargs):
+        """
+        Run one operation across devices with at most max_workers in flight
+        
+        Each device runs in its own daemon thread. A device that exceeds the
+        per-device deadline (timeouts.device) is recorded as Timeout, its client
+        is cancelled and its slot is handed to the next queued device straight
+        away instead of waiting for the stuck request to return. Ctrl+C cancels
+        in-flight devices and drops the queue without waiting for them.
+        
+        Free slots go to the highest-priority device whose maintenance window
+        is open (see ic3000_schedule). Devices still queued at the --until
+        cut-off are recorded as Skipped.
+        
+        With a FailureBreaker (kwargs['breaker']), dispatch stops as soon as it
+        trips: in-flight devices finish, queued devices are left untouched.
+        
+        With a SiteBreaker (kwargs['site_breaker']), queued devices of a site
+        whose breaker is open are held back; half-open probes are dispatched
+        as free slots allow, and when nothing else is left the batch waits for
+        the remaining probes before recording held devices as SiteUnreachable.
+        
+        With AvailabilityGroups (kwargs['groups']), a device of a group at its
+        max-unavailable limit is held until a member of the group comes back;
+        upgrade, install and apply then wait for the post-install check
+        (pipeline.verify_timeout), which extends the device deadline. Devices
+        still held when no member can come back are recorded as Skipped.
+        
+        With kwargs['pipeline'] (upgrade only), max_workers caps the devices that
+        have not finished their upload yet and each stage applies its own limit
+        (see ic3000_pipeline); devices waiting out install and reboot do not
+        hold back the next ones. Time queued between stages does not count against
+        the device deadline; the verify wait extends it.
+        """
         max_workers = kwargs.get('max_workers', 5)
         firmware_path = kwargs.get('firmware_path')
+        device_timeout = kwargs.get('device_timeout', self.config.get('timeouts.device', 0))
+        groups = kwargs.get('groups')
+        pipeline = None
+        done_queue = queue.Queue()
+        # Without availability groups a non-pipelined install is fire-and-forget
+        verify_timeout = self.config.get('pipeline.verify_timeout', 900) if groups is not None else 0
         
+        if operation == 'ntp':
+            func, extra_args = self.configure_ntp, ()
+            verify_timeout = 0
+        elif operation == 'upgrade' and kwargs.get('pipeline'):
+            # A finished upload frees an in-flight place: wake the dispatcher
+            pipeline = StagePipeline(kwargs.get('stage_limits') or self.pipeline_limits(),
+                                     on_uploaded=lambda: done_queue.put((None, None)))
+            func, extra_args = self.upgrade_pipelined, (firmware_path, pipeline, kwargs.get('catalog'))
+            verify_timeout = self.config.get('pipeline.verify_timeout', 900)
+        elif operation == 'upgrade':
+            func, extra_args = self.upgrade_firmware, (firmware_path, kwargs.get('catalog'), verify_timeout)
+        elif operation == 'apply':
+            func, extra_args = self.apply_config, (firmware_path, verify_timeout)
+        elif operation == 'stage':
+            func, extra_args = self.stage_firmware, (firmware_path,)
+            verify_timeout = 0
+        elif operation == 'install':
+            func, extra_args = self.install_staged, (os.path.basename(firmware_path), verify_timeout)
+        else:
+            raise ValueError(f'Unknown operation: {operation}')
+        if device_timeout:
+            device_timeout += verify_timeout
+        
+        breaker = kwargs.get('breaker')
+        site_breaker = kwargs.get('site_breaker')
         results = []
-        completed = 0
-        total = len(devices)
+        pending = DeviceScheduler(devices, until=kwargs.get('until'))
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            if operation == 'ntp':
-                futures = {executor.submit(self.configure_ntp, device): device for device in devices}
-            elif operation == 'upgrade':
-                futures = {executor.submit(self.upgrade_firmware, device, firmware_path): device for device in devices}
-            else:
-                raise ValueError(f'Unknown operation: {operation}')
-            
-            for future in as_completed(futures):
-                device = futures[future]
+        def probe_eligible(device):
+            # Half-open probes obey the same window and --until checks as queued devices
+            return pending.eligible(device, datetime.now()) and (groups is None or groups.has_room(device))
+        
+        def held_count():
+            return ((site_breaker.held_count if site_breaker is not None else 0)
+                    + (groups.held_count if groups is not None else 0))
+        
+        def record(result, device=None):
+            results.append(result)
+            self.logger.result(result)
+            if breaker is not None:
+                breaker.record(result.status)
+            if site_breaker is not None and device is not None:
+                event, released = site_breaker.record(device, result, time.monotonic())
+                if event:
+                    self.logger.message(event)
+                    self.tracer.instant('site breaker', message=event)
+                for held in released:
+                    pending.push(held)
+            if groups is not None and device is not None:
+                event, released = groups.release(device, result)
+                if event:
+                    self.logger.message(event)
+                    self.tracer.instant('availability group', message=event)
+                for held in released:
+                    pending.push(held)
+        
+        def failure(device, status, message, duration=None):
+            target = self.operation_target(device, operation, firmware_path, kwargs.get('catalog'))
+            return self._failure_result(device, operation, status, message, duration, target)
+        
+        task_ids = itertools.count()
+        running = {}  # task id -> (device, thread, start time, worker slot)
+        free_slots = list(range(1, max_workers + 1))  # heap; lowest free slot first
+        extra_slots = itertools.count(max_workers + 1)  # pipelined devices past upload can outnumber max_workers
+        waiting_logged = False
+        
+        def in_flight():
+            if pipeline is None:
+                return len(running)
+            return pipeline.in_flight(thread for _, thread, _, _ in running.values())
+        
+        try:
+            while running or (pending and not (breaker and breaker.tripped)) or held_count():
+                now = datetime.now()
+                for device in pending.expire(now):
+                    record(failure(device, SKIPPED, 'Maintenance window cut-off (--until) reached'))
+                
+                while in_flight() < max_workers and not (breaker and breaker.tripped):
+                    device = site_breaker.next_probe(time.monotonic(), probe_eligible) if site_breaker is not None else None
+                    if device is None:
+                        device = pending.pop_next(now)
+                        if device is None:
+                            break
+                        if site_breaker is not None and not site_breaker.admit(device):
+                            continue
+                        if groups is not None and not groups.admit(device):
+                            continue
+                    elif groups is not None:
+                        groups.admit(device)  # probes are only picked from devices with room in their group
+                    task_id = next(task_ids)
+                    slot = heapq.heappop(free_slots) if free_slots else next(extra_slots)
+                    thread = threading.Thread(
+                        target=self._run_device_task,
+                        args=(task_id, slot, operation, device, func, extra_args, done_queue,
+                              self.operation_target(device, operation, firmware_path, kwargs.get('catalog'))),
+                        name=f'ic3000-device-{device.ip}',
+                        daemon=True
+                    )
+                    thread.start()
+                    running[task_id] = (device, thread, time.monotonic(), slot)
+                
+                if not running:
+                    if breaker and breaker.tripped:
+                        break
+                    if not pending and site_breaker is not None and site_breaker.held_count:
+                        # Only devices behind open site breakers are left: wait for their probes, then give up
+                        wait_seconds = site_breaker.seconds_until_probe(time.monotonic(), probe_eligible)
+                        if wait_seconds is None:
+                            for site, device in site_breaker.give_up():
+                                record(failure(device, SITE_UNREACHABLE, f'Site {site} unreachable (circuit breaker open)'))
+                        else:
+                            if not waiting_logged:
+                                self.logger.message(f'Waiting {wait_seconds:.0f}s to probe {site_breaker.held_count} '
+                                                    f'devices held by open site breakers')
+                                waiting_logged = True
+                            time.sleep(min(max(wait_seconds, 0.1), 5))
+                        continue
+                    if not pending and groups is not None and groups.held_count:
+                        # Nothing in flight can bring a group below its limit any more
+                        for group, device in groups.give_up():
+                            record(failure(
+                                device, SKIPPED,
+                                f'Group {group} at its limit of {groups.limit(group)} unavailable '
+                                f'({len(groups.lost.get(group, ()))} not back in service after install)'
+                            ))
+                        continue
+                    if not pending:
+                        break
+                    # Nothing eligible: idle until the next maintenance window opens
+                    wait_seconds = pending.seconds_until_eligible(now)
+                    if not waiting_logged:
+                        opens = (now + timedelta(seconds=wait_seconds)).strftime('%H:%M')
+                        self.logger.message(f'Waiting for maintenance window: {len(pending)} devices queued, next window opens at {opens}')
+                        self.tracer.instant('waiting for maintenance window', queued=len(pending), opens=opens)
+                        waiting_logged = True
+                    time.sleep(min(max(wait_seconds, 0.5), 5))
+                    continue
+                waiting_logged = False
+                
+                # Wake up at the next deadline; the short cap keeps Ctrl+C responsive
+                wait = 0.5
+                if device_timeout:
+                    earliest = min(started for _, _, started, _ in running.values())
+                    wait = max(0.0, min(wait, earliest + device_timeout - time.monotonic()))
+                
                 try:
-                    result = future.result(timeout=kwargs.get('timeout', 600))
-                    results.append(result)
-                    completed += 1
-                    
-                    status_icon = '✓' if result['Status'] == 'Success' else '✗'
-                    target_info = f' → {result["Target"]}' if 'Target' in result else ''
-                    print(f'[{completed}/{total}] {status_icon} {result["DeviceName"]} ({result["IPAddress"]}){target_info}')
-                    if result['Status'] != 'Success' and result['Message']:
-                        print(f'            {result["Message"][:70]}')
+                    task_id, result = done_queue.get(timeout=wait)
+                except queue.Empty:
+                    task_id = None
                 
-                except Exception as e:
-                    device_name = device.get('DeviceName') or device.get('Hostname') or device['IPAddress']
-                    print(f'[{completed+1}/{total}] FAIL {device_name} - {str(e)[:50]}')
-                    results.append({
-                        'DeviceName': device_name,
-                        'IPAddress': device['IPAddress'],
-                        'Operation': operation,
-                        'Status': 'Failed',
-                        'Message': str(e)[:100]
-                    })
-                    completed += 1
+                # Late results of devices already recorded as Timeout are dropped
+                if task_id in running:
+                    device, _, _, slot = running.pop(task_id)
+                    heapq.heappush(free_slots, slot)
+                    record(result, device)
+                
+                if device_timeout:
+                    now = time.monotonic()
+                    for task_id, (device, thread, started, slot) in list(running.items()):
+                        if now - started - self._queued_time(thread.ident) >= device_timeout:
+                            del running[task_id]
+                            heapq.heappush(free_slots, slot)
+                            self._cancel_client(thread.ident)
+                            self.tracer.instant('device timeout', ip=device.ip)
+                            record(failure(
+                                device, TIMEOUT, f'Device deadline of {device_timeout}s exceeded',
+                                duration=now - started
+                            ), device)
+        
+        except KeyboardInterrupt:
+            self.interrupted = True
+            now = time.monotonic()
+            for task_id, (device, thread, started, _) in running.items():
+                self._cancel_client(thread.ident)
+                results.append(failure(device, CANCELLED, 'Interrupted by user', duration=now - started))
+            self.logger.message(f'Interrupted: cancelled {len(running)} in-flight and {len(pending) + held_count()} queued devices')
+        
+        # Halted or interrupted: held devices stay untouched like the queue
+        held = held_count()
+        if site_breaker is not None:
+            site_breaker.give_up()
+        if groups is not None:
+            groups.give_up()
+        if breaker is not None and breaker.tripped and (pending or held):
+            self.logger.message(f'Circuit breaker tripped ({breaker.reason}): {len(pending) + held} queued devices left untouched')
+        if pipeline is not None:
+            self.logger.message(f'Pipeline stages: {pipeline.summary()}')
         
         return results
     
     def save_results(self, results, operation):
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = os.path.join(self.results_dir, f'ic3000_{operation}_{timestamp}.csv')
+        # Replayed outcomes go to a subdirectory, out of reach of --estimate's result-file model
+        directory = os.path.join(self.results_dir, 'replay') if self.cassette is not None else self.results_dir
+        filename = os.path.join(directory, f'ic3000_{operation}_{timestamp}.csv')
         
         if not results:
             return None
         
-        fieldnames = list(results[0].keys())
-        
+        os.makedirs(directory, exist_ok=True)
         with open(filename, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
             writer.writeheader()
-            writer.writerows(results)
+            writer.writerows(r.as_row() for r in results)
         
         return filename
     
+    def _after_batch(self, operation, batch_results, **kwargs):
+        """Persist a finished batch right away so an aborted run keeps what it did"""
+        # A replayed stage never put an image on the real devices: keep it out of the staging record
+        if operation in ('stage', 'install') and self.cassette is None:
+            self.update_staged(batch_results, os.path.basename(kwargs['firmware_path']))
+        if self.history is not None and self.run_id is not None:
+            self.history.record(self.run_id, batch_results)
+            succeeded = {r.ip: self._fingerprints[r.ip] for r in batch_results
+                         if r.status == SUCCESS and r.ip in self._fingerprints}
+            if succeeded:
+                self.history.save_fingerprints(self.run_id, OPERATION_LABELS[operation], succeeded)
+    
+    # Inventory columns each operation writes to the device; everything else (credentials,
+    # scheduling, Site/Group/Region) only decides how and when it is reached
+    STATE_COLUMNS = {
+        'ntp': ('NTPServer',),
+        'upgrade': ('Firmware',),  # per-device pin with --catalog
+        'stage': (),
+        'install': (),
+        'apply': ('NTPServer', 'Verify', 'Firmware'),
+    }
+    
+    def desired_state(self, device, operation, firmware_path=None, catalog=None):
+        """
+        What a successful run of `operation` leaves on the device: the columns
+        it applies plus the config defaults and firmware image they fall back to
+        """
+        state = {column: device.get(column) for column in self.STATE_COLUMNS[operation]}
+        if operation in ('ntp', 'apply') and not device.ntp_server:
+            state['ntp.default_server'] = self.config.get('ntp.default_server')
+        if operation == 'apply':
+            if device.verify is None:
+                state['apply.verify'] = self.config.get('apply.verify', ['ntp'])
+            firmware_path = device.firmware or firmware_path
+        if operation in ('upgrade', 'stage', 'install', 'apply') and firmware_path:
+            # Image identity: the same file name with a different size is a different build
+            size = os.path.getsize(firmware_path) if os.path.exists(firmware_path) else None
+            state['firmware'] = [os.path.basename(firmware_path), size]
+        if catalog is not None:
+            state['catalog'] = catalog.plan_key()
+        return state
+    
+    def fingerprint(self, device, operation, firmware_path=None, catalog=None):
+        state = json.dumps(self.desired_state(device, operation, firmware_path, catalog), sort_keys=True, default=str)
+        return hashlib.sha256(state.encode()).hexdigest()
+    
+    def select_changed(self, devices, operation, full_sweep=False):
+        """
+        Narrow devices to those whose desired state changed since it last succeeded
+        
+        New devices and devices whose fingerprint differs from the stored one are
+        kept. Returns (devices, is_full_sweep): every device is kept when
+        full_sweep is set or the last full sweep is older than
+        history.full_sweep_days.
+        """
+        if self.history is None:
+            print('Run history is disabled (history.enabled); cannot select changed devices')
+            return [], False
+        
+        label = OPERATION_LABELS[operation]
+        if not full_sweep:
+            sweep_days = self.config.get('history.full_sweep_days', 7)
+            last_sweep = self.history.last_sweep(label)
+            if sweep_days and (last_sweep is None or datetime.now() - last_sweep >= timedelta(days=sweep_days)):
+                since = f'last one {last_sweep:%Y-%m-%d %H:%M}' if last_sweep else 'none recorded'
+                print(f'Changed-only: full sweep due ({since}, history.full_sweep_days {sweep_days})')
+                full_sweep = True
+        if full_sweep:
+            return devices, True
+        
+        stored = self.history.fingerprints(label)
+        new = [d for d in devices if d.ip not in stored]
+        changed = [d for d in devices if d.ip in stored and stored[d.ip] != self._fingerprints[d.ip]]
+        print(f'Changed-only: {len(new)} new, {len(changed)} changed, '
+              f'{len(devices) - len(new) - len(changed)} unchanged since their last successful {label}')
+        selected = {d.ip for d in new + changed}
+        return [d for d in devices if d.ip in selected], False
+    
+    def select_from_history(self, devices, operation, retry_failed=False, failing=None):
+        """Narrow devices to last run's failures and/or devices failing N runs in a row"""
+        if self.history is None:
+            print('Run history is disabled (history.enabled); cannot select devices from it')
+            return []
+        
+        label = OPERATION_LABELS[operation]
+        selected = set()
+        if retry_failed:
+            ips = self.history.last_run_failures(label)
+            print(f'History: {len(ips)} devices failed in the last {label} run')
+            selected.update(ips)
+        if failing:
+            streaks = self.history.consecutive_failures(label, failing)
+            print(f'History: {len(streaks)} devices failed {label} {failing}+ runs in a row')
+            selected.update(streaks)
+        return [d for d in devices if d.ip in selected]
+    
+    def report(self, operation, op_desc, devices, all_results, duration, not_processed=None):
+        """Print the run summary, save the result CSV and close the run in history"""
+        success_count = sum(1 for r in all_results if r.status == SUCCESS)
+        warning_count = sum(1 for r in all_results if r.status == WARNING)
+        failed_count = sum(1 for r in all_results if r.status == FAILED)
+        timeout_count = sum(1 for r in all_results if r.status == TIMEOUT)
+        skipped_count = sum(1 for r in all_results if r.status == SKIPPED)
+        unreachable_count = sum(1 for r in all_results if r.status == SITE_UNREACHABLE)
+        
+        print('\n' + '='*80)
+        print(f'{op_desc.upper()} COMPLETE')
+        print('='*80)
+        print(f'Total Devices: {len(devices)}')
+        print(f'Success: {success_count}')
+        if warning_count > 0:
+            print(f'Warning: {warning_count}')
+        print(f'Failed: {failed_count}')
+        if timeout_count > 0:
+            print(f'Timeout: {timeout_count}')
+        if skipped_count > 0:
+            print(f'Skipped: {skipped_count}')
+        if unreachable_count > 0:
+            print(f'Site unreachable: {unreachable_count}')
+        if not_processed:
+            print(f'Not processed: {len(devices) - len(all_results)} {not_processed}')
+        print(f'Duration: {duration:.1f}s ({duration/60:.1f} minutes)')
+        if len(devices) > 0:
+            print(f'Avg per Device: {duration/len(devices):.1f}s')
+            print(f'Success Rate: {success_count/len(devices)*100:.1f}%')
+        print('='*80)
+        print()
+        
+        # Show detailed results for small sets
+        if len(devices) <= 20:
+            print('DETAILED RESULTS:')
+            print('-' * 80)
+            print(f'{"Device":<25} {"IP":<18} {"Status":<10} {"Target"}')
+            print('-' * 80)
+            for r in all_results:
+                name = r.device_name[:24]
+                ip = r.ip
+                status = r.status
+                target = r.target
+                # Truncate target if too long, but show multiple servers
+                if len(target) > 35:
+                    target_display = target[:32] + '...'
+                else:
+                    target_display = target
+                print(f'{name:<25} {ip:<18} {status:<10} {target_display}')
+            print()
+        
+        result_file = self.save_results(all_results, operation)
+        if result_file:
+            print(f'✓ Detailed results saved: {result_file}')
+        if self.history is not None:
+            self.history.finish_run(self.run_id, result_file)
+            print(f'✓ Run {self.run_id} recorded in history: {self.history.db_path}')
+        
+        failures = [r for r in all_results if r.status in FAILURE_STATUSES]
+        if failures and len(failures) <= 10:
+            print('\n' + '='*80)
+            print(f'FAILED DEVICES ({len(failures)}):')
+            print('='*80)
+            for f in failures:
+                print(f'\n{f.device_name} ({f.ip})')
+                print(f'  Error: {f.message}')
+        
+        return result_file
+    
+    def estimate(self, devices, operation, max_workers, batches, batch_delay, firmware_path=None, target_minutes=None):
+        """Predict the run's duration from earlier runs instead of running it (--estimate)"""
+        label = OPERATION_LABELS[operation]
+        spread_by = self.config.get('rollout.spread_by', 'Site')
+        sites = [spread_key(d, spread_by) for d in devices]
+        site_by_ip = {d.ip: site for d, site in zip(devices, sites)}
+        site_of = lambda ip: site_by_ip.get(ip) or subnet_key(ip)
+        
+        # Only operations that upload get their upload phase rescaled to this image
+        image_bytes = None
+        if operation in ('upgrade', 'stage', 'apply') and firmware_path and os.path.exists(firmware_path):
+            image_bytes = os.path.getsize(firmware_path)
+        known_images = [firmware_path, self.config.get('software.firmware_path')] + [d.firmware for d in devices]
+        
+        model, source = None, None
+        if self.history is not None:
+            model = load_history_model(self.history, label, site_of, image_sizes(known_images))
+            source = f'run history ({self.history.db_path})'
+        if not model:
+            model = load_results_model(self.results_dir, operation, site_of)
+            source = f'result files ({self.results_dir}/ic3000_{operation}_*.csv, total duration only)'
+        if not model:
+            print(f'No recorded {label} runs to estimate from (run history or {self.results_dir}/ic3000_{operation}_*.csv)')
+            return
+        
+        batch_sizes = [len(b) for b in batches]
+        totals = estimate(model, sites, max_workers, batch_sizes, batch_delay, image_bytes,
+                          device_timeout=self.config.get('timeouts.device', 0))
+        current = totals[max_workers]
+        
+        print('='*80)
+        print(f'ESTIMATE: IC3000 {label.upper()} ON {len(devices)} DEVICES')
+        print('='*80)
+        print(f'Samples: {len(model)} device outcomes from {source}')
+        distinct = sorted(set(sites))
+        fitted = sum(1 for site in distinct if model.site_has_fit(site))
+        print(f'Sites: {len(distinct)} ({fitted} with their own fit, {len(distinct) - fitted} use the fleet-wide fit)')
+        rates = sorted(model.throughput.get(None, ()))
+        if image_bytes and rates:
+            print(f'Upload Throughput: median {percentile(rates, 0.5) / 1048576:.1f} MB/s '
+                  f'(p10 {percentile(rates, 0.1) / 1048576:.1f}, p90 {percentile(rates, 0.9) / 1048576:.1f}) '
+                  f'for a {image_bytes / 1048576:.1f} MB image')
+        print(f'Settings: {max_workers} workers, {len(batches)} batch(es), {batch_delay}s between batches')
+        print(f'Predicted Duration: {format_duration(percentile(current, 0.5))} '
+              f'(90% interval {format_duration(percentile(current, 0.05))} - {format_duration(percentile(current, 0.95))}, '
+              f'{len(current)} simulated runs)')
+        print('='*80)
+        print()
+        
+        print(f'{"Workers":>7}  {"Median":>8}  {"p90":>8}')
+        print('-' * 28)
+        for n, values in sorted(totals.items()):
+            marker = '  <- current' if n == max_workers else ''
+            print(f'{n:>7}  {format_duration(percentile(values, 0.5)):>8}  {format_duration(percentile(values, 0.9)):>8}{marker}')
+        print()
+        
+        if target_minutes:
+            best = recommend(totals, target_minutes * 60)
+            if best is None:
+                print(f'✗ No worker count up to {max(totals)} fits a {target_minutes}-minute window at 90% confidence; '
+                      f'split the run or reduce batch delays')
+            else:
+                print(f'✓ Recommended for a {target_minutes}-minute window: --workers {best} '
+                      f'(p90 {format_duration(percentile(totals[best], 0.9))})')
+    
     def run(self, operation, **kwargs):
         test_mode = kwargs.get('test_mode', self.config.get('safety.test_mode_default', False))
+        if kwargs.get('replay'):
+            try:
+                self.cassette = Cassette(kwargs['replay'])
+            except (OSError, ValueError, KeyError) as e:
+                print(f'Cannot load cassette {kwargs["replay"]}: {e}')
+                return
+            self.replay_speed = kwargs.get('replay_speed', self.config.get('replay.speed', 1.0))
+            # Replayed outcomes say nothing about the real devices: keep them out of history and fingerprints
+            self.history = None
         devices = self.load_devices(kwargs.get('csv_file'), test_mode, kwargs.get('limit'))
         
+        if kwargs.get('retry_failed') or kwargs.get('failing'):
+            devices = self.select_from_history(devices, operation, kwargs.get('retry_failed'), kwargs.get('failing'))
+        
+        # Highest priority first (stable, so CSV order breaks ties); batches follow this order too
+        devices.sort(key=lambda d: -d.priority)
+        
         if not devices:
             print('No devices to process')
             return
@@ -247,44 +1196,192 @@ class IC3000Manager:
         elif operation == 'upgrade':
             max_workers = kwargs.get('max_workers', self.config.get('parallel.max_workers_upgrade', 3))
             op_desc = 'Software Upgrade'
+            # A catalog picks the image per device; --firmware still forces one image for everyone
+            catalog_dir = kwargs.get('catalog_dir')
+            if not catalog_dir and not kwargs.get('firmware_path'):
+                catalog_dir = self.config.get('software.catalog_dir')
+            if catalog_dir:
+                try:
+                    catalog = self.load_catalog(catalog_dir, kwargs.get('target_version'))
+                except (OSError, ValueError) as e:
+                    print(f'Firmware catalog error: {e}')
+                    return
+                if not catalog:
+                    print(f'No firmware images in catalog {catalog_dir}')
+                    return
+                kwargs['catalog'] = catalog
+            else:
+                firmware_path = kwargs.get('firmware_path') or self.config.get('software.firmware_path')
+                if not firmware_path or not os.path.exists(firmware_path):
+                    print(f'Firmware file not found: {firmware_path}')
+                    return
+                kwargs['firmware_path'] = firmware_path
+            if kwargs.get('pipeline', self.config.get('pipeline.enabled', False)):
+                # --workers sets the upload stage; max_workers becomes the devices not yet past upload
+                kwargs['pipeline'] = True
+                kwargs['stage_limits'] = self.pipeline_limits(kwargs.get('max_workers'))
+                max_workers = self.pipeline_in_flight(kwargs['stage_limits'])
+        elif operation == 'stage':
+            # Pre-staging runs during business hours: keep concurrency (and bandwidth) low
+            max_workers = kwargs.get('max_workers', self.config.get('parallel.max_workers_stage', 2))
+            op_desc = 'Firmware Pre-Staging'
             firmware_path = kwargs.get('firmware_path') or self.config.get('software.firmware_path')
             if not firmware_path or not os.path.exists(firmware_path):
                 print(f'Firmware file not found: {firmware_path}')
                 return
             kwargs['firmware_path'] = firmware_path
+        elif operation == 'install':
+            # Install only sends a trigger per device, so the maintenance window can use high concurrency
+            max_workers = kwargs.get('max_workers', self.config.get('parallel.max_workers_install', 20))
+            op_desc = 'Staged Firmware Install'
+            firmware_path = kwargs.get('firmware_path') or self.config.get('software.firmware_path')
+            if not firmware_path:
+                print('No firmware specified (--firmware or software.firmware_path)')
+                return
+            kwargs['firmware_path'] = firmware_path
+            staged = self.load_staged().get(os.path.basename(firmware_path), {})
+            not_staged = [d for d in devices if d.ip not in staged]
+            devices = [d for d in devices if d.ip in staged]
+            if not_staged:
+                print(f'Skipping {len(not_staged)} devices without a successful stage of {os.path.basename(firmware_path)}')
+            if not devices:
+                print('No staged devices to install')
+                return
+        elif operation == 'apply':
+            max_workers = kwargs.get('max_workers', self.config.get('parallel.max_workers_apply', 3))
+            op_desc = 'Apply Desired State'
+            # Firmware is optional for apply: only devices with a Firmware column or --firmware get upgraded
+            firmware_paths = {d.firmware for d in devices}
+            firmware_paths.add(kwargs.get('firmware_path'))
+            missing = sorted(p for p in firmware_paths if p and not os.path.exists(p))
+            if missing:
+                print(f'Firmware file not found: {", ".join(missing)}')
+                return
         else:
             print(f'Unknown operation: {operation}')
             return
         
+        # A run over the whole inventory counts as a full sweep for --changed-only
+        full_sweep = not (test_mode or kwargs.get('limit') or kwargs.get('retry_failed') or kwargs.get('failing'))
+        if self.history is not None:
+            self._fingerprints = {d.ip: self.fingerprint(d, operation, kwargs.get('firmware_path'), kwargs.get('catalog'))
+                                  for d in devices}
+        if kwargs.get('changed_only'):
+            devices, full_sweep = self.select_changed(devices, operation, kwargs.get('full_sweep'))
+            if not devices:
+                print('No changed devices to process')
+                return
+        
+        rollout = kwargs.get('rollout') or self.config.get('rollout.enabled', False)
+        breaker = None
+        if rollout:
+            breaker = FailureBreaker(
+                max_failure_rate=self.config.get('rollout.max_failure_rate', 0.25),
+                window=self.config.get('rollout.failure_window', 20),
+                min_samples=self.config.get('rollout.min_samples', 5),
+                max_failures=self.config.get('rollout.max_failures', 0)
+            )
+            batches = plan_cohorts(
+                devices,
+                self.config.get('rollout.canary_size', 3),
+                self.config.get('rollout.ramp_factor', 2),
+                self.config.get('rollout.spread_by', 'Site')
+            )
+        elif batch_size > 0 and batch_size < len(devices):
+            batches = [devices[i:i+batch_size] for i in range(0, len(devices), batch_size)]
+        else:
+            batches = [devices]
+        
+        # Redundancy groups (Group column) bound how many members reboot at once instead of a low worker count
+        groups = self.availability_groups(operation, devices, kwargs.get('max_unavailable'))
+        if groups is not None and 'max_workers' not in kwargs and not kwargs.get('pipeline'):
+            max_workers = self.group_workers(groups, devices)
+        
+        site_breaker = None
+        if kwargs.get('site_breaker', self.config.get('site_breaker.enabled', False)):
+            site_breaker = SiteBreaker(
+                threshold=self.config.get('site_breaker.threshold', 3),
+                cooldown=self.config.get('site_breaker.cooldown', 120),
+                max_probes=self.config.get('site_breaker.max_probes', 2),
+                group_by=self.config.get('site_breaker.group_by', 'Site')
+            )
+        
+        if kwargs.get('estimate'):
+            if kwargs.get('pipeline'):
+                # The simulator models independent worker slots, not per-stage limits
+                print('--estimate does not model pipeline stage limits: estimate without --pipeline '
+                      '(and with pipeline.enabled off)')
+                return
+            delay = self.config.get('rollout.cohort_delay', batch_delay) if rollout else batch_delay
+            self.estimate(devices, operation, max_workers, batches, delay, kwargs.get('firmware_path'),
+                          kwargs.get('target_minutes'))
+            return
+        
         print('='*80)
         print(f'IC3000 {op_desc.upper()}')
         print('='*80)
-        if operation == 'upgrade' and kwargs.get('firmware_path'):
+        if operation in ('upgrade', 'apply', 'stage') and kwargs.get('firmware_path'):
             fw_name = os.path.basename(kwargs['firmware_path'])
             fw_size = os.path.getsize(kwargs['firmware_path']) / (1024 * 1024)
             print(f'Firmware: {fw_name} ({fw_size:.1f} MB)')
+        if kwargs.get('catalog'):
+            catalog = kwargs['catalog']
+            print(f'Firmware Catalog: {catalog.directory} ({len(catalog)} images, target {format_version(catalog.target)}'
+                  f'{", " + str(catalog.digested) + " digested" if catalog.digested else ""})')
+            for version, image in sorted(catalog.images.items()):
+                print(f'  {format_version(version):<10} {image.name} ({image.size / (1024 * 1024):.1f} MB, sha256 {image.sha256[:12]})')
         print(f'Total Devices: {len(devices)}')
-        print(f'Parallel Workers: {max_workers}')
-        if batch_size > 0:
+        if self.cassette is not None:
+            speed = f'{self.replay_speed:g}x' if self.replay_speed else 'no delays'
+            print(f'Replay: {self.cassette.path} ({len(self.cassette)} exchanges from {len(self.cassette.hosts)} devices, '
+                  f'{speed}) - nothing is sent to devices')
+        if kwargs.get('pipeline'):
+            limits = kwargs['stage_limits']
+            stages = ' -> '.join(f'{name} {limits[name]}' for name in STAGES)
+            print(f'Pipeline: {stages} ({max_workers} devices in flight)')
+        else:
+            print(f'Parallel Workers: {max_workers}')
+        windowed = sum(1 for d in devices if d.window)
+        if windowed:
+            print(f'Maintenance Windows: {windowed} devices only dispatched inside their window')
+        if kwargs.get('until'):
+            print(f'Dispatch Until: {kwargs["until"].strftime("%Y-%m-%d %H:%M")} (queued devices are skipped after)')
+        if rollout:
+            print(f'Automated Rollout: canary of {len(batches[0])} across sites, then cohorts of '
+                  f'{", ".join(str(len(b)) for b in batches[1:]) or "-"}')
+            print(f'Circuit Breaker: halt at {breaker.max_failure_rate:.0%} failures over last '
+                  f'{breaker.recent.maxlen} devices' + (f' or {breaker.max_failures} failures total' if breaker.max_failures else ''))
+        elif batch_size > 0:
             print(f'Batch Size: {batch_size} devices per batch')
             print(f'Batch Delay: {batch_delay}s between batches')
+        if groups is not None:
+            group_count = len({groups.group(d) for d in devices} - {''})
+            print(f'Availability Groups: {group_count} by {groups.group_by} column, at most {groups.max_unavailable} '
+                  f'unavailable per group until back online' + (f' ({len(groups.limits)} overrides)' if groups.limits else ''))
+        if site_breaker is not None:
+            print(f'Site Breaker: hold a {site_breaker.group_by or "subnet"} (else /24) after {site_breaker.threshold} '
+                  f'consecutive connection failures, probe after {site_breaker.cooldown}s')
         print('='*80)
         print()
         
         print('Devices to configure:')
         for i, d in enumerate(devices[:5], 1):
-            name = d.get('DeviceName') or d.get('Hostname') or d['IPAddress']
             if operation == 'ntp':
-                ntp = d.get('NTPServer', self.config.get('ntp.default_server'))
+                ntp = d.ntp_server or self.config.get('ntp.default_server')
                 # Show multiple NTP servers if present
                 if ',' in ntp:
                     ntp_list = [s.strip() for s in ntp.split(',')]
                     ntp_display = ', '.join(ntp_list)
-                    print(f'  {i}. {name} ({d["IPAddress"]}) → NTP: {ntp_display}')
+                    print(f'  {i}. {d.name} ({d.ip}) → NTP: {ntp_display}')
                 else:
-                    print(f'  {i}. {name} ({d["IPAddress"]}) → NTP: {ntp}')
+                    print(f'  {i}. {d.name} ({d.ip}) → NTP: {ntp}')
+            elif operation == 'apply':
+                ntp = d.ntp_server or self.config.get('ntp.default_server')
+                firmware = d.firmware or kwargs.get('firmware_path')
+                fw_display = os.path.basename(firmware) if firmware else '(unchanged)'
+                print(f'  {i}. {d.name} ({d.ip}) → NTP: {ntp}, Firmware: {fw_display}')
             else:
-                print(f'  {i}. {name} ({d["IPAddress"]})')
+                print(f'  {i}. {d.name} ({d.ip})')
         if len(devices) > 5:
             print(f'  ... and {len(devices) - 5} more')
         print()
@@ -302,92 +1399,162 @@ class IC3000Manager:
         
         start_time = datetime.now()
         all_results = []
+        kwargs['max_workers'] = max_workers
+        if breaker is not None:
+            kwargs['breaker'] = breaker
+        kwargs['site_breaker'] = site_breaker
+        kwargs['groups'] = groups
         
-        if batch_size > 0 and batch_size < len(devices):
-            batches = [devices[i:i+batch_size] for i in range(0, len(devices), batch_size)]
-            
+        if self.history is not None:
+            self.run_id = self.history.start_run(OPERATION_LABELS[operation], len(devices), kwargs.get('csv_file'))
+        
+        run_stamp = start_time.strftime('%Y%m%d_%H%M%S')
+        if kwargs.get('trace', self.config.get('output.trace', False)):
+            self.tracer = SpanTracer()
+        if kwargs.get('record') and self.cassette is None:
+            record_path = kwargs['record']
+            if not isinstance(record_path, str):
+                record_path = os.path.join(self.results_dir, f'ic3000_{operation}_{run_stamp}.cassette.jsonl')
+            self.recorder = CassetteRecorder(record_path)
+        
+        profiler = None
+        if kwargs.get('profile'):
+            profiler = RunProfiler(self.results_dir, f'ic3000_{operation}_{run_stamp}')
+            profiler.start()
+        
+        self.logger.start(total=len(devices))
+        try:
             for batch_num, batch in enumerate(batches, 1):
-                print(f'\n--- BATCH {batch_num}/{len(batches)} ({len(batch)} devices) ---\n')
+                label = 'CANARY' if rollout and batch_num == 1 else ('COHORT' if rollout else 'BATCH')
+                if len(batches) > 1:
+                    self.logger.message(f'\n--- {label} {batch_num}/{len(batches)} ({len(batch)} devices) ---\n')
                 
-                batch_results = self.process_batch(batch, operation, max_workers=max_workers, **kwargs)
+                with self.tracer.span(f'{label.lower()} {batch_num}', cat='batch', devices=len(batch)):
+                    batch_results = self.process_batch(batch, operation, **kwargs)
                 all_results.extend(batch_results)
+                self._after_batch(operation, batch_results, **kwargs)
+                if profiler is not None:
+                    profiler.snapshot(f'batch {batch_num}')
+                
+                if rollout and batch_num == 1 and len(batches) > 1:
+                    canary_failures = sum(1 for r in batch_results if r.status in FAILURE_STATUSES)
+                    if canary_failures > self.config.get('rollout.canary_max_failures', 0):
+                        breaker.trip(f'canary cohort had {canary_failures} failed devices')
+                    elif not breaker.tripped:
+                        self.logger.message('Canary cohort passed, ramping up')
+                
+                if self.interrupted or (breaker is not None and breaker.tripped):
+                    break
                 
                 if batch_num < len(batches):
-                    if self.config.get('safety.prompt_between_batches', True):
-                        input(f'\nBatch {batch_num} complete. Press Enter to continue...')
-                    else:
-                        print(f'\nWaiting {batch_delay} seconds before next batch...')
-                        time.sleep(batch_delay)
-        else:
-            all_results = self.process_batch(devices, operation, max_workers=max_workers, **kwargs)
+                    try:
+                        if rollout:
+                            cohort_delay = self.config.get('rollout.cohort_delay', batch_delay)
+                            self.logger.message(f'\nWaiting {cohort_delay} seconds before next cohort...')
+                            with self.tracer.span('cohort delay', cat='batch'):
+                                time.sleep(cohort_delay)
+                        elif self.config.get('safety.prompt_between_batches', True):
+                            self.logger.flush()
+                            with self.tracer.span('operator prompt', cat='batch'):
+                                input(f'\nBatch {batch_num} complete. Press Enter to continue...')
+                        else:
+                            self.logger.message(f'\nWaiting {batch_delay} seconds before next batch...')
+                            with self.tracer.span('batch delay', cat='batch'):
+                                time.sleep(batch_delay)
+                    except KeyboardInterrupt:
+                        # Between batches nothing is in flight: report and save what already ran
+                        self.interrupted = True
+                        self.logger.message(f'Interrupted: {len(batches) - batch_num} remaining batches left untouched')
+                        break
+        finally:
+            self.logger.close()
+            profile_files = profiler.stop() if profiler is not None else {}
+            trace_file = None
+            if self.tracer.enabled:
+                trace_file = self.tracer.write(os.path.join(self.results_dir, f'ic3000_{operation}_{run_stamp}.trace.json'))
+                self.tracer = NULL_TRACER
+            cassette_file = None
+            if self.recorder is not None:
+                self.recorder.close()
+                cassette_file = f'{self.recorder.path} ({self.recorder.count} exchanges)'
+                self.recorder = None
         
         end_time = datetime.now()
         duration = (end_time - start_time).total_seconds()
         
-        success_count = sum(1 for r in all_results if r['Status'] == 'Success')
-        warning_count = sum(1 for r in all_results if r['Status'] == 'Warning')
-        failed_count = sum(1 for r in all_results if r['Status'] == 'Failed')
-        
-        print('\n' + '='*80)
-        print(f'{op_desc.upper()} COMPLETE')
-        print('='*80)
-        print(f'Total Devices: {len(devices)}')
-        print(f'Success: {success_count}')
-        if warning_count > 0:
-            print(f'Warning: {warning_count}')
-        print(f'Failed: {failed_count}')
-        print(f'Duration: {duration:.1f}s ({duration/60:.1f} minutes)')
-        if len(devices) > 0:
-            print(f'Avg per Device: {duration/len(devices):.1f}s')
-            print(f'Success Rate: {success_count/len(devices)*100:.1f}%')
-        print('='*80)
-        print()
-        
-        # Show detailed results for small sets
-        if len(devices) <= 20:
-            print('DETAILED RESULTS:')
-            print('-' * 80)
-            print(f'{"Device":<25} {"IP":<18} {"Status":<10} {"Target"}')
-            print('-' * 80)
-            for r in all_results:
-                name = r['DeviceName'][:24]
-                ip = r['IPAddress']
-                status = r['Status']
-                target = r.get('Target', '')
-                # Truncate target if too long, but show multiple servers
-                if len(target) > 35:
-                    target_display = target[:32] + '...'
-                else:
-                    target_display = target
-                print(f'{name:<25} {ip:<18} {status:<10} {target_display}')
-            print()
+        if self.interrupted:
+            not_processed = '(interrupted)'
+        elif breaker is not None and breaker.tripped:
+            not_processed = f'(HALTED: {breaker.reason})'
+        else:
+            not_processed = None
+        if full_sweep and not_processed is None and self.history is not None:
+            self.history.record_sweep(self.run_id, OPERATION_LABELS[operation])
+        self.report(operation, op_desc, devices, all_results, duration, not_processed)
         
-        result_file = self.save_results(all_results, operation)
-        if result_file:
-            print(f'✓ Detailed results saved: {result_file}')
+        if cassette_file:
+            print(f'\n✓ Cassette saved: {cassette_file} (secrets redacted; replay with --replay)')
+        if trace_file:
+            print(f'\n✓ Trace saved: {trace_file} (open in https://ui.perfetto.dev or chrome://tracing)')
+        for kind, path in profile_files.items():
+            if path:
+                print(f'✓ Profile ({kind}) saved: {path}')
+        if profiler is not None and profiler.unmerged_threads:
+            print(f'  ({profiler.unmerged_threads} threads still running were left out of the pstats)')
         
-        failures = [r for r in all_results if r['Status'] == 'Failed']
-        if failures and len(failures) <= 10:
-            print('\n' + '='*80)
-            print(f'FAILED DEVICES ({len(failures)}):')
-            print('='*80)
-            for f in failures:
-                print(f'\n{f["DeviceName"]} ({f["IPAddress"]})')
-                print(f'  Error: {f["Message"]}')
+        if self.interrupted:
+            raise KeyboardInterrupt
 
 
 def main():
     parser = argparse.ArgumentParser(description='IC3000 Device Manager')
-    parser.add_argument('operation', choices=['ntp', 'upgrade'], help='Operation to perform')
+    parser.add_argument('operation', choices=['ntp', 'upgrade', 'apply'], help='Operation to perform')
     parser.add_argument('--config', default='ic3000_config.yaml', help='Configuration file')
     parser.add_argument('--csv', dest='csv_file', help='Device CSV file')
     parser.add_argument('--firmware', help='Firmware file path')
+    parser.add_argument('--catalog', dest='catalog_dir',
+                        help='upgrade: firmware catalog directory, image chosen per device from its running version')
+    parser.add_argument('--target-version', help='--catalog: version to upgrade to (default: highest in catalog)')
+    phase = parser.add_mutually_exclusive_group()
+    phase.add_argument('--stage', action='store_true', help='upgrade: only upload firmware to every device (no install)')
+    phase.add_argument('--install-staged', action='store_true', help='upgrade: install firmware on devices staged earlier')
     parser.add_argument('--batch-size', type=int, help='Process devices in batches')
     parser.add_argument('--batch-delay', type=int, help='Seconds between batches')
     parser.add_argument('--workers', type=int, dest='max_workers', help='Max parallel workers')
     parser.add_argument('--test', action='store_true', dest='test_mode', help='Test mode (3 devices)')
     parser.add_argument('--limit', type=int, help='Limit to N devices')
     parser.add_argument('--yes', action='store_true', help='Skip confirmation')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='upgrade: per-stage limits (reachability, login, upload, install, verify); --workers sets upload')
+    parser.add_argument('--canary', action='store_true', dest='rollout',
+                        help='Automated rollout: canary across sites, ramp-up, halt on failure threshold (no prompts)')
+    parser.add_argument('--max-unavailable', type=int, metavar='N',
+                        help='Max devices per Group column value upgrading/rebooting at once (default: 1)')
+    parser.add_argument('--site-breaker', action='store_true',
+                        help='Hold devices of a site after repeated connection failures, probe it again later')
+    parser.add_argument('--until', metavar='HH:MM', help='Stop dispatching new devices at this local time')
+    parser.add_argument('--retry-failed', action='store_true', help="Only devices that did not succeed in the last run (from history)")
+    parser.add_argument('--failing', type=int, metavar='N', help='Only devices that failed N or more runs in a row (from history)')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='Only devices whose desired state changed since their last success (from history)')
+    parser.add_argument('--full-sweep', action='store_true', help='--changed-only: process every device this time')
+    parser.add_argument('-v', '--verbose', action='count', help='Per-device output: -v results, -vv step detail')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Progress line only, no per-device lines')
+    parser.add_argument('--json-log', help='Append every run event as JSON Lines to this file')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Predict the run duration from past runs and simulate worker counts (nothing is sent to devices)')
+    parser.add_argument('--window-minutes', type=int, dest='target_minutes',
+                        help='--estimate: recommend the fewest workers that finish within this many minutes')
+    parser.add_argument('--trace', action='store_true',
+                        help='Write a Chrome/Perfetto trace of every device and phase to the results directory')
+    parser.add_argument('--record', nargs='?', const=True, metavar='FILE',
+                        help='Record every device exchange with timings (secrets redacted) to a cassette '
+                             '(default: results directory)')
+    parser.add_argument('--replay', metavar='FILE', help='Run offline against a recorded cassette instead of the devices')
+    parser.add_argument('--replay-speed', type=float, metavar='X',
+                        help='--replay: divide recorded latencies by X (default 1, 0 = no delays)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write CPU (pstats + collapsed stacks) and tracemalloc profiles to the results directory')
     
     args = parser.parse_args()
     
@@ -397,13 +1564,43 @@ def main():
         config.config['safety']['require_confirmation'] = False
         config.config['safety']['prompt_between_batches'] = False
     
+    output = config.config.setdefault('output', {})
+    if args.verbose:
+        output['verbose'] = args.verbose
+    if args.quiet:
+        output['verbose'] = 0
+    if args.json_log:
+        output['json_log'] = args.json_log
+    
     manager = IC3000Manager(config)
     
     kwargs = {
         'test_mode': args.test_mode,
         'csv_file': args.csv_file,
         'limit': args.limit,
+        'retry_failed': args.retry_failed,
+        'failing': args.failing,
+        'changed_only': args.changed_only,
+        'full_sweep': args.full_sweep,
+        'rollout': args.rollout,
+        'profile': args.profile,
+        'estimate': args.estimate,
+        'target_minutes': args.target_minutes,
     }
+    if args.trace:
+        kwargs['trace'] = True
+    if args.pipeline:
+        kwargs['pipeline'] = True
+    if args.site_breaker:
+        kwargs['site_breaker'] = True
+    if args.max_unavailable:
+        kwargs['max_unavailable'] = args.max_unavailable
+    if args.record:
+        kwargs['record'] = args.record
+    if args.replay:
+        kwargs['replay'] = args.replay
+    if args.replay_speed is not None:
+        kwargs['replay_speed'] = args.replay_speed
     
     if args.batch_size:
         kwargs['batch_size'] = args.batch_size
@@ -413,9 +1610,26 @@ def main():
         kwargs['max_workers'] = args.max_workers
     if args.firmware:
         kwargs['firmware_path'] = args.firmware
+    if args.catalog_dir:
+        kwargs['catalog_dir'] = args.catalog_dir
+    if args.target_version:
+        kwargs['target_version'] = args.target_version
+    if args.until:
+        try:
+            kwargs['until'] = parse_until(args.until)
+        except ValueError:
+            parser.error(f'--until expects HH:MM, got {args.until}')
+    
+    operation = args.operation
+    if args.stage or args.install_staged:
+        if operation != 'upgrade':
+            parser.error('--stage and --install-staged only apply to the upgrade operation')
+        operation = 'stage' if args.stage else 'install'
+    if args.catalog_dir and operation != 'upgrade':
+        parser.error('--catalog only applies to the upgrade operation (without --stage/--install-staged)')
     
     try:
-        manager.run(args.operation, **kwargs)
+        manager.run(operation, **kwargs)
     except KeyboardInterrupt:
         print('\nInterrupted by user')
         sys.exit(1)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+IC3000 Cassettes - record real device exchanges, replay them offline
+
+Recording (ic3000_auto.py --record) mounts a RecordingAdapter on every API
+client: each HTTP exchange and each reachability probe is appended to a JSON
+Lines cassette with its wall time, status, headers and body, or the exception
+it raised (timeouts, refused connections). Secrets are redacted before
+anything is written:
+
+  - Authorization, Cookie, Set-Cookie and X-IDA-AUTH-TOKEN headers
+  - password/token fields in form and JSON bodies (token UUIDs become the
+    zero UUID, so token parsing still sees the recorded shape)
+  - every redacted value wherever else it appears in that device's exchanges
+  - the device password, wherever it appears
+
+Firmware uploads are stored as their length only.
+
+Replay (ic3000_auto.py --replay FILE) mounts a ReplayAdapter instead: requests
+never leave the process and are answered from the cassette, in recorded order
+per (method, port, path), after the recorded latency divided by the replay
+speed (0 = no delay). A recorded exchange slower than the request's timeout
+raises ReadTimeout, as the device would. Inventory IPs not in the cassette are
+mapped onto recorded devices, so a handful of recorded devices can drive a
+benchmark of the whole fleet.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import socket
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, Optional
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from ic3000_estimate import percentile
+
+
+SECRET_HEADERS = {'authorization', 'cookie', 'set-cookie', 'x-ida-auth-token', 'proxy-authorization'}
+SECRET_FIELDS = re.compile(r'pass|secret|token|auth', re.IGNORECASE)
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+ZERO_UUID = '00000000-0000-0000-0000-000000000000'
+REDACTED = '***'
+MAX_BODY = 256 * 1024  # larger bodies (firmware images) are stored as their length only
+
+
+def _placeholder(value: str) -> str:
+    return ZERO_UUID if UUID_RE.match(value.strip()) else REDACTED
+
+
+def _redact_json(value, secrets: set, secret: bool = False):
+    """Redact strings under secret keys (recursively), collecting the originals in `secrets`"""
+    if isinstance(value, dict):
+        return {k: _redact_json(v, secrets, secret or bool(SECRET_FIELDS.search(str(k)))) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact_json(v, secrets, secret) for v in value]
+    if secret and isinstance(value, str) and value:
+        secrets.add(value)
+        return _placeholder(value)
+    return value
+
+
+def _scrub(text: str, secrets: set) -> str:
+    for secret in sorted(secrets, key=len, reverse=True):
+        if len(secret) >= 4:
+            text = text.replace(secret, _placeholder(secret))
+    return text
+
+
+def redact_body(body, content_type: str, secrets: set):
+    """Body as stored in the cassette: redacted text, or {"length": n} for binary/large bodies"""
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        if len(body) > MAX_BODY:
+            return {'length': len(body)}
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'length': len(body)}
+    elif not isinstance(body, str):
+        return {'length': None}  # streamed (file object)
+    if len(body) > MAX_BODY:
+        return {'length': len(body)}
+
+    stripped = body.strip()
+    if stripped[:1] in ('{', '[', '"'):
+        try:
+            body = json.dumps(_redact_json(json.loads(stripped), secrets))
+        except ValueError:
+            pass
+    elif 'x-www-form-urlencoded' in (content_type or '') and '=' in body:
+        fields = []
+        for key, value in parse_qsl(body, keep_blank_values=True):
+            if SECRET_FIELDS.search(key) and value:
+                secrets.add(value)
+                value = _placeholder(value)
+            fields.append((key, value))
+        body = urlencode(fields)
+    return _scrub(body, secrets)
+
+
+def redact_headers(headers, secrets: set) -> Dict[str, str]:
+    redacted = {}
+    for key, value in (headers or {}).items():
+        if key.lower() in SECRET_HEADERS:
+            redacted[key] = REDACTED
+        else:
+            redacted[key] = _scrub(str(value), secrets)
+    return redacted
+
+
+def exchange_key(method: str, url: str):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return method.upper(), parts.port, path
+
+
+class CassetteRecorder:
+    """Append-only JSON Lines cassette shared by every RecordingAdapter of a run"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self.count = 0
+
+    def write(self, entry: Dict):
+        entry['offset'] = round(time.monotonic() - self._t0 - entry['elapsed'], 4)
+        line = json.dumps(entry, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    """Real HTTPS transport that appends every exchange of one device to a CassetteRecorder"""
+
+    def __init__(self, recorder: CassetteRecorder, host: str, secrets=(), **kwargs):
+        super().__init__(**kwargs)
+        self.recorder = recorder
+        self.host = host
+        self.secrets = {s for s in secrets if s}  # grows with every redacted value seen
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        entry = {'host': self.host, 'method': request.method, 'url': request.url}
+        try:
+            response = super().send(request, **kwargs)
+        except Exception as e:
+            entry['error'] = {'type': type(e).__name__, 'message': _scrub(str(e), self.secrets)[:300]}
+            raise
+        else:
+            entry['status'] = response.status_code
+            entry['reason'] = response.reason
+            entry['response_headers'] = redact_headers(response.headers, self.secrets)
+            entry['response_body'] = redact_body(response.content, response.headers.get('Content-Type'), self.secrets)
+            return response
+        finally:
+            entry['elapsed'] = round(time.monotonic() - start, 4)
+            # Request side last: secrets learned from the response (the token) are scrubbed too
+            entry['request_headers'] = redact_headers(request.headers, self.secrets)
+            entry['request_body'] = redact_body(request.body, request.headers.get('Content-Type'), self.secrets)
+            self.recorder.write(entry)
+
+    def probe(self, host: str, port: int, timeout: float):
+        """TCP connect (IC3000APIClient.check_reachable), recorded as a CONNECT exchange"""
+        start = time.monotonic()
+        entry = {'host': self.host, 'method': 'CONNECT', 'url': f'tcp://{host}:{port}/'}
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                entry['status'] = 0
+        except OSError as e:
+            entry['error'] = {'type': type(e).__name__, 'message': str(e)[:300]}
+            raise
+        finally:
+            entry['elapsed'] = round(time.monotonic() - start, 4)
+            self.recorder.write(entry)
+
+
+class Cassette:
+    """Recorded exchanges grouped per device and (method, port, path), in recorded order"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.exchanges = defaultdict(lambda: defaultdict(list))  # host -> key -> [entry]
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                self.exchanges[entry['host']][exchange_key(entry['method'], entry['url'])].append(entry)
+        self.hosts = sorted(self.exchanges)
+
+    def __len__(self):
+        return sum(len(entries) for keys in self.exchanges.values() for entries in keys.values())
+
+    def host_for(self, ip: str) -> Optional[str]:
+        """Recorded device to replay for an inventory IP (itself, else a stable pick)"""
+        if ip in self.exchanges:
+            return ip
+        if not self.hosts:
+            return None
+        return self.hosts[zlib.crc32(ip.encode()) % len(self.hosts)]
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """Offline transport for one client: answers from a Cassette at recorded latency / speed"""
+
+    def __init__(self, cassette: Cassette, ip: str, speed: float = 1.0):
+        super().__init__()
+        self.cassette = cassette
+        self.host = cassette.host_for(ip)
+        self.speed = speed
+        self.cursors = defaultdict(int)  # key -> next index; the last exchange repeats once exhausted
+        self._closed = threading.Event()
+
+    def _next(self, method: str, url: str) -> Optional[Dict]:
+        key = exchange_key(method, url)
+        entries = self.cassette.exchanges.get(self.host, {}).get(key)
+        if not entries:
+            return None
+        entry = entries[min(self.cursors[key], len(entries) - 1)]
+        self.cursors[key] += 1
+        return entry
+
+    def _wait(self, seconds: float):
+        if self.speed and seconds > 0:
+            if self._closed.wait(seconds / self.speed):
+                raise requests.exceptions.ConnectionError('Request cancelled (device deadline exceeded or run interrupted)')
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        entry = self._next(request.method, request.url)
+        if entry is None:
+            raise requests.exceptions.ConnectionError(
+                f'No recorded exchange for {request.method} {urlsplit(request.url).path} ({self.host or "empty cassette"})')
+
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and entry['elapsed'] > read_timeout:
+            self._wait(read_timeout)
+            raise requests.exceptions.ReadTimeout(f'Read timed out. (read timeout={read_timeout}) [replay]')
+        self._wait(entry['elapsed'])
+
+        error = entry.get('error')
+        if error:
+            exc_class = getattr(requests.exceptions, error['type'], requests.exceptions.ConnectionError)
+            raise exc_class(error['message'])
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry.get('reason')
+        response.headers = CaseInsensitiveDict(entry.get('response_headers') or {})
+        body = entry.get('response_body')
+        response._content = body.encode('utf-8') if isinstance(body, str) else b''
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=entry['elapsed'])
+        return response
+
+    def probe(self, host: str, port: int, timeout: float):
+        entry = self._next('CONNECT', f'tcp://{host}:{port}/')
+        if entry is None:
+            return  # recorded without reachability checks: treat as reachable
+        elapsed = min(entry['elapsed'], timeout) if timeout else entry['elapsed']
+        self._wait(elapsed)
+        error = entry.get('error')
+        if error:
+            if error['type'] in ('timeout', 'TimeoutError'):
+                raise socket.timeout(error['message'])
+            raise OSError(error['message'])
+
+    def close(self):
+        self._closed.set()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Summarize an IC3000 cassette (latency per endpoint)')
+    parser.add_argument('cassette', help='Cassette file written by ic3000_auto.py --record')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cassette):
+        print(f'✗ Cassette not found: {args.cassette}')
+        sys.exit(1)
+
+    cassette = Cassette(args.cassette)
+    by_endpoint = defaultdict(list)
+    errors = defaultdict(int)
+    for keys in cassette.exchanges.values():
+        for (method, port, path), entries in keys.items():
+            endpoint = f'{method} :{port or ""}{path.split("?")[0]}'
+            for entry in entries:
+                by_endpoint[endpoint].append(entry['elapsed'])
+                if entry.get('error'):
+                    errors[endpoint] += 1
+
+    print(f'{args.cassette}: {len(cassette)} exchanges, {len(cassette.hosts)} devices\n')
+    print(f'{"Endpoint":<50} {"Count":>6} {"p50":>8} {"p90":>8} {"max":>8} {"Errors":>6}')
+    print('-' * 90)
+    for endpoint, values in sorted(by_endpoint.items()):
+        values.sort()
+        print(f'{endpoint[:50]:<50} {len(values):>6} {percentile(values, 0.5):>7.2f}s '
+              f'{percentile(values, 0.9):>7.2f}s {values[-1]:>7.2f}s {errors[endpoint]:>6}')
+
+
+if __name__ == '__main__':
+    main()
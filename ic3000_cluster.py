@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+"""
+IC3000 Cluster - spread one run over worker hosts in several regions
+
+A coordinator splits the inventory into work units and leases them over a
+small JSON-over-HTTP API to worker processes on jump hosts close to the
+devices, so each region uploads firmware over its local network:
+
+  coordinator                          worker (one per jump host)
+  -----------                          ------
+  units of unit_size devices,          POST /lease      -> unit or nothing
+  grouped by the Region column         POST /heartbeat  (every lease_timeout/3)
+                                       runs IC3000Manager.process_batch
+  merged report, history, CSV   <-     POST /complete   with the unit's results
+
+Units carry IP addresses only: every worker resolves them against its own copy
+of the inventory CSV, so credentials never cross the network. A worker leases
+units of its own --region first, then units without a region, and units of
+another region only while no worker of that region is alive. A unit whose
+lease is not renewed (worker died or lost its link) is leased again; after
+cluster.max_attempts expiries its devices are reported as Failed.
+
+Members of an availability group (availability.group_by column) always share
+a unit, so the worker running it can apply --max-unavailable to the whole
+group. --pipeline and --max-unavailable are forwarded to the workers with each
+unit; a cluster upgrade installs the one image named by --firmware (no catalog).
+
+Re-leasing can run a device twice when a worker stalls but is not dead, so
+keep lease_timeout well above a heartbeat interval.
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import queue
+import socket
+import threading
+import ipaddress
+import itertools
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from ic3000_records import DeviceResult, FAILED, OPERATION_LABELS
+
+
+class WorkUnit:
+    """A lease-able slice of the inventory"""
+
+    def __init__(self, unit_id: int, ips: List[str], region: Optional[str]):
+        self.unit_id = unit_id
+        self.ips = ips
+        self.region = region
+        self.state = 'pending'  # pending -> leased -> done
+        self.worker = None
+        self.deadline = 0.0
+        self.attempts = 0
+
+
+class Coordinator:
+    """Unit bookkeeping behind the HTTP handler; completed result lists are put on self.completed"""
+
+    def __init__(self, devices, operation: str, options: Optional[Dict] = None, unit_size: int = 10,
+                 lease_timeout: float = 120, max_attempts: int = 3, group_by: Optional[str] = None):
+        self.operation = operation
+        self.options = options or {}
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.devices = {d.ip: d for d in devices}
+        self.completed = queue.Queue()  # lists of DeviceResult, consumed by the coordinator's main thread
+        self.workers = {}  # worker id -> {'region', 'last_seen', 'units'}
+        self._lock = threading.Lock()
+
+        # Region -> availability group (or the lone device) -> IPs; a group is never split across units
+        regions = OrderedDict()
+        for device in devices:
+            group = device.get(group_by) if group_by else None
+            key = ('group', group) if group else ('device', device.ip)
+            regions.setdefault(device.get('Region'), OrderedDict()).setdefault(key, []).append(device.ip)
+        unit_ids = itertools.count(1)
+        self.units = OrderedDict()
+        for region, members in regions.items():
+            ips = []
+            for group_ips in members.values():
+                if ips and len(ips) + len(group_ips) > max(1, unit_size):
+                    self._add_unit(next(unit_ids), ips, region)
+                    ips = []
+                ips.extend(group_ips)
+            if ips:
+                self._add_unit(next(unit_ids), ips, region)
+
+    def _add_unit(self, unit_id, ips, region):
+        self.units[unit_id] = WorkUnit(unit_id, ips, region)
+
+    @property
+    def done(self) -> bool:
+        with self._lock:
+            return all(unit.state == 'done' for unit in self.units.values())
+
+    def expire(self):
+        """Re-queue expired units even while no worker asks for a lease (all workers gone)"""
+        with self._lock:
+            self._expire(time.monotonic())
+
+    def _expire(self, now):
+        """Re-queue units whose lease ran out (lock held)"""
+        for unit in self.units.values():
+            if unit.state != 'leased' or unit.deadline > now:
+                continue
+            if unit.attempts >= self.max_attempts:
+                unit.state = 'done'
+                self.completed.put([
+                    self._failure(ip, f'Work unit abandoned after {unit.attempts} expired leases')
+                    for ip in unit.ips
+                ])
+            else:
+                unit.state = 'pending'
+                unit.worker = None
+
+    def _failure(self, ip, message):
+        result = DeviceResult(self.devices[ip], OPERATION_LABELS[self.operation], status=FAILED, message=message)
+        result.phases = {}
+        return result
+
+    def _region_alive(self, region, now):
+        return any(w['region'] == region and now - w['last_seen'] < self.lease_timeout
+                   for w in self.workers.values())
+
+    def lease(self, worker: str, region: Optional[str]) -> Optional[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self.workers.setdefault(worker, {'region': region, 'units': 0})
+            entry['last_seen'] = now
+            self._expire(now)
+
+            pending = [u for u in self.units.values() if u.state == 'pending']
+            choice = (next((u for u in pending if region and u.region == region), None) or
+                      next((u for u in pending if u.region is None), None) or
+                      next((u for u in pending if not self._region_alive(u.region, now)), None))
+            if choice is None:
+                return None
+            choice.state = 'leased'
+            choice.worker = worker
+            choice.deadline = now + self.lease_timeout
+            choice.attempts += 1
+            entry['units'] += 1
+            return {
+                'unit_id': choice.unit_id,
+                'ips': choice.ips,
+                'operation': self.operation,
+                'options': self.options,
+                'lease_timeout': self.lease_timeout,
+            }
+
+    def heartbeat(self, worker: str, unit_id: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if worker in self.workers:
+                self.workers[worker]['last_seen'] = now
+            unit = self.units.get(unit_id)
+            if unit is None or unit.state != 'leased' or unit.worker != worker:
+                return False
+            unit.deadline = now + self.lease_timeout
+            return True
+
+    def complete(self, worker: str, unit_id: int, rows: List[Dict]) -> bool:
+        """Accept a unit's results unless another worker already completed it"""
+        with self._lock:
+            unit = self.units.get(unit_id)
+            if unit is None or unit.state == 'done':
+                return False
+            unit.state = 'done'
+            if worker in self.workers:
+                self.workers[worker]['last_seen'] = time.monotonic()
+            ips = set(unit.ips)
+            results = [DeviceResult.from_dict(row) for row in rows if row.get('IPAddress') in ips]
+            reported = {r.ip for r in results}
+            results.extend(self._failure(ip, 'No result reported by worker') for ip in unit.ips if ip not in reported)
+        self.completed.put(results)
+        return True
+
+    def status(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            states = {}
+            for unit in self.units.values():
+                states[unit.state] = states.get(unit.state, 0) + 1
+            return {
+                'operation': self.operation,
+                'units': states,
+                'workers': {w: {'region': e['region'], 'units': e['units'],
+                                'idle_seconds': round(now - e['last_seen'], 1)}
+                            for w, e in self.workers.items()},
+            }
+
+
+class ClusterHandler(BaseHTTPRequestHandler):
+    """JSON API handler; the Coordinator lives on self.server.coordinator"""
+
+    def log_message(self, format, *args):
+        pass  # the coordinator's RunLogger reports progress
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        token = self.server.token
+        if token and not hmac.compare_digest(self.headers.get('X-IC3000-Token', '').encode(), token.encode()):
+            self._send(403, {'error': 'Invalid cluster token'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == '/status':
+            self._send(200, self.server.coordinator.status())
+        else:
+            self._send(404, {'error': f'Unknown path: {self.path}'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        coordinator = self.server.coordinator
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            worker = body['worker']
+        except (ValueError, KeyError):
+            self._send(400, {'error': 'Expected a JSON body with "worker"'})
+            return
+
+        if self.path == '/lease':
+            unit = coordinator.lease(worker, body.get('region'))
+            self._send(200, {'unit': unit, 'done': unit is None and coordinator.done})
+        elif self.path == '/heartbeat':
+            ok = coordinator.heartbeat(worker, body.get('unit_id'))
+            self._send(200 if ok else 409, {'ok': ok})
+        elif self.path == '/complete':
+            accepted = coordinator.complete(worker, body.get('unit_id'), body.get('results') or [])
+            self._send(200, {'accepted': accepted})
+        else:
+            self._send(404, {'error': f'Unknown path: {self.path}'})
+
+
+class ClusterServerV6(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+def parse_listen(listen: str, default_port: int = 8770):
+    """(host, port) from --listen: host:port, [ipv6]:port, or a bare host"""
+    parts = urlsplit('//' + listen)
+    return parts.hostname or '0.0.0.0', parts.port or default_port
+
+
+def is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def coordinate(manager, operation: str, devices, host: str = '0.0.0.0', port: int = 8770,
+               options: Optional[Dict] = None, token: Optional[str] = None):
+    """Serve work units until every unit is done, then print the merged report"""
+    config = manager.config
+    coordinator = Coordinator(
+        devices, operation, options,
+        unit_size=config.get('cluster.unit_size', 10),
+        lease_timeout=config.get('cluster.lease_timeout', 120),
+        max_attempts=config.get('cluster.max_attempts', 3),
+        group_by=config.get('availability.group_by', 'Group') if operation in ('upgrade', 'install', 'apply') else None
+    )
+    server_class = ClusterServerV6 if ':' in host else ThreadingHTTPServer
+    server = server_class((host, port), ClusterHandler)
+    server.daemon_threads = True
+    server.coordinator = coordinator
+    server.token = token
+
+    label = OPERATION_LABELS[operation]
+    print('='*80)
+    print(f'IC3000 CLUSTER COORDINATOR: {label.upper()}')
+    print('='*80)
+    print(f'Total Devices: {len(devices)}')
+    print(f'Work Units: {len(coordinator.units)} of up to {config.get("cluster.unit_size", 10)} devices')
+    regions = sorted({u.region for u in coordinator.units.values() if u.region})
+    if regions:
+        print(f'Regions: {", ".join(regions)}')
+    address = f'[{host}]' if ':' in host else host
+    print(f'Listening: http://{address}:{port} (lease timeout {coordinator.lease_timeout}s)')
+    print('='*80)
+    print()
+
+    if manager.history is not None:
+        manager.run_id = manager.history.start_run(label, len(devices), options.get('csv_file') if options else None)
+
+    threading.Thread(target=server.serve_forever, name='ic3000-cluster', daemon=True).start()
+    start = time.monotonic()
+    all_results = []
+    manager.logger.start(total=len(devices))
+    try:
+        while True:
+            try:
+                results = coordinator.completed.get(timeout=1.0)
+            except queue.Empty:
+                # Leases also expire here, so units of dead workers are abandoned with no worker left to lease
+                coordinator.expire()
+                if coordinator.done and coordinator.completed.empty():
+                    break
+                continue
+            for result in results:
+                manager.logger.result(result)
+            all_results.extend(results)
+            # History and the staging record are written from this thread only
+            manager._after_batch(operation, results, firmware_path=(options or {}).get('firmware'))
+    except KeyboardInterrupt:
+        manager.interrupted = True
+        manager.logger.message('Interrupted: leased units are abandoned, workers stop at their next lease')
+    finally:
+        manager.logger.close()
+
+    # Keep answering "done" for a moment so polling workers exit cleanly
+    time.sleep(config.get('cluster.linger', 10) if not manager.interrupted else 0)
+    server.shutdown()
+    server.server_close()
+
+    manager.report(operation, f'Cluster {label}', devices, all_results, time.monotonic() - start,
+                   '(interrupted)' if manager.interrupted else None)
+    if manager.interrupted:
+        raise KeyboardInterrupt
+
+
+class ClusterWorker:
+    """Leases units from a coordinator and runs them with a local IC3000Manager"""
+
+    def __init__(self, manager, url: str, csv_file: Optional[str] = None, region: Optional[str] = None,
+                 firmware_path: Optional[str] = None, max_workers: Optional[int] = None,
+                 token: Optional[str] = None, poll_interval: float = 5, max_retries: int = 12):
+        self.manager = manager
+        self.url = url.rstrip('/')
+        self.csv_file = csv_file
+        self.region = region
+        self.firmware_path = firmware_path
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
+        self.session = requests.Session()
+        if token:
+            self.session.headers['X-IC3000-Token'] = token
+
+    def _post(self, path, payload, retries=None):
+        """POST to the coordinator, retrying connection errors; None once retries are exhausted"""
+        payload = dict(payload, worker=self.worker_id)
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                response = self.session.post(f'{self.url}{path}', json=payload, timeout=30)
+                if response.status_code == 403:
+                    raise SystemExit('✗ Coordinator rejected the cluster token')
+                return response
+            except requests.exceptions.RequestException:
+                if attempt == retries:
+                    return None
+                time.sleep(self.poll_interval)
+
+    def run(self):
+        inventory = {d.ip: d for d in self.manager.load_devices(self.csv_file)}
+        print(f'Worker {self.worker_id} ({self.region or "no region"}): {len(inventory)} devices in local inventory')
+        print(f'Coordinator: {self.url}')
+        units = 0
+        while True:
+            response = self._post('/lease', {'region': self.region})
+            if response is None:
+                print('✗ Coordinator unreachable, stopping')
+                break
+            body = response.json()
+            if body.get('unit') is None:
+                if body.get('done'):
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            self._run_unit(body['unit'], inventory)
+            units += 1
+        print(f'Worker {self.worker_id} finished: {units} units processed')
+
+    def _firmware_for(self, name):
+        """Local path of the image the coordinator names (same file name, local directory)"""
+        if not name:
+            return None
+        candidates = [self.firmware_path, self.manager.config.get('software.firmware_path')]
+        for path in candidates:
+            if path and os.path.basename(path) == name:
+                return path
+        for path in candidates:
+            if path and os.path.exists(os.path.join(os.path.dirname(path), name)):
+                return os.path.join(os.path.dirname(path), name)
+        return None
+
+    def _batch_options(self, operation, devices, options):
+        """process_batch keyword arguments for a unit: workers, forwarded --pipeline and --max-unavailable"""
+        manager = self.manager
+        kwargs = {'max_workers': self.max_workers or manager.config.get(f'parallel.max_workers_{operation}', 5)}
+        if operation == 'upgrade' and options.get('pipeline'):
+            kwargs['pipeline'] = True
+            kwargs['stage_limits'] = manager.pipeline_limits(self.max_workers)
+            kwargs['max_workers'] = manager.pipeline_in_flight(kwargs['stage_limits'])
+        groups = manager.availability_groups(operation, devices, options.get('max_unavailable'))
+        if groups is not None:
+            kwargs['groups'] = groups
+            if not self.max_workers and not kwargs.get('pipeline'):
+                kwargs['max_workers'] = manager.group_workers(groups, devices)
+        return kwargs
+
+    def _run_unit(self, unit, inventory):
+        operation = unit['operation']
+        options = unit.get('options') or {}
+        label = OPERATION_LABELS[operation]
+        devices = [inventory[ip] for ip in unit['ips'] if ip in inventory]
+        missing = [ip for ip in unit['ips'] if ip not in inventory]
+        results = []
+        for ip in missing:
+            results.append({'IPAddress': ip, 'DeviceName': ip, 'Operation': label, 'Status': FAILED,
+                            'Message': f'Not in the inventory of worker {self.worker_id}'})
+
+        firmware_path = self._firmware_for(options.get('firmware'))
+        if options.get('firmware') and operation != 'install' and (not firmware_path or not os.path.exists(firmware_path)):
+            for device in devices:
+                results.append({'IPAddress': device.ip, 'DeviceName': device.name, 'Operation': label, 'Status': FAILED,
+                                'Message': f'Firmware {options["firmware"]} not found on worker {self.worker_id}'})
+            devices = []
+        if operation == 'install':
+            firmware_path = options.get('firmware')
+
+        lost = threading.Event()
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(unit['lease_timeout'] / 3):
+                response = self._post('/heartbeat', {'unit_id': unit['unit_id']}, retries=1)
+                if response is not None and response.status_code == 409:
+                    lost.set()
+
+        print(f'Unit {unit["unit_id"]}: {len(unit["ips"])} devices')
+        beat = threading.Thread(target=heartbeat, name='ic3000-heartbeat', daemon=True)
+        beat.start()
+        logger = self.manager.logger
+        logger.start(total=len(devices))
+        try:
+            if devices:
+                batch = self.manager.process_batch(devices, operation, firmware_path=firmware_path,
+                                                   **self._batch_options(operation, devices, options))
+                results.extend(r.to_dict() for r in batch)
+        finally:
+            logger.close()
+            stop.set()
+
+        if lost.is_set():
+            print(f'Unit {unit["unit_id"]}: lease was lost, coordinator may have re-leased it')
+        response = self._post('/complete', {'unit_id': unit['unit_id'], 'results': results})
+        if response is None:
+            print(f'✗ Unit {unit["unit_id"]}: could not report results to the coordinator')
+        elif not response.json().get('accepted'):
+            print(f'Unit {unit["unit_id"]}: results not accepted (unit already completed elsewhere)')
+        if self.manager.interrupted:
+            raise KeyboardInterrupt
+
+
+def main():
+    import argparse
+    from ic3000_auto import IC3000Config, IC3000Manager
+
+    parser = argparse.ArgumentParser(
+        description='IC3000 Cluster - run one operation from worker hosts in several regions',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Coordinator: split the inventory into units, merge the results into one report
+  python3 ic3000_cluster.py coordinate upgrade --csv ic3000_devices.csv --firmware IC3000-new.SPA
+
+  # Worker on each jump host, with a local copy of the inventory and firmware
+  python3 ic3000_cluster.py work --coordinator http://coord.example:8770 \\
+      --csv ic3000_devices.csv --firmware /srv/fw/IC3000-new.SPA --region EU
+        """
+    )
+    parser.add_argument('--config', default='ic3000_config.yaml', help='Configuration file (cluster.*)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_coord = sub.add_parser('coordinate', help='Lease work units to workers and merge their results')
+    p_coord.add_argument('operation', choices=['ntp', 'upgrade', 'apply'])
+    p_coord.add_argument('--csv', dest='csv_file', help='Device CSV file (Region column groups units)')
+    p_coord.add_argument('--firmware', help='Firmware file name (workers use their local copy)')
+    phase = p_coord.add_mutually_exclusive_group()
+    phase.add_argument('--stage', action='store_true', help='upgrade: only upload firmware (no install)')
+    phase.add_argument('--install-staged', action='store_true', help='upgrade: install on devices staged earlier')
+    p_coord.add_argument('--pipeline', action='store_true', help='upgrade: workers run per-stage limits (see ic3000_auto.py)')
+    p_coord.add_argument('--max-unavailable', type=int, metavar='N',
+                         help='Max devices per Group column value upgrading/rebooting at once on the workers')
+    p_coord.add_argument('--listen', default='0.0.0.0:8770',
+                         help='Bind address, [addr]:port for IPv6 (default: 0.0.0.0:8770, requires a cluster token)')
+    p_coord.add_argument('--limit', type=int, help='Limit to N devices')
+
+    p_work = sub.add_parser('work', help='Run units leased from a coordinator')
+    p_work.add_argument('--coordinator', required=True, help='Coordinator URL, e.g. http://host:8770')
+    p_work.add_argument('--csv', dest='csv_file', help='Local inventory CSV (credentials)')
+    p_work.add_argument('--firmware', help='Local firmware file')
+    p_work.add_argument('--region', help='Prefer units of this Region')
+    p_work.add_argument('--workers', type=int, dest='max_workers', help='Max parallel devices per unit')
+
+    args = parser.parse_args()
+    config = IC3000Config(args.config)
+    token = os.environ.get('IC3000_CLUSTER_TOKEN') or config.get('cluster.token')
+    manager = IC3000Manager(config)
+
+    try:
+        if args.command == 'coordinate':
+            operation = args.operation
+            if args.stage or args.install_staged:
+                if operation != 'upgrade':
+                    parser.error('--stage and --install-staged only apply to the upgrade operation')
+                operation = 'stage' if args.stage else 'install'
+            firmware = args.firmware or config.get('software.firmware_path')
+            if operation != 'ntp' and operation != 'apply' and not firmware:
+                parser.error('--firmware (or software.firmware_path) is required')
+
+            devices = manager.load_devices(args.csv_file, limit=args.limit)
+            if operation == 'install':
+                staged = manager.load_staged().get(os.path.basename(firmware), {})
+                devices = [d for d in devices if d.ip in staged]
+            if not devices:
+                print('No devices to process')
+                sys.exit(1)
+
+            options = {'csv_file': args.csv_file}
+            if firmware:
+                options['firmware'] = os.path.basename(firmware)
+            if operation == 'upgrade' and (args.pipeline or config.get('pipeline.enabled', False)):
+                options['pipeline'] = True
+            elif args.pipeline:
+                parser.error('--pipeline only applies to the upgrade operation')
+            if args.max_unavailable is not None:
+                options['max_unavailable'] = args.max_unavailable
+            try:
+                host, port = parse_listen(args.listen)
+            except ValueError as e:
+                parser.error(f'--listen {args.listen}: {e}')
+            if not token and not is_loopback(host):
+                # Completed units flow into history and the staging record, so anonymous workers are not accepted
+                parser.error(f'--listen {args.listen} is reachable from other hosts: set cluster.token '
+                             f'(or IC3000_CLUSTER_TOKEN), or listen on 127.0.0.1')
+            coordinate(manager, operation, devices, host, port, options, token)
+        else:
+            worker = ClusterWorker(manager, args.coordinator, args.csv_file, args.region, args.firmware,
+                                   args.max_workers, token, poll_interval=config.get('cluster.poll_interval', 5))
+            worker.run()
+    except KeyboardInterrupt:
+        print('\nInterrupted by user')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+IC3000 Agent - long-running daemon that keeps device sessions warm
+
+Holds an LRU pool of authenticated IC3000UpgradeClient instances so repeat
+queries against the same device skip interpreter start-up and the four-step
+login(). Operations are exposed as a small JSON API over HTTP on localhost or
+over a Unix socket, for NMS integrations that would otherwise shell out to
+ic3000_api_client.py for every query.
+
+API (JSON request and response bodies):
+  GET  /status                      pool and job statistics
+  POST /ntp/get       {"ip": ...}   current NTP configuration
+  POST /ntp/set       {"ip": ..., "ntp_server": "10.0.0.1, 10.0.0.2"}
+  POST /system-info   {"ip": ...}
+  POST /upgrade       {"ip": ..., "firmware": "/path/file.SPA", "upload_only": false}
+                                    starts a background job, returns {"job_id": ...}
+  GET  /jobs/<id>                   job state and result (finished jobs kept for daemon.job_ttl)
+
+Each POST body may carry "username" and "password"; otherwise credentials are
+taken from the inventory CSV (--csv) by IP address.
+
+With daemon.token (or IC3000_AGENT_TOKEN) set, every request must carry it in
+an X-IC3000-Token header. Over HTTP, stored credentials (--csv) are only
+served with a token; the Unix socket is restricted to its owner (mode 0600).
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import threading
+import itertools
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from typing import Dict, Optional
+
+from ic3000_records import read_devices
+from ic3000_upgrade_api import IC3000UpgradeClient
+
+
+class SessionPool:
+    """LRU pool of authenticated clients with idle eviction and token refresh"""
+
+    def __init__(self, max_size: int = 64, idle_timeout: float = 300, token_ttl: float = 900,
+                 client_kwargs: Optional[Dict] = None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.token_ttl = token_ttl
+        self.client_kwargs = client_kwargs or {}
+        self._entries = OrderedDict()  # (ip, username) -> entry dict
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'logins': 0, 'refreshes': 0, 'evictions': 0}
+
+    def _entry(self, ip, username, password):
+        key = (ip, username)
+        with self._lock:
+            replaced = self._entries.get(key)
+            if replaced is not None and replaced['password'] == password:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return replaced
+            entry = {
+                'client': IC3000UpgradeClient(ip, username, password, **self.client_kwargs),
+                'password': password,
+                'lock': threading.Lock(),  # one operation per device session at a time
+                'logged_in_at': 0.0,
+                'last_used': time.monotonic(),
+            }
+            self._entries[key] = entry
+            if replaced is not None:
+                # Password changed: the old session must not outlive its entry
+                self._retire(replaced)
+            while len(self._entries) > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._retire(evicted)
+            return entry
+
+    def _retire(self, entry):
+        """Close the session of an entry dropped from the pool, or leave that to its running call()"""
+        entry['retired'] = True
+        self.stats['evictions'] += 1
+        if entry['lock'].acquire(blocking=False):
+            try:
+                entry['client'].session.close()
+            finally:
+                entry['lock'].release()
+
+    def _login(self, entry):
+        client = entry['client']
+        client.authenticated = False
+        success, message = client.login()
+        if success:
+            entry['logged_in_at'] = time.monotonic()
+        return success, message
+
+    def call(self, ip: str, username: str, password: str, method: str, *args):
+        """
+        Run client.<method>(*args) on a warm session, logging in when needed
+
+        Re-authenticates once if the token is older than token_ttl or the
+        device answers 401 (token expired on the device side).
+        """
+        entry = self._entry(ip, username, password)
+        try:
+            with entry['lock']:
+                entry['last_used'] = time.monotonic()
+                client = entry['client']
+
+                if not client.authenticated or time.monotonic() - entry['logged_in_at'] > self.token_ttl:
+                    if client.authenticated:
+                        self.stats['refreshes'] += 1
+                    else:
+                        self.stats['logins'] += 1
+                    success, message = self._login(entry)
+                    if not success:
+                        return False, f'Auth: {message}'
+
+                client.last_status = None
+                success, result = getattr(client, method)(*args)
+                if not success and client.last_status == 401:
+                    self.stats['refreshes'] += 1
+                    ok, message = self._login(entry)
+                    if not ok:
+                        return False, f'Auth: {message}'
+                    success, result = getattr(client, method)(*args)
+
+                entry['last_used'] = time.monotonic()
+                return success, result
+        finally:
+            # A session dropped from the pool while in use is closed by its last caller
+            if entry.get('retired') and entry['lock'].acquire(blocking=False):
+                try:
+                    entry['client'].session.close()
+                finally:
+                    entry['lock'].release()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if now - e['last_used'] > self.idle_timeout]:
+                entry = self._entries[key]
+                if entry['lock'].locked():
+                    continue
+                del self._entries[key]
+                self._retire(entry)
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class IC3000Agent:
+    """Pool, credentials and background jobs behind the HTTP handler"""
+
+    def __init__(self, pool: SessionPool, credentials: Optional[Dict] = None, job_ttl: float = 3600):
+        self.pool = pool
+        self.credentials = credentials or {}  # ip -> (username, password)
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self._job_ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+        self.started = time.time()
+
+    def resolve_credentials(self, body):
+        ip = body.get('ip')
+        if not ip:
+            raise ValueError('Missing "ip"')
+        if body.get('username') and body.get('password'):
+            return ip, body['username'], body['password']
+        if ip in self.credentials:
+            return (ip,) + self.credentials[ip]
+        raise ValueError(f'No credentials for {ip} (pass username/password or start with --csv)')
+
+    def start_upgrade(self, ip, username, password, firmware, upload_only):
+        with self._jobs_lock:
+            job_id = str(next(self._job_ids))
+            self.jobs[job_id] = {'job_id': job_id, 'ip': ip, 'firmware': os.path.basename(firmware),
+                                 'state': 'running', 'started': time.time(), 'result': None}
+
+        def work():
+            if upload_only:
+                success, message = self.pool.call(ip, username, password, 'upload_firmware', firmware)
+            else:
+                success, message = self.pool.call(ip, username, password, 'upgrade_firmware', firmware)
+            job = self.jobs[job_id]
+            job['result'] = message
+            job['finished'] = time.time()
+            job['state'] = 'done' if success else 'failed'
+
+        threading.Thread(target=work, name=f'ic3000-job-{job_id}', daemon=True).start()
+        return job_id
+
+    def evict_jobs(self):
+        """Forget jobs that finished more than job_ttl seconds ago"""
+        cutoff = time.time() - self.job_ttl
+        with self._jobs_lock:
+            for job_id in [j for j, job in self.jobs.items() if job.get('finished', cutoff) < cutoff]:
+                del self.jobs[job_id]
+
+    def status(self):
+        states = {}
+        for job in list(self.jobs.values()):
+            states[job['state']] = states.get(job['state'], 0) + 1
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'sessions': self.pool.size(),
+            'pool': dict(self.pool.stats),
+            'jobs': states,
+        }
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    """JSON API handler; the IC3000Agent lives on self.server.agent"""
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f'[{self.log_date_time_string()}] {format % args}\n')
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self):
+        token = self.server.token
+        if token and not hmac.compare_digest(self.headers.get('X-IC3000-Token', '').encode(), token.encode()):
+            self._send(403, {'error': 'Invalid agent token'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        agent = self.server.agent
+        if self.path == '/status':
+            self._send(200, agent.status())
+        elif self.path.startswith('/jobs/'):
+            job = agent.jobs.get(self.path[len('/jobs/'):])
+            if job is None:
+                self._send(404, {'error': 'Unknown job'})
+            else:
+                self._send(200, job)
+        else:
+            self._send(404, {'error': f'Unknown path: {self.path}'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        agent = self.server.agent
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            ip, username, password = agent.resolve_credentials(body)
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        start = time.monotonic()
+        if self.path == '/ntp/get':
+            success, result = agent.pool.call(ip, username, password, 'get_ntp_config')
+        elif self.path == '/ntp/set':
+            if not body.get('ntp_server'):
+                self._send(400, {'error': 'Missing "ntp_server"'})
+                return
+            success, result = agent.pool.call(ip, username, password, 'set_ntp_config', body['ntp_server'])
+        elif self.path == '/system-info':
+            success, result = agent.pool.call(ip, username, password, 'get_system_info')
+        elif self.path == '/upgrade':
+            firmware = body.get('firmware')
+            if not firmware or not os.path.exists(firmware):
+                self._send(400, {'error': f'Firmware file not found: {firmware}'})
+                return
+            job_id = agent.start_upgrade(ip, username, password, firmware, bool(body.get('upload_only')))
+            self._send(202, {'job_id': job_id})
+            return
+        else:
+            self._send(404, {'error': f'Unknown path: {self.path}'})
+            return
+
+        self._send(200 if success else 502, {
+            'ip': ip,
+            'success': success,
+            'result': result,
+            'elapsed_ms': round((time.monotonic() - start) * 1000, 1),
+        })
+
+
+class UnixAgentServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def load_credentials(csv_file):
+    """ip -> (username, password) from the inventory, read like ic3000_auto.py reads it"""
+    return {device.ip: (device.username, device.password) for device in read_devices(csv_file)}
+
+
+def serve(agent, host='127.0.0.1', port=8765, socket_path=None, evict_interval=30, token=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # The pool holds authenticated sessions: create the socket owner-only, with no window before a chmod
+        umask = os.umask(0o177)
+        try:
+            server = UnixAgentServer(socket_path, AgentHandler)
+        finally:
+            os.umask(umask)
+        where = f'unix:{socket_path}'
+    else:
+        server = ThreadingHTTPServer((host, port), AgentHandler)
+        where = f'http://{host}:{port}'
+    server.agent = agent
+    server.token = token
+
+    def evictor():
+        while True:
+            time.sleep(evict_interval)
+            agent.pool.evict_idle()
+            agent.evict_jobs()
+
+    threading.Thread(target=evictor, name='ic3000-evictor', daemon=True).start()
+
+    print(f'IC3000 agent listening on {where}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nShutting down')
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main():
+    import argparse
+    from ic3000_auto import IC3000Config
+
+    parser = argparse.ArgumentParser(
+        description='IC3000 Agent - keeps device sessions warm for repeat queries',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # HTTP on localhost, credentials from the inventory
+  python3 ic3000_daemon.py --csv ic3000_devices.csv
+
+  # Unix socket
+  python3 ic3000_daemon.py --csv ic3000_devices.csv --socket /run/ic3000.sock
+
+  # Query (daemon.token / IC3000_AGENT_TOKEN set)
+  curl -s -X POST localhost:8765/ntp/get -H "X-IC3000-Token: $IC3000_AGENT_TOKEN" -d '{"ip": "192.168.1.100"}'
+  curl -s --unix-socket /run/ic3000.sock -X POST http://x/system-info -d '{"ip": "192.168.1.100"}'
+        """
+    )
+    parser.add_argument('--config', default='ic3000_config.yaml', help='Configuration file (timeouts, daemon.*)')
+    parser.add_argument('--csv', dest='csv_file', help='Inventory CSV used for credentials')
+    parser.add_argument('--host', default='127.0.0.1', help='HTTP bind address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, help='HTTP port (default: daemon.port or 8765)')
+    parser.add_argument('--socket', help='Serve on this Unix socket instead of HTTP')
+
+    args = parser.parse_args()
+    config = IC3000Config(args.config)
+
+    pool = SessionPool(
+        max_size=config.get('daemon.pool_size', 64),
+        idle_timeout=config.get('daemon.idle_timeout', 300),
+        token_ttl=config.get('daemon.token_ttl', 900),
+        client_kwargs={
+            'timeout': config.get('timeouts.api_call', 30),
+            'login_timeout': config.get('timeouts.login', 15),
+            'upload_timeout': config.get('timeouts.upload', 300),
+            'install_timeout': config.get('timeouts.install', 60),
+        }
+    )
+    token = os.environ.get('IC3000_AGENT_TOKEN') or config.get('daemon.token')
+    if args.csv_file and not args.socket and not token:
+        # Any local user could otherwise act on every inventory device with the stored credentials
+        print('✗ Serving inventory credentials over HTTP requires daemon.token or IC3000_AGENT_TOKEN '
+              '(or use --socket)', file=sys.stderr)
+        sys.exit(1)
+    try:
+        credentials = load_credentials(args.csv_file) if args.csv_file else {}
+    except (OSError, ValueError) as e:
+        print(f'✗ Cannot load inventory: {e}', file=sys.stderr)
+        sys.exit(1)
+    agent = IC3000Agent(pool, credentials, job_ttl=config.get('daemon.job_ttl', 3600))
+
+    serve(agent, host=args.host, port=args.port or config.get('daemon.port', 8765), socket_path=args.socket,
+          token=token)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+IC3000 Estimate - predict how long a bulk run will take (ic3000_auto.py --estimate)
+
+Per-device durations are learned from earlier runs: the run history database
+(per-phase timings) or, when history is empty, the per-run result CSVs (total
+Duration only). For every site (rollout.spread_by column, else /24 subnet) the
+model keeps the empirical distribution of phase durations and of upload
+throughput, so a larger or smaller firmware image is scaled by what each site's
+links actually delivered. Sites with too few samples fall back to the
+fleet-wide distribution.
+
+The scheduler is then replayed offline many times (Monte Carlo): each trial
+draws a duration for every device, runs the batches with N workers (a worker
+takes the next device as soon as it is free) and adds the delays between
+batches. The spread of the trial totals gives the confidence bounds, and the
+same draws are replayed for other worker counts to recommend settings that fit
+a target window.
+"""
+
+import os
+import csv
+import glob
+import heapq
+import json
+import random
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+
+FLEET = None  # model key of the fleet-wide distributions
+WORKER_CANDIDATES = (1, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 25, 30, 40, 50)
+
+
+def subnet_key(ip: str) -> str:
+    return '.'.join(ip.split('.')[:3])
+
+
+def firmware_name(target: str) -> Optional[str]:
+    """Firmware file name from a result Target ("image.SPA" or "NTP=...; FW=image.SPA")"""
+    if not target:
+        return None
+    for part in target.split(';'):
+        part = part.strip()
+        if part.startswith('FW='):
+            return part[3:]
+    return None if '=' in target else target
+
+
+def image_sizes(paths) -> Dict[str, int]:
+    """File name -> size for every file next to the given firmware paths"""
+    sizes = {}
+    for directory in {os.path.dirname(os.path.abspath(p)) for p in paths if p}:
+        for path in glob.glob(os.path.join(directory, '*')):
+            if os.path.isfile(path):
+                sizes[os.path.basename(path)] = os.path.getsize(path)
+    return sizes
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class DurationModel:
+    """Empirical per-site distributions of phase durations and upload throughput"""
+
+    def __init__(self, min_samples: int = 5):
+        self.min_samples = min_samples
+        self.records = defaultdict(list)  # site -> [{phase: seconds}], FLEET holds every record
+        self.throughput = defaultdict(list)  # site -> [bytes per second]
+
+    def add(self, site: str, duration: float, phases: Optional[Dict] = None, upload_bytes: Optional[int] = None,
+            timing_only: bool = False):
+        """One recorded device outcome; time not covered by a phase is kept as 'overhead'"""
+        phases = dict(phases or {})
+        # Pipeline queue waits (queue_<stage>) depend on that run's limits, not on the device
+        duration -= sum(phases.pop(k) for k in [k for k in phases if k.startswith('queue_')])
+        phases['overhead'] = max(0.0, duration - sum(phases.values()))
+        if upload_bytes and phases.get('upload', 0) > 0:
+            rate = upload_bytes / phases['upload']
+            self.throughput[site].append(rate)
+            self.throughput[FLEET].append(rate)
+        if not timing_only:
+            self.records[site].append(phases)
+            self.records[FLEET].append(phases)
+
+    def __len__(self):
+        return len(self.records[FLEET])
+
+    def _pool(self, table, site):
+        values = table.get(site, ())
+        return values if len(values) >= self.min_samples else table.get(FLEET, ())
+
+    def site_has_fit(self, site) -> bool:
+        return len(self.records.get(site, ())) >= self.min_samples
+
+    def sample(self, site: str, rng: random.Random, image_bytes: Optional[int] = None) -> float:
+        """Draw one device duration; the upload phase is rescaled to image_bytes by sampled throughput"""
+        record = rng.choice(self._pool(self.records, site))
+        upload = record.get('upload', 0.0)
+        if image_bytes and upload:
+            rates = self._pool(self.throughput, site)
+            if rates:
+                upload = image_bytes / rng.choice(rates)
+        return sum(v for k, v in record.items() if k != 'upload') + upload
+
+
+def load_history_model(history, label: str, site_of, sizes: Dict[str, int], min_samples: int = 5) -> DurationModel:
+    """Model from the run history: records of this operation, throughput from every upload"""
+    model = DurationModel(min_samples)
+    for row in history.samples():
+        phases = json.loads(row['phases'] or '{}')
+        name = firmware_name(row['target'])
+        upload_bytes = sizes.get(name) if name and row['status'] in ('Success', 'Warning') else None
+        model.add(site_of(row['ip']), row['duration'], phases, upload_bytes,
+                  timing_only=row['operation'] != label)
+    return model
+
+
+def load_results_model(results_dir: str, operation: str, site_of, min_samples: int = 5) -> DurationModel:
+    """Model from earlier result CSVs (total Duration per device, no phases)"""
+    model = DurationModel(min_samples)
+    for path in sorted(glob.glob(os.path.join(results_dir, f'ic3000_{operation}_*.csv'))):
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                if row.get('Status') in ('Skipped', 'Cancelled') or not row.get('Duration'):
+                    continue
+                try:
+                    duration = float(row['Duration'])
+                except ValueError:
+                    continue
+                model.add(site_of(row['IPAddress']), duration)
+    return model
+
+
+def simulate(durations: List[float], workers: int, batch_sizes: List[int], batch_delay: float,
+             device_timeout: float = 0) -> float:
+    """Total wall time of one run: batches in order, list scheduling on `workers` slots within a batch"""
+    total = 0.0
+    start = 0
+    for i, size in enumerate(batch_sizes):
+        batch = durations[start:start + size]
+        start += size
+        slots = [0.0] * max(1, min(workers, len(batch)))
+        for duration in batch:
+            if device_timeout:
+                duration = min(duration, device_timeout)
+            heapq.heapreplace(slots, slots[0] + duration)
+        total += max(slots)
+        if i < len(batch_sizes) - 1:
+            total += batch_delay
+    return total
+
+
+def estimate(model: DurationModel, sites: List[str], workers: int, batch_sizes: List[int], batch_delay: float,
+             image_bytes: Optional[int] = None, device_timeout: float = 0, trials: Optional[int] = None,
+             candidates=WORKER_CANDIDATES, seed: int = 0) -> Dict[int, List[float]]:
+    """
+    Monte Carlo over the scheduler; returns {workers: sorted trial totals}
+
+    `sites` has one entry per device in dispatch order. Every candidate worker
+    count replays the same draws, so their differences are not sampling noise.
+    """
+    rng = random.Random(seed)
+    if trials is None:
+        trials = max(20, min(300, 2000000 // max(1, len(sites))))
+    counts = sorted(set(c for c in candidates if c <= len(sites)) | {workers})
+    totals = {n: [] for n in counts}
+    for _ in range(trials):
+        durations = [model.sample(site, rng, image_bytes) for site in sites]
+        for n in counts:
+            totals[n].append(simulate(durations, n, batch_sizes, batch_delay, device_timeout))
+    for values in totals.values():
+        values.sort()
+    return totals
+
+
+def recommend(totals: Dict[int, List[float]], window_seconds: float, confidence: float = 0.9) -> Optional[int]:
+    """Smallest worker count whose `confidence` percentile fits the window"""
+    for n in sorted(totals):
+        if percentile(totals[n], confidence) <= window_seconds:
+            return n
+    return None
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+IC3000 Firmware Catalog - version-aware image selection (ic3000_auto.py upgrade --catalog DIR)
+
+A catalog is a directory of firmware images whose file names carry their
+version (IC3000-K9-1.5.1.SPA -> 1.5.1). It is indexed once per run; size,
+mtime, version and SHA-256 of every image are cached in an index file, so an
+unchanged image is never re-read, and a replaced one (new mtime or size) is
+digested again.
+
+For every device the manager reads the running version (get_system_info) and
+asks the catalog for the image to install:
+
+  - running version == target (or newer): nothing to do, no upload, no reboot
+  - an upgrade path matches the running version: the path's intermediate
+    version, e.g. {"1.2": "1.3.2"} sends every 1.2.x device through 1.3.2 first
+  - otherwise: the target version
+
+The target is software.target_version (default: highest version in the
+catalog); a per-device Firmware column overrides it with a version or an
+image file name from the catalog.
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+
+VERSION_RE = re.compile(r'(\d+(?:\.\d+){1,3})')
+INDEX_VERSION = 1
+
+# Keys that hold the running software version in system info responses, most specific first
+VERSION_KEYS = ('firmware_version', 'software_version', 'sw_version', 'os_version', 'version')
+
+
+def parse_version(text) -> Optional[Tuple[int, ...]]:
+    """'IC3000-K9-1.5.1.SPA' or '1.5.1' -> (1, 5, 1); None if there is no version"""
+    if text is None:
+        return None
+    match = VERSION_RE.search(str(text))
+    return tuple(int(part) for part in match.group(1).split('.')) if match else None
+
+
+def compare_versions(a: Tuple[int, ...], b: Tuple[int, ...]) -> int:
+    """-1, 0 or 1; the shorter version is padded with zeros, so 1.5 == 1.5.0 < 1.5.1"""
+    width = max(len(a), len(b))
+    a = a + (0,) * (width - len(a))
+    b = b + (0,) * (width - len(b))
+    return (a > b) - (a < b)
+
+
+def format_version(version: Optional[Tuple[int, ...]]) -> str:
+    return '.'.join(str(part) for part in version) if version else '?'
+
+
+def running_version(info) -> Optional[Tuple[int, ...]]:
+    """Running version from a get_system_info() response (dict, possibly nested, or text)"""
+    if isinstance(info, dict):
+        for key in VERSION_KEYS:
+            for k, v in info.items():
+                if k.lower() == key and not isinstance(v, (dict, list)):
+                    version = parse_version(v)
+                    if version:
+                        return version
+        for v in info.values():
+            if isinstance(v, (dict, list)):
+                version = running_version(v)
+                if version:
+                    return version
+        return None
+    if isinstance(info, list):
+        for item in info:
+            version = running_version(item)
+            if version:
+                return version
+        return None
+    return parse_version(info)
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FirmwareImage:
+    """One image in the catalog"""
+
+    __slots__ = ('path', 'name', 'version', 'size', 'mtime_ns', 'sha256')
+
+    def __init__(self, path: str, version: Tuple[int, ...], size: int, mtime_ns: int, sha256: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.version = version
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return f'FirmwareImage({self.name!r}, {format_version(self.version)})'
+
+
+class FirmwareCatalog:
+    """Images of one directory, indexed by version; read-only once built, safe to share between workers"""
+
+    def __init__(self, directory: str, index_path: str, pattern: str = '*.SPA',
+                 target: Optional[str] = None, upgrade_paths: Optional[Dict[str, str]] = None):
+        self.directory = directory
+        self.index_path = index_path
+        self.pattern = pattern
+        self.images: Dict[Tuple[int, ...], FirmwareImage] = {}
+        self.ignored: List[str] = []  # files without a version in their name
+        self.digested = 0  # images read this run (new or changed since the last index)
+        self._index()
+
+        if target:
+            self.target = parse_version(target)
+            if self.target is None:
+                raise ValueError(f'Invalid target version "{target}"')
+        else:
+            self.target = max(self.images) if self.images else None
+        self.paths = []
+        for prefix, via in (upgrade_paths or {}).items():
+            if parse_version(prefix) is None or parse_version(via) is None:
+                raise ValueError(f'Invalid upgrade path "{prefix}: {via}" (expected version: version)')
+            self.paths.append((parse_version(prefix), parse_version(via)))
+        # Longest prefix first, so "1.2.3" beats "1.2"
+        self.paths.sort(key=lambda item: -len(item[0]))
+
+    def _index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                cached = json.load(f)
+            if cached.get('version') != INDEX_VERSION:
+                cached = {}
+        except (OSError, ValueError):
+            cached = {}
+        entries = cached.get('images', {})
+
+        fresh = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            if not os.path.isfile(path):
+                continue
+            path = os.path.abspath(path)
+            version = parse_version(os.path.basename(path))
+            if version is None:
+                self.ignored.append(os.path.basename(path))
+                continue
+            st = os.stat(path)
+            entry = entries.get(path)
+            if not entry or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+                entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': file_digest(path)}
+                self.digested += 1
+            fresh[path] = entry
+            same = self.image(version)
+            if same is not None:
+                raise ValueError(f'Two images for version {format_version(version)}: '
+                                 f'{same.name}, {os.path.basename(path)}')
+            self.images[version] = FirmwareImage(path, version, entry['size'], entry['mtime_ns'], entry['sha256'])
+
+        # Other catalog directories may share the index file: only replace this directory's entries
+        prefix = os.path.abspath(self.directory) + os.sep
+        others = {p: e for p, e in entries.items() if not p.startswith(prefix)}
+        if len(others) + len(fresh) != len(entries) or any(entries.get(p) != e for p, e in fresh.items()):
+            entries = dict(others, **fresh)
+            directory = os.path.dirname(self.index_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'images': entries}, f, indent=1)
+            os.replace(tmp, self.index_path)
+
+    def __len__(self):
+        return len(self.images)
+
+    def image(self, version: Optional[Tuple[int, ...]]) -> Optional[FirmwareImage]:
+        """Image of a version, whatever its length (1.5 finds IC3000-K9-1.5.0.SPA)"""
+        if version is None:
+            return None
+        for image in self.images.values():
+            if compare_versions(image.version, version) == 0:
+                return image
+        return None
+
+    def find(self, text: str) -> Optional[FirmwareImage]:
+        """Image by file name or version"""
+        for image in self.images.values():
+            if image.name == os.path.basename(text):
+                return image
+        return self.image(parse_version(text))
+
+    def device_target(self, device) -> Optional[Tuple[int, ...]]:
+        if device.firmware:
+            image = self.find(device.firmware)
+            return image.version if image else parse_version(device.firmware)
+        return self.target
+
+    def select(self, current: Optional[Tuple[int, ...]],
+               target: Optional[Tuple[int, ...]]) -> Tuple[Optional[FirmwareImage], bool, str]:
+        """
+        Image to install on a device running `current`
+        Returns: (image or None, up_to_date: bool, message)
+        """
+        if target is None:
+            return None, False, 'No target version (empty catalog)'
+        if current is None:
+            return None, False, 'Could not determine running version'
+        if compare_versions(current, target) >= 0:
+            if compare_versions(current, target) > 0:
+                return None, True, f'Already on {format_version(current)} (newer than target {format_version(target)})'
+            return None, True, f'Already on {format_version(current)}'
+        step = target
+        for prefix, via in self.paths:
+            if current[:len(prefix)] == prefix and compare_versions(current, via) < 0 < compare_versions(target, via):
+                step = via
+                break
+        image = self.image(step)
+        if image is None:
+            return None, False, f'No image for {format_version(step)} in catalog {self.directory}'
+        return image, False, f'{format_version(current)} -> {format_version(step)}'
+
+    def plan_key(self) -> List:
+        """Everything selection depends on, for desired-state fingerprints"""
+        return [format_version(self.target), [[format_version(a), format_version(b)] for a, b in self.paths],
+                sorted(image.sha256 for image in self.images.values())]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Index an IC3000 firmware catalog directory')
+    parser.add_argument('directory', help='Directory with firmware images')
+    parser.add_argument('--pattern', default='*.SPA', help='Image file pattern (default: *.SPA)')
+    parser.add_argument('--index', default=os.path.join('results', 'ic3000_firmware_index.json'),
+                        help='Index file (default: results/ic3000_firmware_index.json)')
+    parser.add_argument('--target', help='Target version (default: highest in catalog)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f'✗ Not a directory: {args.directory}')
+        sys.exit(1)
+
+    catalog = FirmwareCatalog(args.directory, args.index, args.pattern, args.target)
+    print(f'{"Version":<12} {"Size":>9}  {"SHA-256":<16}  Image')
+    print('-' * 80)
+    for version, image in sorted(catalog.images.items()):
+        marker = '  (target)' if catalog.target and compare_versions(version, catalog.target) == 0 else ''
+        print(f'{format_version(version):<12} {image.size / (1024 * 1024):>7.1f}MB  {image.sha256[:16]}  {image.name}{marker}')
+    print(f'\n{len(catalog)} images, {catalog.digested} digested this time')
+    for name in catalog.ignored:
+        print(f'⚠ Ignored (no version in file name): {name}')
+
+
+if __name__ == '__main__':
+    main()
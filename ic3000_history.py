@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+IC3000 Run History - indexed SQLite store of every device outcome
+
+ic3000_auto.py records each run and each device result (with per-phase
+timings) here, next to the per-run CSV. The store answers questions such as
+"when did this device last succeed an NTP push?" without grepping result files,
+and feeds device selection (--retry-failed, --failing N, --changed-only).
+
+For --changed-only it also keeps, per device and operation, the fingerprint of
+the desired state that last succeeded, and when the last full sweep (a run
+over the whole inventory) finished.
+"""
+
+import os
+import sys
+import json
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from ic3000_records import FAILED, TIMEOUT, WARNING
+
+# Outcomes of devices that were attempted and did not succeed; Skipped, Cancelled and
+# SiteUnreachable devices were never (fully) attempted and are not selected for a retry
+ATTEMPT_FAILURES = (FAILED, TIMEOUT, WARNING)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    operation    TEXT NOT NULL,
+    started_at   TEXT NOT NULL,
+    finished_at  TEXT,
+    device_count INTEGER,
+    csv_file     TEXT,
+    result_file  TEXT
+);
+CREATE TABLE IF NOT EXISTS outcomes (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id       INTEGER NOT NULL REFERENCES runs(run_id),
+    ip           TEXT NOT NULL,
+    device_name  TEXT,
+    operation    TEXT NOT NULL,
+    target       TEXT,
+    status       TEXT NOT NULL,
+    message      TEXT,
+    duration     REAL,
+    phases       TEXT,
+    finished_at  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    ip           TEXT NOT NULL,
+    operation    TEXT NOT NULL,
+    fingerprint  TEXT NOT NULL,
+    run_id       INTEGER,
+    updated_at   TEXT NOT NULL,
+    PRIMARY KEY (ip, operation)
+);
+CREATE TABLE IF NOT EXISTS sweeps (
+    operation    TEXT PRIMARY KEY,
+    run_id       INTEGER,
+    finished_at  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outcomes_ip_op_time ON outcomes (ip, operation, finished_at);
+CREATE INDEX IF NOT EXISTS idx_outcomes_run ON outcomes (run_id);
+CREATE INDEX IF NOT EXISTS idx_outcomes_status ON outcomes (status, operation);
+CREATE INDEX IF NOT EXISTS idx_runs_op_time ON runs (operation, started_at);
+"""
+
+
+class RunHistory:
+    """SQLite run history; use from a single thread (the manager's dispatcher)"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    # ------------------------------------------------------------------
+    # Recording
+    # ------------------------------------------------------------------
+
+    def start_run(self, operation: str, device_count: int, csv_file: Optional[str] = None) -> int:
+        with self.conn:
+            cur = self.conn.execute(
+                'INSERT INTO runs (operation, started_at, device_count, csv_file) VALUES (?, ?, ?, ?)',
+                (operation, datetime.now().isoformat(timespec='seconds'), device_count, csv_file)
+            )
+        return cur.lastrowid
+
+    def record(self, run_id: int, results: List):
+        """Store DeviceResult records as produced by IC3000Manager.process_batch"""
+        rows = [
+            (
+                run_id,
+                r.ip,
+                r.device_name,
+                r.operation,
+                r.target,
+                r.status,
+                r.message,
+                r.duration,
+                json.dumps(r.phases or {}),
+                r.finished_at or datetime.now().isoformat(timespec='seconds'),
+            )
+            for r in results
+        ]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO outcomes (run_id, ip, device_name, operation, target, status, message, '
+                'duration, phases, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def finish_run(self, run_id: int, result_file: Optional[str] = None):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE runs SET finished_at = ?, result_file = ? WHERE run_id = ?',
+                (datetime.now().isoformat(timespec='seconds'), result_file, run_id)
+            )
+
+    def save_fingerprints(self, run_id: int, operation: str, fingerprints: Dict[str, str]):
+        """Desired-state fingerprints (ip -> fingerprint) of devices that just succeeded"""
+        now = datetime.now().isoformat(timespec='seconds')
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO fingerprints (ip, operation, fingerprint, run_id, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(ip, operation, fingerprint, run_id, now) for ip, fingerprint in fingerprints.items()]
+            )
+
+    def record_sweep(self, run_id: int, operation: str):
+        """Mark a run that covered the whole inventory as the latest full sweep"""
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO sweeps (operation, run_id, finished_at) VALUES (?, ?, ?)',
+                (operation, run_id, datetime.now().isoformat(timespec='seconds'))
+            )
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def runs(self, limit: int = 20) -> List[sqlite3.Row]:
+        return self.conn.execute(
+            'SELECT r.*, '
+            '  (SELECT COUNT(*) FROM outcomes o WHERE o.run_id = r.run_id AND o.status = ?) AS success, '
+            '  (SELECT COUNT(*) FROM outcomes o WHERE o.run_id = r.run_id) AS recorded '
+            'FROM runs r ORDER BY r.run_id DESC LIMIT ?',
+            ('Success', limit)
+        ).fetchall()
+
+    def device_history(self, ip: str, operation: Optional[str] = None, limit: int = 20) -> List[sqlite3.Row]:
+        sql = 'SELECT * FROM outcomes WHERE ip = ?'
+        params = [ip]
+        if operation:
+            sql += ' AND operation = ?'
+            params.append(operation)
+        sql += ' ORDER BY finished_at DESC, id DESC LIMIT ?'
+        params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+    def last_success(self, ip: str, operation: str) -> Optional[sqlite3.Row]:
+        return self.conn.execute(
+            'SELECT * FROM outcomes WHERE ip = ? AND operation = ? AND status = ? '
+            'ORDER BY finished_at DESC, id DESC LIMIT 1',
+            (ip, operation, 'Success')
+        ).fetchone()
+
+    def last_run_failures(self, operation: str) -> List[str]:
+        """IPs that failed (ATTEMPT_FAILURES) in the most recent run of this operation"""
+        row = self.conn.execute(
+            'SELECT run_id FROM runs WHERE operation = ? ORDER BY run_id DESC LIMIT 1', (operation,)
+        ).fetchone()
+        if row is None:
+            return []
+        return [r['ip'] for r in self.conn.execute(
+            'SELECT DISTINCT ip FROM outcomes WHERE run_id = ? AND status IN (?, ?, ?)',
+            (row['run_id'],) + ATTEMPT_FAILURES
+        )]
+
+    def fingerprints(self, operation: str) -> Dict[str, str]:
+        """ip -> fingerprint of the desired state last applied successfully"""
+        return {r['ip']: r['fingerprint'] for r in self.conn.execute(
+            'SELECT ip, fingerprint FROM fingerprints WHERE operation = ?', (operation,)
+        )}
+
+    def last_sweep(self, operation: str) -> Optional[datetime]:
+        row = self.conn.execute('SELECT finished_at FROM sweeps WHERE operation = ?', (operation,)).fetchone()
+        return datetime.fromisoformat(row['finished_at']) if row else None
+
+    def samples(self, operation: Optional[str] = None, limit: int = 20000) -> List[sqlite3.Row]:
+        """Most recent timed outcomes (Skipped and Cancelled devices never ran), for duration estimates"""
+        sql = ('SELECT ip, operation, target, status, duration, phases FROM outcomes '
+               'WHERE duration IS NOT NULL AND status NOT IN (?, ?)')
+        params = ['Skipped', 'Cancelled']
+        if operation:
+            sql += ' AND operation = ?'
+            params.append(operation)
+        sql += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+        return self.conn.execute(sql, params).fetchall()
+
+    def consecutive_failures(self, operation: str, count: int) -> Dict[str, int]:
+        """
+        IPs whose latest `count` or more attempts at this operation all failed
+
+        Outcomes outside ATTEMPT_FAILURES and Success (device skipped or
+        cancelled) neither count nor break a streak.
+        """
+        streaks = {}
+        finished = set()
+        rows = self.conn.execute(
+            'SELECT ip, status FROM outcomes WHERE operation = ? ORDER BY ip, finished_at DESC, id DESC',
+            (operation,)
+        )
+        for row in rows:
+            ip = row['ip']
+            if ip in finished:
+                continue
+            if row['status'] == 'Success':
+                finished.add(ip)
+            elif row['status'] in ATTEMPT_FAILURES:
+                streaks[ip] = streaks.get(ip, 0) + 1
+        return {ip: n for ip, n in streaks.items() if n >= count}
+
+
+def default_db_path(config) -> str:
+    """Database of a configuration: history.db, else ic3000_history.db in output.results_dir"""
+    return config.get('history.db') or os.path.join(config.get('output.results_dir', 'results'), 'ic3000_history.db')
+
+
+def main():
+    import argparse
+    from ic3000_auto import IC3000Config
+
+    parser = argparse.ArgumentParser(
+        description='IC3000 run history queries',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Recent runs
+  python3 ic3000_history.py runs
+
+  # Everything recorded for one device
+  python3 ic3000_history.py device 192.168.1.100
+
+  # When did this device last succeed an NTP push?
+  python3 ic3000_history.py last-success 192.168.1.100 --operation NTP
+
+  # Devices that failed the last 3 upgrade attempts in a row
+  python3 ic3000_history.py failing --operation Upgrade --runs 3
+        """
+    )
+    parser.add_argument('--config', default='ic3000_config.yaml', help='Configuration file (history.db, output.results_dir)')
+    parser.add_argument('--db', help='History database (default: from the configuration, as ic3000_auto.py uses it)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_runs = sub.add_parser('runs', help='List recent runs')
+    p_runs.add_argument('--limit', type=int, default=20)
+
+    p_device = sub.add_parser('device', help='Outcomes for one device')
+    p_device.add_argument('ip')
+    p_device.add_argument('--operation', help='NTP, Upgrade, Apply, Stage, Install')
+    p_device.add_argument('--limit', type=int, default=20)
+
+    p_last = sub.add_parser('last-success', help='Last successful outcome for a device')
+    p_last.add_argument('ip')
+    p_last.add_argument('--operation', default='NTP')
+
+    p_failing = sub.add_parser('failing', help='Devices failing N runs in a row')
+    p_failing.add_argument('--operation', default='NTP')
+    p_failing.add_argument('--runs', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.db is None:
+        args.db = default_db_path(IC3000Config(args.config))
+
+    if not os.path.exists(args.db):
+        print(f"✗ History database not found: {args.db}")
+        sys.exit(1)
+
+    history = RunHistory(args.db)
+
+    if args.command == 'runs':
+        print(f'{"Run":<6} {"Operation":<10} {"Started":<20} {"Devices":>7} {"Success":>7}  Result file')
+        print('-' * 80)
+        for r in history.runs(args.limit):
+            print(f'{r["run_id"]:<6} {r["operation"]:<10} {r["started_at"]:<20} '
+                  f'{r["device_count"] or 0:>7} {r["success"]:>7}  {r["result_file"] or ""}')
+
+    elif args.command == 'device':
+        rows = history.device_history(args.ip, args.operation, args.limit)
+        if not rows:
+            print(f'No history for {args.ip}')
+            sys.exit(1)
+        print(f'{"Finished":<20} {"Operation":<10} {"Status":<10} {"Duration":>8}  Message')
+        print('-' * 80)
+        for r in rows:
+            duration = f'{r["duration"]:.1f}s' if r['duration'] is not None else ''
+            print(f'{r["finished_at"]:<20} {r["operation"]:<10} {r["status"]:<10} {duration:>8}  {(r["message"] or "")[:40]}')
+
+    elif args.command == 'last-success':
+        row = history.last_success(args.ip, args.operation)
+        if row is None:
+            print(f'{args.ip}: no successful {args.operation} recorded')
+            sys.exit(1)
+        print(f'{args.ip}: last successful {args.operation} at {row["finished_at"]} (run {row["run_id"]}, target {row["target"]})')
+
+    elif args.command == 'failing':
+        streaks = history.consecutive_failures(args.operation, args.runs)
+        if not streaks:
+            print(f'No devices failing {args.operation} {args.runs} runs in a row')
+        for ip, n in sorted(streaks.items(), key=lambda item: -item[1]):
+            print(f'{ip:<18} {n} consecutive failures')
+
+    history.close()
+
+
+if __name__ == '__main__':
+    main()
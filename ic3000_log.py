@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+IC3000 Run Logger - queue-based structured logging for bulk runs
+
+Worker threads never write to stdout themselves. They put small event tuples
+on a queue and a single consumer thread renders them: a throttled, aggregated
+progress line, per-device lines depending on the verbosity level, and an
+optional JSON Lines log file with every event.
+
+Verbosity (output.verbose / -v):
+  0  progress line only (failures are listed in the final summary)
+  1  one line per finished device (default)
+  2  also per-device step detail from the API clients (upload progress etc.)
+"""
+
+import sys
+import json
+import time
+import queue
+import threading
+from collections import Counter
+from typing import Optional
+
+
+class RunLogger:
+    """Single-consumer event logger shared by the manager and its worker threads"""
+
+    def __init__(self, verbose: int = 1, show_progress: bool = True, json_path: Optional[str] = None,
+                 interval: float = 1.0, stream=None):
+        self.verbose = int(verbose)
+        self.show_progress = show_progress
+        self.json_path = json_path
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+        self.total = 0
+        self.counts = Counter()
+        self.completed = 0
+        self._start = None
+        self._last_render = 0.0
+        self._line_len = 0  # length of the progress line currently shown (tty only)
+
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._json_file = None
+
+    # ------------------------------------------------------------------
+    # Producer side (any thread)
+    # ------------------------------------------------------------------
+
+    def result(self, result):
+        """A device finished; result is the manager's DeviceResult (not modified afterwards)"""
+        self._queue.put(('result', time.time(), result))
+
+    def detail(self, ip: str, message: str):
+        """Per-device step detail (shown at verbosity 2)"""
+        self._queue.put(('detail', time.time(), {'IPAddress': ip, 'Message': message}))
+
+    def message(self, text: str):
+        """Run-level message that is always shown (batch headers, interrupts)"""
+        self._queue.put(('message', time.time(), {'Message': text}))
+
+    def device_logger(self, ip: str):
+        """Callable suitable for IC3000APIClient.log, tagging messages with the device IP"""
+        return lambda text: self.detail(ip, text.strip())
+
+    def flush(self):
+        """Block until every queued event has been rendered and end the progress line"""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(('flush', time.time(), done))
+        done.wait()
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def start(self, total: int = 0):
+        self.total = total
+        self.counts.clear()
+        self.completed = 0
+        self._start = time.monotonic()
+        if self.json_path and self._json_file is None:
+            self._json_file = open(self.json_path, 'a')
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._consume, name='ic3000-log', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(('stop', time.time(), None))
+            self._thread.join()
+            self._thread = None
+        if self._json_file is not None:
+            self._json_file.close()
+            self._json_file = None
+
+    # ------------------------------------------------------------------
+    # Consumer side (logger thread only)
+    # ------------------------------------------------------------------
+
+    def _consume(self):
+        while True:
+            try:
+                kind, ts, payload = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                self._render_progress()
+                continue
+
+            if kind == 'stop':
+                self._render_progress(force=True)
+                self._end_progress_line()
+                return
+            if kind == 'flush':
+                self._render_progress(force=True)
+                self._end_progress_line()
+                if self._json_file is not None:
+                    self._json_file.flush()
+                payload.set()
+                continue
+
+            self._write_json(kind, ts, payload.to_dict() if kind == 'result' else payload)
+
+            if kind == 'result':
+                self.completed += 1
+                self.counts[payload.status] += 1
+                if self.verbose >= 1:
+                    self._write_lines(self._format_result(payload))
+            elif kind == 'detail':
+                if self.verbose >= 2:
+                    self._write_lines([f'            {payload["IPAddress"]}: {payload["Message"]}'])
+            elif kind == 'message':
+                self._write_lines([payload['Message']])
+
+            self._render_progress()
+
+    def _format_result(self, result):
+        status_icon = '✓' if result.status == 'Success' else '✗'
+        target_info = f' → {result.target}' if result.target else ''
+        lines = [f'[{self.completed}/{self.total}] {status_icon} {result.device_name} ({result.ip}){target_info}']
+        if result.status != 'Success' and result.message:
+            lines.append(f'            {result.message[:70]}')
+        return lines
+
+    def _write_json(self, kind, ts, payload):
+        if self._json_file is None:
+            return
+        record = {'ts': round(ts, 3), 'event': kind}
+        record.update(payload)
+        self._json_file.write(json.dumps(record, default=str) + '\n')
+
+    def _write_lines(self, lines):
+        self._clear_progress_line()
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+
+    def _render_progress(self, force=False):
+        if not self.show_progress or self._start is None or not self.total:
+            return
+        now = time.monotonic()
+        # Non-interactive output (logs, pipes) gets a new line at most every 10 intervals
+        interval = self.interval if self.is_tty else self.interval * 10
+        if not force and now - self._last_render < interval:
+            return
+        self._last_render = now
+
+        elapsed = now - self._start
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        others = ' '.join(f'{status}={count}' for status, count in sorted(self.counts.items())
+                          if status not in ('Success', 'Failed'))
+        line = (f'Progress: {self.completed}/{self.total} | ok={self.counts["Success"]} '
+                f'failed={self.counts["Failed"]}{" " + others if others else ""} | '
+                f'{rate:.2f} dev/s | {elapsed:.0f}s elapsed')
+
+        if self.is_tty:
+            self.stream.write('\r' + line.ljust(self._line_len))
+            self._line_len = len(line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def _clear_progress_line(self):
+        if self._line_len:
+            self.stream.write('\r' + ' ' * self._line_len + '\r')
+            self._line_len = 0
+
+    def _end_progress_line(self):
+        if self._line_len:
+            self.stream.write('\n')
+            self.stream.flush()
+            self._line_len = 0
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+IC3000 Pipeline - per-stage concurrency limits for upgrades (ic3000_auto.py upgrade --pipeline)
+
+Without the pipeline, one worker slot carries a device through login, upload
+and install, so cheap steps wait behind bandwidth-heavy uploads and the link
+sits idle while workers authenticate. With it, every device runs through
+
+  reachability -> login -> upload -> install -> verify
+
+and each stage has its own concurrency limit with a FIFO queue in front of
+it. Devices overlap across stages: while `upload` devices transfer firmware,
+the next ones are already checked and logged in and wait at the head of the
+upload queue.
+
+Only devices that have not finished their upload count as in flight: once a
+device is past upload it waits out install and reboot without holding back
+the next device (see StagePipeline.mark_uploaded).
+
+Time spent waiting in a stage queue is recorded as queue_<stage> in the
+device's phase timings and does not count against the device deadline.
+"""
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+
+STAGES = ('reachability', 'login', 'upload', 'install', 'verify')
+
+DEFAULT_LIMITS = {'reachability': 50, 'login': 10, 'upload': 3, 'install': 20, 'verify': 50}
+
+
+class StageCancelled(Exception):
+    """The device was cancelled (deadline or Ctrl+C) while queued for a stage"""
+
+
+class StageGate:
+    """FIFO concurrency limit for one stage"""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self.peak_queue = 0
+        self.passed = 0
+        self._waiting = deque()
+        self._cond = threading.Condition()
+
+    def acquire(self, cancelled=lambda: False):
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while self._waiting[0] is not ticket or self.active >= self.limit:
+                    if cancelled():
+                        raise StageCancelled(self.name)
+                    self.peak_queue = max(self.peak_queue, len(self._waiting))
+                    self._cond.wait(0.5)
+            finally:
+                if self._waiting and self._waiting[0] is ticket:
+                    self._waiting.popleft()
+                elif ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                self._cond.notify_all()
+            self.active += 1
+            self.passed += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+class StagePipeline:
+    """One gate per stage, shared by every device thread of a batch"""
+
+    def __init__(self, limits: Dict[str, int], on_uploaded=None):
+        self.gates = {name: StageGate(name, limits.get(name, DEFAULT_LIMITS[name])) for name in STAGES}
+        self.uploaded = set()  # thread idents of devices past the upload stage
+        self._on_uploaded = on_uploaded
+
+    def mark_uploaded(self):
+        """Called by a device thread once its upload is done; it stops counting as in flight"""
+        self.uploaded.add(threading.get_ident())
+        if self._on_uploaded is not None:
+            self._on_uploaded()
+
+    def unmark(self):
+        """Called by a device thread when it is done"""
+        self.uploaded.discard(threading.get_ident())
+
+    def in_flight(self, threads) -> int:
+        """How many of the running `threads` have not finished their upload yet"""
+        return sum(1 for thread in threads if thread.ident not in self.uploaded)
+
+    @contextmanager
+    def stage(self, name: str, client):
+        """Wait for a slot in `name`, then run the block; queue time goes to client.timings['queue_<name>']"""
+        gate = self.gates[name]
+        client.queued_since = time.monotonic()
+        try:
+            with client.tracer.span(f'queue {name}', cat='queue'):
+                gate.acquire(lambda: client.cancelled)
+        finally:
+            waited = time.monotonic() - client.queued_since
+            client.queued_since = None
+            client.timings[f'queue_{name}'] = client.timings.get(f'queue_{name}', 0.0) + waited
+        try:
+            yield
+        finally:
+            gate.release()
+
+    def summary(self) -> str:
+        return ', '.join(f'{g.name} {g.limit} (peak queue {g.peak_queue})' for g in self.gates.values())
+
+
+def queued_seconds(client) -> float:
+    """Total time a client has spent waiting in stage queues, including a wait in progress"""
+    total = sum(v for k, v in list(client.timings.items()) if k.startswith('queue_'))
+    since = client.queued_since
+    if since is not None:
+        total += time.monotonic() - since
+    return total
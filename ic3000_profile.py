@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+IC3000 Profiler - CPU and memory profile of a bulk run (ic3000_auto.py --profile)
+
+Writes three files next to the run's result CSV:
+  <run>.pstats      cProfile statistics merged across every thread
+                    (python3 -m pstats <run>.pstats, snakeviz, ...)
+  <run>.collapsed   sampled stacks of every thread in collapsed-stack format
+                    (flamegraph.pl <run>.collapsed > run.svg, speedscope, ...)
+  <run>_memory.txt  tracemalloc report: allocations at peak, the share held
+                    by the upgrade client (upload_firmware reads the whole
+                    image into memory per device) and growth per batch
+
+cProfile only sees the thread that enabled it before Python 3.12, so one
+profiler is started in every thread through threading.setprofile(). Every
+device runs in its own short-lived thread, so the sampler merges the profile
+of each finished thread into one pstats.Stats as it goes (memory stays flat
+at any fleet size), and folds their stacks into one "ic3000-device" root frame
+instead of one root per device. Before 3.12 disable() only unhooks the calling
+thread, so a profile is only merged once its thread has ended; threads still
+running at the end (a device thread abandoned after its deadline) are left out
+of the pstats and counted in RunProfiler.unmerged_threads.
+"""
+
+import os
+import re
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Dict
+
+
+UPGRADE_MODULE = 'ic3000_upgrade_api.py'
+
+
+def _thread_label(name: str) -> str:
+    """Fold per-device and numbered thread names: 'ic3000-device-10.0.0.5' -> 'ic3000-device'"""
+    name = name.split(' (')[0]
+    return re.sub(r'[-_]?[\d.:]+$', '', name) or name
+
+
+class RunProfiler:
+    """Multi-thread CPU profile, stack sampler and tracemalloc snapshots for one run"""
+
+    def __init__(self, output_dir: str, prefix: str, sample_interval: float = 0.005, trace_frames: int = 25):
+        self.base = os.path.join(output_dir, prefix)
+        self.sample_interval = sample_interval
+        self.trace_frames = trace_frames
+
+        self._profiles = []  # (thread, profile) of threads not merged yet
+        self._stats = None  # pstats.Stats merged from finished threads
+        self.unmerged_threads = 0  # threads still running when the pstats were written
+        self._profiles_lock = threading.Lock()
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._sampler = None
+
+        self._snapshots = []  # (label, snapshot) at batch boundaries
+        self._peak = None  # (traced bytes, time, snapshot) taken when memory reaches a new high
+        self._snapshot_lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def start(self):
+        tracemalloc.start(self.trace_frames)
+        self.snapshot('start')
+
+        # The sampler starts before the profile hook so it does not profile itself
+        self._sampler = threading.Thread(target=self._sample, name='ic3000-profiler', daemon=True)
+        self._sampler.start()
+
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_new_thread)
+        # From 3.12 cProfile uses sys.monitoring, which already covers every thread
+        self._enable_profile()
+
+    def stop(self) -> Dict[str, str]:
+        """Stop profiling and write the report files; returns {kind: path}"""
+        threading.setprofile(None)
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.snapshot('end')
+
+        paths = {
+            'pstats': self._write_pstats(self.base + '.pstats'),
+            'collapsed': self._write_collapsed(self.base + '.collapsed'),
+            'memory': self._write_memory(self.base + '_memory.txt'),
+        }
+        tracemalloc.stop()
+        return paths
+
+    def snapshot(self, label: str):
+        """Take a labelled tracemalloc snapshot (the manager takes one after each batch)"""
+        with self._snapshot_lock:
+            self._snapshots.append((label, tracemalloc.take_snapshot()))
+
+    # ------------------------------------------------------------------
+    # Collection
+    # ------------------------------------------------------------------
+
+    def _enable_profile(self):
+        profile = cProfile.Profile()
+        with self._profiles_lock:
+            self._profiles.append((threading.current_thread(), profile))
+        profile.enable()
+
+    def _merge(self, profile):
+        try:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+        except TypeError:
+            pass  # a thread that never made a profiled call
+
+    def _merge_finished(self):
+        """Fold the profiles of threads that have ended into the merged stats"""
+        with self._profiles_lock:
+            finished = [profile for thread, profile in self._profiles if not thread.is_alive()]
+            self._profiles = [(thread, profile) for thread, profile in self._profiles if thread.is_alive()]
+            for profile in finished:
+                self._merge(profile)
+
+    def _profile_new_thread(self, frame, event, arg):
+        # Called once at the first event of each new thread; enable() replaces this hook
+        self._enable_profile()
+
+    def _sample(self):
+        own = threading.get_ident()
+        last_peak_check = last_merge = 0.0
+        while not self._stop.wait(self.sample_interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(_thread_label(names.get(ident, 'thread')))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+            now = time.monotonic()
+            if now - last_merge >= 1.0:
+                last_merge = now
+                self._merge_finished()
+
+            # Upload buffers are freed as soon as upload_firmware returns, so batch-boundary
+            # snapshots miss them: snapshot again whenever traced memory reaches a new high
+            if now - last_peak_check >= 0.5:
+                last_peak_check = now
+                current, _ = tracemalloc.get_traced_memory()
+                if self._peak is None or current > self._peak[0] * 1.1:
+                    self._peak = (current, datetime.now(), tracemalloc.take_snapshot())
+
+    # ------------------------------------------------------------------
+    # Reports
+    # ------------------------------------------------------------------
+
+    def _write_pstats(self, path):
+        # Only this thread's own profile can be stopped from here; one still hooked into a live
+        # thread would keep changing while it is merged
+        own = threading.current_thread()
+        with self._profiles_lock:
+            mine = [profile for thread, profile in self._profiles if thread is own]
+            self._profiles = [(thread, profile) for thread, profile in self._profiles if thread is not own]
+        for profile in mine:
+            profile.disable()
+        self._merge_finished()
+        with self._profiles_lock:
+            for profile in mine:
+                self._merge(profile)
+            self.unmerged_threads = len(self._profiles)
+        if self._stats is None:
+            return None
+        self._stats.dump_stats(path)
+        return path
+
+    def _write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write(f'{stack} {count}\n')
+        return path
+
+    def _write_memory(self, path):
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f'Traced memory: current {current / 1048576:.1f} MB, peak {peak / 1048576:.1f} MB',
+            '',
+        ]
+
+        if self._peak is not None:
+            traced, when, snapshot = self._peak
+            lines.append(f'Largest snapshot: {traced / 1048576:.1f} MB at {when.strftime("%H:%M:%S")}')
+            lines.append('Top allocations (by line):')
+            for stat in snapshot.statistics('lineno')[:15]:
+                lines.append(f'  {stat}')
+            lines.append('')
+
+            upgrade = snapshot.filter_traces([tracemalloc.Filter(True, f'*{UPGRADE_MODULE}', all_frames=True)])
+            held = sum(stat.size for stat in upgrade.statistics('filename'))
+            lines.append(f'Held under {UPGRADE_MODULE} (upload_firmware buffers): {held / 1048576:.1f} MB')
+            for stat in upgrade.statistics('traceback')[:5]:
+                lines.append(f'  {stat.size / 1048576:.1f} MB in {stat.count} blocks')
+                lines.extend(f'    {line}' for line in stat.traceback.format(limit=4))
+            lines.append('')
+
+        lines.append('Growth between snapshots:')
+        with self._snapshot_lock:
+            snapshots = list(self._snapshots)
+        for (before_label, before), (after_label, after) in zip(snapshots, snapshots[1:]):
+            diff = after.compare_to(before, 'lineno')
+            total = sum(stat.size_diff for stat in diff)
+            lines.append(f'  {before_label} -> {after_label}: {total / 1048576:+.1f} MB')
+            for stat in diff[:5]:
+                lines.append(f'    {stat}')
+
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
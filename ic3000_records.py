@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+IC3000 Records - compact device and result records for large runs
+
+Inventory rows and per-device results live in memory for the whole run, so
+they use __slots__ classes instead of dicts, and the handful of status and
+operation values are interned constants shared by every record. Device also
+resolves the display name once instead of repeating the
+DeviceName/Hostname/IPAddress fallback wherever a name is needed.
+"""
+
+import csv
+import sys
+from typing import Dict, List, Optional
+
+from ic3000_schedule import parse_priority, parse_window
+
+
+# Result statuses (interned: every record shares the same string objects)
+SUCCESS = sys.intern('Success')
+WARNING = sys.intern('Warning')
+FAILED = sys.intern('Failed')
+TIMEOUT = sys.intern('Timeout')
+SKIPPED = sys.intern('Skipped')
+CANCELLED = sys.intern('Cancelled')
+SITE_UNREACHABLE = sys.intern('SiteUnreachable')
+
+OPERATION_LABELS = {
+    'ntp': sys.intern('NTP'),
+    'upgrade': sys.intern('Upgrade'),
+    'apply': sys.intern('Apply'),
+    'stage': sys.intern('Stage'),
+    'install': sys.intern('Install'),
+}
+
+# Columns written to the per-run result CSV; Phases and FinishedAt go to the run history only
+RESULT_FIELDS = ['DeviceName', 'IPAddress', 'Operation', 'Target', 'Status', 'Message', 'Duration']
+
+
+def _value(text):
+    """Empty CSV cells become None; repeated values (sites, servers, windows) are interned"""
+    if text is None:
+        return None
+    text = text.strip()
+    return sys.intern(text) if text else None
+
+
+class Device:
+    """One inventory row"""
+
+    __slots__ = ('name', 'ip', 'username', 'password', 'ntp_server', 'firmware', 'verify',
+                 'window', 'priority', 'extra')
+
+    # CSV column -> attribute, for get()
+    COLUMNS = {
+        'DeviceName': 'name',
+        'IPAddress': 'ip',
+        'Username': 'username',
+        'Password': 'password',
+        'NTPServer': 'ntp_server',
+        'Firmware': 'firmware',
+        'Verify': 'verify',
+        'Window': 'window',
+        'Priority': 'priority',
+    }
+
+    def __init__(self, ip: str, username: str = '', password: str = '', name: Optional[str] = None,
+                 ntp_server: Optional[str] = None, firmware: Optional[str] = None, verify: Optional[str] = None,
+                 window: Optional[str] = None, priority: int = 0, extra: Optional[Dict[str, str]] = None):
+        self.ip = ip
+        self.username = username
+        self.password = password
+        self.name = name or ip
+        self.ntp_server = ntp_server
+        self.firmware = firmware
+        self.verify = verify
+        self.window = window
+        self.priority = priority
+        self.extra = extra  # other non-empty columns (Site, Group, ...), None if there are none
+
+    @classmethod
+    def from_row(cls, row: Dict[str, str]) -> 'Device':
+        ip = (row.get('IPAddress') or '').strip()
+        if not ip:
+            raise ValueError('missing IPAddress')
+        known = set(cls.COLUMNS) | {'Hostname'}
+        extra = {sys.intern(k): _value(v) for k, v in row.items()
+                 if k is not None and k not in known and _value(v) is not None}
+        return cls(
+            ip=ip,
+            username=_value(row.get('Username')) or '',
+            password=row.get('Password') or '',  # never interned
+            name=(row.get('DeviceName') or row.get('Hostname') or '').strip() or None,
+            ntp_server=_value(row.get('NTPServer')),
+            firmware=_value(row.get('Firmware')),
+            # An empty Verify cell means "no verification", unlike a missing column
+            verify=row['Verify'].strip() if row.get('Verify') is not None else None,
+            window=_value(row.get('Window')),
+            priority=parse_priority(row.get('Priority')),
+            extra=extra or None,
+        )
+
+    def get(self, column: str, default=None):
+        """Value of a CSV column by its header name (e.g. a configurable Site column)"""
+        attr = self.COLUMNS.get(column)
+        if attr is not None:
+            value = getattr(self, attr)
+        else:
+            value = self.extra.get(column) if self.extra else None
+        return default if value is None else value
+
+    def __repr__(self):
+        # Deliberately leaves out the password
+        return f'Device({self.name!r}, {self.ip!r})'
+
+
+class DeviceResult:
+    """Outcome of one operation on one device"""
+
+    __slots__ = ('device_name', 'ip', 'operation', 'target', 'status', 'message', 'duration',
+                 'phases', 'finished_at', 'unreachable')
+
+    def __init__(self, device: Device, operation: str, target: str = '', status: str = FAILED,
+                 message: str = ''):
+        self.device_name = device.name
+        self.ip = device.ip
+        self.operation = operation
+        self.target = target or ''
+        self.status = status
+        self.message = message
+        self.duration = None
+        self.phases = None
+        self.finished_at = None
+        self.unreachable = False  # the last reachability check or login could not connect (see SiteBreaker)
+
+    def as_row(self) -> Dict:
+        """Result CSV row (RESULT_FIELDS)"""
+        return {
+            'DeviceName': self.device_name,
+            'IPAddress': self.ip,
+            'Operation': self.operation,
+            'Target': self.target,
+            'Status': self.status,
+            'Message': self.message,
+            'Duration': self.duration if self.duration is not None else '',
+        }
+
+    def to_dict(self) -> Dict:
+        """Full record for the JSON log"""
+        row = self.as_row()
+        row['Phases'] = self.phases or {}
+        row['FinishedAt'] = self.finished_at
+        return row
+
+    @classmethod
+    def from_dict(cls, row: Dict) -> 'DeviceResult':
+        """Inverse of to_dict(), e.g. for results reported by a remote worker"""
+        status = row.get('Status') or FAILED
+        result = cls(Device(row['IPAddress'], name=row.get('DeviceName')), sys.intern(row.get('Operation') or ''),
+                     target=row.get('Target') or '', status=sys.intern(status), message=row.get('Message') or '')
+        if row.get('Duration') not in (None, ''):
+            result.duration = float(row['Duration'])
+        result.phases = row.get('Phases') or {}
+        result.finished_at = row.get('FinishedAt')
+        return result
+
+    def __repr__(self):
+        return f'DeviceResult({self.ip!r}, {self.operation!r}, {self.status!r})'
+
+
+def read_devices(csv_file: str) -> List[Device]:
+    """
+    Inventory CSV rows as Device records
+
+    Optional scheduling columns are validated up front rather than mid-run;
+    a bad row raises ValueError naming its line.
+    """
+    devices = []
+    with open(csv_file, 'r') as f:
+        for row_num, row in enumerate(csv.DictReader(f), 2):
+            try:
+                device = Device.from_row(row)
+                parse_window(device.window)
+            except ValueError as e:
+                raise ValueError(f'{csv_file} line {row_num}: {e}')
+            devices.append(device)
+    return devices
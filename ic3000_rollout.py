@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+IC3000 Rollout - automated canary cohort, ramp-up and failure circuit breaker
+
+Replaces the interactive "Press Enter to continue" between batches for
+unattended runs:
+  1. A canary cohort is picked across sites (Site column, else /24 subnet)
+     instead of the first CSV rows.
+  2. If the canary passes, the remaining devices run in cohorts that grow by
+     ramp_factor each time.
+  3. A FailureBreaker watches every result; when the rolling failure rate or
+     the total failure count crosses its threshold the run halts, in-flight
+     devices finish and queued devices are left untouched.
+
+Independently, a SiteBreaker (site_breaker config section) fast-fails the
+devices behind a dead site link instead of letting each of them wait out
+the connect timeout, and AvailabilityGroups (availability config section)
+keeps at most max_unavailable members of each redundancy group rebooting at
+once, handing free workers to other groups instead.
+"""
+
+from collections import deque, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from ic3000_records import Device, DeviceResult, SUCCESS, FAILED, TIMEOUT, CANCELLED, SKIPPED, SITE_UNREACHABLE
+
+
+# Statuses that count against the breaker; Warning, Skipped, Cancelled and SiteUnreachable do not
+FAILURE_STATUSES = (FAILED, TIMEOUT)
+
+
+def spread_key(device: Device, spread_by: Optional[str] = 'Site') -> str:
+    """Site of a device for canary spreading; falls back to its /24 subnet"""
+    if spread_by and device.get(spread_by):
+        return str(device.get(spread_by))
+    return '.'.join(device.ip.split('.')[:3])
+
+
+def select_canaries(devices: List[Device], size: int, spread_by: Optional[str] = 'Site') -> List[Device]:
+    """
+    Pick `size` devices round-robin across sites, largest sites first
+
+    Order within a site is preserved, so Priority ordering still applies.
+    """
+    sites = OrderedDict()
+    for device in devices:
+        sites.setdefault(spread_key(device, spread_by), deque()).append(device)
+    queues = sorted(sites.values(), key=len, reverse=True)
+
+    canaries = []
+    while len(canaries) < size and any(queues):
+        for q in queues:
+            if q and len(canaries) < size:
+                canaries.append(q.popleft())
+    return canaries
+
+
+def plan_cohorts(devices: List[Device], canary_size: int, ramp_factor: float = 2.0,
+                 spread_by: Optional[str] = 'Site') -> List[List[Device]]:
+    """Canary cohort first, then cohorts growing by ramp_factor over the rest"""
+    if canary_size <= 0 or canary_size >= len(devices):
+        return [devices]
+
+    canaries = select_canaries(devices, canary_size, spread_by)
+    chosen = set(id(d) for d in canaries)
+    rest = [d for d in devices if id(d) not in chosen]
+
+    cohorts = [canaries]
+    size = float(canary_size)
+    while rest:
+        size *= max(ramp_factor, 1.0)
+        take = max(1, int(size))
+        cohorts.append(rest[:take])
+        rest = rest[take:]
+    return cohorts
+
+
+class FailureBreaker:
+    """
+    Trips when the failure rate over the last `window` results reaches
+    max_failure_rate (once min_samples results are in), or when the total
+    number of failures reaches max_failures. A threshold of 0 disables it.
+    """
+
+    def __init__(self, max_failure_rate: float = 0.0, window: int = 20, min_samples: int = 5,
+                 max_failures: int = 0):
+        self.max_failure_rate = max_failure_rate
+        self.min_samples = min_samples
+        self.max_failures = max_failures
+        self.recent = deque(maxlen=window)
+        self.failures = 0
+        self.reason = None
+
+    @property
+    def tripped(self) -> bool:
+        return self.reason is not None
+
+    def record(self, status: str):
+        failed = status in FAILURE_STATUSES
+        self.recent.append(failed)
+        if failed:
+            self.failures += 1
+        if self.reason is not None:
+            return
+
+        if self.max_failures and self.failures >= self.max_failures:
+            self.reason = f'{self.failures} failures reached the limit of {self.max_failures}'
+        elif self.max_failure_rate and len(self.recent) >= self.min_samples:
+            rate = sum(self.recent) / len(self.recent)
+            if rate >= self.max_failure_rate:
+                self.reason = (f'failure rate {rate:.0%} over the last {len(self.recent)} devices '
+                               f'reached the limit of {self.max_failure_rate:.0%}')
+
+    def trip(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+
+def is_connection_failure(result: DeviceResult) -> bool:
+    """A failure where the device could not be connected to at all (result.unreachable, set from the client)"""
+    return result.status in FAILURE_STATUSES and result.unreachable
+
+
+class SiteBreaker:
+    """
+    Per-site circuit breakers (site = group_by column, else /24 subnet)
+
+    After `threshold` consecutive connection failures in a site, its breaker
+    opens: queued devices of that site are held back instead of dispatched.
+    Once `cooldown` seconds have passed, one held device is sent as a
+    half-open probe. If it reaches the device (or any device of the site
+    answers meanwhile) the site closes and its held devices are queued again;
+    if not, the breaker re-opens for another cooldown. After `max_probes`
+    failed probes the site's held devices are given up as SiteUnreachable.
+    State persists across batches of a run.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold: int = 3, cooldown: float = 120, max_probes: int = 2,
+                 group_by: Optional[str] = 'Site'):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_probes = max_probes
+        self.group_by = group_by
+        self.failures = {}  # site -> consecutive connection failures
+        self.state = {}  # site -> CLOSED / OPEN / HALF_OPEN
+        self.opened_at = {}  # site -> monotonic time the breaker (re)opened
+        self.probes = {}  # site -> probes sent
+        self.probing = {}  # site -> ip of the probe in flight
+        self.held = {}  # site -> [devices] waiting for the site to close
+
+    def site(self, device: Device) -> str:
+        return spread_key(device, self.group_by)
+
+    @property
+    def held_count(self) -> int:
+        return sum(len(devices) for devices in self.held.values())
+
+    def admit(self, device: Device) -> bool:
+        """True if the device may be dispatched; False if it is held because its site is open"""
+        site = self.site(device)
+        if self.state.get(site, self.CLOSED) == self.CLOSED:
+            return True
+        self.held.setdefault(site, []).append(device)
+        return False
+
+    def next_probe(self, now: float, eligible=None) -> Optional[Device]:
+        """
+        A held device of an open site whose cooldown has passed, or None
+
+        Only devices that eligible(device) accepts are picked; the dispatcher
+        passes the scheduler's window and --until checks (and group room).
+        """
+        for site, state in self.state.items():
+            if (state == self.OPEN and self.held.get(site) and self.probes[site] < self.max_probes
+                    and now - self.opened_at[site] >= self.cooldown):
+                device = next((d for d in self.held[site] if eligible is None or eligible(d)), None)
+                if device is None:
+                    continue
+                self.held[site].remove(device)
+                self.state[site] = self.HALF_OPEN
+                self.probes[site] += 1
+                self.probing[site] = device.ip
+                return device
+        return None
+
+    def seconds_until_probe(self, now: float, eligible=None) -> Optional[float]:
+        """Wait until the next possible probe; None if no held site has probes (or eligible devices) left"""
+        waits = [max(0.0, self.opened_at[site] + self.cooldown - now) for site, state in self.state.items()
+                 if state == self.OPEN and self.probes[site] < self.max_probes
+                 and any(eligible is None or eligible(d) for d in self.held.get(site, ()))]
+        return min(waits) if waits else None
+
+    def give_up(self) -> List[Tuple[str, Device]]:
+        """Held devices of sites that stay open, as (site, device); they are no longer held"""
+        given_up = [(site, device) for site, devices in self.held.items() for device in devices]
+        self.held.clear()
+        return given_up
+
+    def record(self, device: Device, result: DeviceResult, now: float) -> Tuple[Optional[str], List[Device]]:
+        """
+        Feed one result
+        Returns: (event message or None, devices released by the site closing)
+        """
+        site = self.site(device)
+        state = self.state.get(site, self.CLOSED)
+        probe = self.probing.get(site) == device.ip
+        if probe:
+            del self.probing[site]
+
+        if is_connection_failure(result) or (probe and result.status == TIMEOUT):
+            self.failures[site] = self.failures.get(site, 0) + 1
+            if state == self.HALF_OPEN and probe:
+                self.state[site] = self.OPEN
+                self.opened_at[site] = now
+                return f'Site {site}: probe {device.ip} failed, breaker stays open ({len(self.held.get(site, []))} held)', []
+            if state == self.CLOSED and self.failures[site] >= self.threshold:
+                self.state[site] = self.OPEN
+                self.opened_at[site] = now
+                self.probes.setdefault(site, 0)
+                return (f'Site {site}: {self.failures[site]} consecutive connection failures, breaker open - '
+                        f'its queued devices are held as {SITE_UNREACHABLE}'), []
+            return None, []
+
+        if result.status in (TIMEOUT, CANCELLED, SKIPPED, SITE_UNREACHABLE):
+            return None, []  # says nothing about the link
+
+        # The device answered: the site link is up
+        self.failures[site] = 0
+        if state == self.CLOSED:
+            return None, []
+        self.state[site] = self.CLOSED
+        released = self.held.pop(site, [])
+        return f'Site {site}: {device.ip} reachable again, breaker closed, {len(released)} devices released', released
+
+
+class AvailabilityGroups:
+    """
+    Max-unavailable limits for redundancy groups (Group column: pair, cluster)
+
+    A grouped device counts as unavailable from dispatch until its result
+    shows it back in service: it succeeded (the post-install check passed),
+    or it failed before anything was installed. A device that failed or timed
+    out after its install stays unavailable for the rest of the run. Devices
+    of a group at its limit are held; each released member lets one of them
+    back into the queue. Devices without a group are not limited.
+    """
+
+    def __init__(self, max_unavailable: int = 1, group_by: str = 'Group', limits: Optional[Dict[str, int]] = None):
+        self.max_unavailable = max(1, int(max_unavailable))
+        self.group_by = group_by
+        self.limits = {group: max(1, int(limit)) for group, limit in (limits or {}).items()}
+        self.down = {}  # group -> ips unavailable right now
+        self.lost = {}  # group -> ips that did not come back (failed after install)
+        self.held = {}  # group -> [devices] waiting for a member to come back
+
+    def group(self, device) -> str:
+        return (device.get(self.group_by) or '').strip()
+
+    def limit(self, group: str) -> int:
+        return self.limits.get(group, self.max_unavailable)
+
+    def capacity(self, devices) -> int:
+        """Devices that may be unavailable at once across the fleet (standalone devices count fully)"""
+        sizes = {}
+        standalone = 0
+        for device in devices:
+            group = self.group(device)
+            if group:
+                sizes[group] = sizes.get(group, 0) + 1
+            else:
+                standalone += 1
+        return standalone + sum(min(size, self.limit(group)) for group, size in sizes.items())
+
+    @property
+    def held_count(self) -> int:
+        return sum(len(devices) for devices in self.held.values())
+
+    def has_room(self, device) -> bool:
+        group = self.group(device)
+        return not group or len(self.down.get(group, ())) < self.limit(group)
+
+    def admit(self, device) -> bool:
+        """True if the device may be dispatched (it now counts as unavailable); False if it is held"""
+        group = self.group(device)
+        if not group:
+            return True
+        if not self.has_room(device):
+            self.held.setdefault(group, []).append(device)
+            return False
+        self.down.setdefault(group, set()).add(device.ip)
+        return True
+
+    def release(self, device, result) -> Tuple[Optional[str], List]:
+        """
+        Feed the result of a dispatched device
+        Returns: (event message or None, held devices that may be queued again)
+        """
+        group = self.group(device)
+        if device.ip not in self.down.get(group, ()):
+            return None, []
+        # Timeout results carry no phases: the device may be mid-install, so assume it is
+        installed = result.status == TIMEOUT or 'install' in (result.phases or {})
+        if result.status != SUCCESS and installed:
+            self.lost.setdefault(group, set()).add(device.ip)
+            return (f'Group {group}: {device.ip} not back in service ({result.status}), still counted unavailable '
+                    f'({len(self.down[group])}/{self.limit(group)})'), []
+        self.down[group].discard(device.ip)
+        held = self.held.get(group)
+        return None, [held.pop(0)] if held else []
+
+    def give_up(self) -> List[Tuple[str, object]]:
+        """Held devices whose group never got below its limit, as (group, device); they are no longer held"""
+        given_up = [(group, device) for group, devices in self.held.items() for device in devices]
+        self.held.clear()
+        return given_up
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+IC3000 Scheduler - maintenance-window and priority aware device dispatch
+
+Devices may carry two optional inventory columns:
+  Window    daily maintenance window(s) in local time, e.g. "22:00-04:00" or
+            "01:00-03:00, 13:00-14:00". Windows may wrap midnight. Empty = any time.
+  Priority  integer, higher is dispatched first (default 0). Ties keep CSV order.
+
+DeviceScheduler hands the dispatcher the highest-priority device whose window
+is open right now, so workers stay busy with whatever is eligible instead of
+waiting on CSV order. Redundancy groups (Group column) are limited by
+ic3000_rollout.AvailabilityGroups.
+"""
+
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+
+Window = Tuple[int, int]  # (start, end) in minutes since midnight
+
+
+def parse_window(text: str) -> Optional[List[Window]]:
+    """Parse a Window column value; returns None for "any time" """
+    if text is None or not text.strip():
+        return None
+    windows = []
+    for part in text.split(','):
+        part = part.strip()
+        try:
+            start, end = (_parse_hhmm(t) for t in part.split('-'))
+        except ValueError:
+            raise ValueError(f'Invalid maintenance window "{part}" (expected HH:MM-HH:MM)')
+        if start == end:
+            raise ValueError(f'Empty maintenance window "{part}"')
+        windows.append((start, end))
+    return windows
+
+
+def _parse_hhmm(text: str) -> int:
+    hours, minutes = text.strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59):
+        raise ValueError(text)
+    return hours * 60 + minutes
+
+
+def parse_priority(text) -> int:
+    if text is None or str(text).strip() == '':
+        return 0
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f'Invalid priority "{text}" (expected an integer)')
+
+
+def in_window(windows: Optional[List[Window]], now: datetime) -> bool:
+    if windows is None:
+        return True
+    minute = now.hour * 60 + now.minute
+    for start, end in windows:
+        if start < end:
+            if start <= minute < end:
+                return True
+        elif minute >= start or minute < end:  # wraps midnight
+            return True
+    return False
+
+
+def seconds_until_open(windows: Optional[List[Window]], now: datetime) -> float:
+    if in_window(windows, now):
+        return 0.0
+    minute_start = now.replace(second=0, microsecond=0)
+    best = None
+    for start, _ in windows:
+        opens = minute_start.replace(hour=start // 60, minute=start % 60)
+        if opens <= now:
+            opens += timedelta(days=1)
+        if best is None or opens < best:
+            best = opens
+    return (best - now).total_seconds()
+
+
+def parse_until(text: str, now: Optional[datetime] = None) -> datetime:
+    """--until HH:MM: the next occurrence of that local time"""
+    now = now or datetime.now()
+    minute = _parse_hhmm(text)
+    until = now.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    if until <= now:
+        until += timedelta(days=1)
+    return until
+
+
+class DeviceScheduler:
+    """
+    Pending devices grouped by maintenance window, each group a priority heap
+
+    pop_next() looks only at the head of each open group, so dispatch stays
+    cheap with very large inventories (there are few distinct windows).
+    """
+
+    def __init__(self, devices: List, until: Optional[datetime] = None):
+        self.until = until
+        self._groups = {}  # window text -> (parsed windows, heap of (-priority, seq, device))
+        self._count = 0
+        self._seq = itertools.count()
+        for device in devices:
+            key = device.window or ''
+            if key not in self._groups:
+                self._groups[key] = (parse_window(key), [])
+            self._groups[key][1].append((-device.priority, next(self._seq), device))
+            self._count += 1
+        for _, heap in self._groups.values():
+            heapq.heapify(heap)
+
+    def __len__(self):
+        return self._count
+
+    def pop_next(self, now: datetime):
+        """Highest-priority device whose window is open now, or None"""
+        if self.until is not None and now >= self.until:
+            return None
+        best = None
+        for windows, heap in self._groups.values():
+            if heap and in_window(windows, now) and (best is None or heap[0] < best[0]):
+                best = (heap[0], heap)
+        if best is None:
+            return None
+        self._count -= 1
+        return heapq.heappop(best[1])[2]
+
+    def eligible(self, device, now: datetime) -> bool:
+        """Whether pop_next() could hand out `device` now: before the cut-off and inside its window"""
+        if self.until is not None and now >= self.until:
+            return False
+        key = device.window or ''
+        windows = self._groups[key][0] if key in self._groups else parse_window(key)
+        return in_window(windows, now)
+
+    def push(self, device):
+        """Queue a device again (e.g. released by a site breaker), behind devices of equal priority"""
+        key = device.window or ''
+        if key not in self._groups:
+            self._groups[key] = (parse_window(key), [])
+        heapq.heappush(self._groups[key][1], (-device.priority, next(self._seq), device))
+        self._count += 1
+
+    def seconds_until_eligible(self, now: datetime) -> float:
+        waits = [seconds_until_open(windows, now) for windows, heap in self._groups.values() if heap]
+        return min(waits) if waits else 0.0
+
+    def expire(self, now: datetime) -> List:
+        """Once the --until cut-off has passed, drain and return every pending device"""
+        if self.until is None or now < self.until:
+            return []
+        return self.drain()
+
+    def drain(self) -> List:
+        devices = []
+        for _, heap in self._groups.values():
+            devices.extend(device for _, _, device in sorted(heap))
+            heap.clear()
+        self._count = 0
+        return devices
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+IC3000 Trace - span tracing of bulk runs, exported as Chrome/Perfetto trace JSON
+
+With tracing on (ic3000_auto.py --trace or output.trace), the manager records a
+span per device, the API clients record a span per phase (login, set_ntp,
+upload, install, ...) and per HTTP request (the individual login steps,
+PUT/GET calls), and the dispatcher records batches, batch delays and
+maintenance-window waits. Each worker slot gets its own track, so idle slots
+at batch barriers, stragglers and serialized logins are visible at a glance
+in https://ui.perfetto.dev or chrome://tracing.
+
+Spans are kept as tuples in memory and written once at the end of the run.
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit
+
+import requests
+
+
+DISPATCHER_TRACK = 0
+
+
+class NullTracer:
+    """Tracer used when tracing is off: spans cost one nullcontext"""
+
+    enabled = False
+
+    def span(self, name, cat='phase', **args):
+        return nullcontext(args)
+
+    def instant(self, name, cat='event', **args):
+        pass
+
+    def set_track(self, track):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class SpanTracer:
+    """Thread-safe collector of complete ("X") and instant ("i") trace events"""
+
+    enabled = True
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._t0 = time.perf_counter()
+        self._events = []  # (phase, name, cat, ts_us, dur_us, track, args)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tracks = {DISPATCHER_TRACK: 'dispatcher'}
+        self._other_tracks = {}  # thread ident -> track, for threads without a worker slot
+
+    def _now(self):
+        return (time.perf_counter() - self._t0) * 1e6
+
+    def set_track(self, track: int):
+        """Attribute spans recorded by the current thread to worker slot `track` (1-based)"""
+        self._local.track = track
+        with self._lock:
+            self._tracks.setdefault(track, f'worker {track}')
+
+    def _track(self):
+        track = getattr(self._local, 'track', None)
+        if track is not None:
+            return track
+        ident = threading.get_ident()
+        with self._lock:
+            track = self._other_tracks.get(ident)
+            if track is None:
+                if threading.current_thread() is threading.main_thread():
+                    track = DISPATCHER_TRACK
+                else:
+                    track = 1000 + len(self._other_tracks)
+                    self._tracks[track] = threading.current_thread().name
+                self._other_tracks[ident] = track
+        self._local.track = track
+        return track
+
+    @contextmanager
+    def span(self, name: str, cat: str = 'phase', **args):
+        """Record the enclosed block; the yielded dict can be filled with result args"""
+        start = self._now()
+        try:
+            yield args
+        except Exception as e:
+            args['error'] = str(e)[:200]
+            raise
+        finally:
+            event = ('X', name, cat, start, self._now() - start, self._track(), args)
+            with self._lock:
+                self._events.append(event)
+
+    def instant(self, name: str, cat: str = 'event', **args):
+        event = ('i', name, cat, self._now(), None, self._track(), args)
+        with self._lock:
+            self._events.append(event)
+
+    def write(self, path: str) -> str:
+        with self._lock:
+            events = list(self._events)
+            tracks = dict(self._tracks)
+
+        with open(path, 'w') as f:
+            f.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+            first = True
+            for track, name in sorted(tracks.items()):
+                for meta in ({'ph': 'M', 'name': 'thread_name', 'pid': self.pid, 'tid': track, 'args': {'name': name}},
+                             {'ph': 'M', 'name': 'thread_sort_index', 'pid': self.pid, 'tid': track, 'args': {'sort_index': track}}):
+                    f.write(('' if first else ',\n') + json.dumps(meta))
+                    first = False
+            for ph, name, cat, ts, dur, track, args in events:
+                event = {'ph': ph, 'name': name, 'cat': cat, 'ts': round(ts, 1), 'pid': self.pid, 'tid': track}
+                if ph == 'X':
+                    event['dur'] = round(dur, 1)
+                else:
+                    event['s'] = 't'
+                if args:
+                    event['args'] = args
+                f.write(('' if first else ',\n') + json.dumps(event, default=str))
+                first = False
+            f.write('\n]}\n')
+        return path
+
+
+class TracingAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter recording one span per HTTP request ("POST /iox/api/v2/hosting/tokenservice")
+
+    Sends through `inner` when given (a recording or replay adapter), else over HTTPS itself.
+    """
+
+    def __init__(self, tracer, inner=None, *args, **kwargs):
+        self.tracer = tracer
+        self.inner = inner
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        with self.tracer.span(f'{request.method} {url.path or "/"}', cat='http', port=url.port) as args:
+            if self.inner is not None:
+                response = self.inner.send(request, **kwargs)
+            else:
+                response = super().send(request, **kwargs)
+            args['status'] = response.status_code
+            return response
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+        super().close()
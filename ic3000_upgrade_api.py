@@ -7,12 +7,19 @@ Handles firmware/software upgrades via REST API
 import os
 import sys
 import requests
-from typing import Tuple, Any
-from ic3000_api_client import IC3000APIClient
+from typing import Dict, Tuple, Any, Optional
+from ic3000_api_client import IC3000APIClient, timed_phase, run_jsonl_batch, open_batch_source
 
 class IC3000UpgradeClient(IC3000APIClient):
     """Extended API client for software upgrades"""
     
+    def __init__(self, ip: str, username: str, password: str, timeout: Optional[int] = None,
+                 login_timeout: Optional[int] = None, upload_timeout: int = 300, install_timeout: int = 60):
+        super().__init__(ip, username, password, timeout=timeout, login_timeout=login_timeout)
+        self.upload_timeout = upload_timeout
+        self.install_timeout = install_timeout
+    
+    @timed_phase('upload')
     def upload_firmware(self, firmware_path: str) -> Tuple[bool, str]:
         """
         Upload firmware file to device
@@ -35,7 +42,7 @@ class IC3000UpgradeClient(IC3000APIClient):
         filesize = os.path.getsize(firmware_path)
         filesize_mb = filesize / (1024 * 1024)
         
-        print(f"      Uploading: {filename} ({filesize_mb:.1f} MB)")
+        self.log(f"      Uploading: {filename} ({filesize_mb:.1f} MB)")
         
         try:
             # Read file content
@@ -54,7 +61,7 @@ class IC3000UpgradeClient(IC3000APIClient):
                     "Origin": f"https://{self.ip}:8443",
                     "Referer": f"https://{self.ip}:8443/"
                 },
-                timeout=300  # 5 minutes timeout for large files
+                timeout=self.upload_timeout  # Large files need minutes, see timeouts.upload
             )
             
             if response.status_code in [200, 201, 204]:
@@ -65,6 +72,7 @@ class IC3000UpgradeClient(IC3000APIClient):
         except Exception as e:
             return False, f"Upload error: {str(e)}"
     
+    @timed_phase('install')
     def install_firmware(self, filename: str) -> Tuple[bool, str]:
         """
         Trigger firmware installation after upload
@@ -90,7 +98,7 @@ class IC3000UpgradeClient(IC3000APIClient):
                     "Origin": f"https://{self.ip}:8443",
                     "Referer": f"https://{self.ip}:8443/"
                 },
-                timeout=60  # Increased timeout
+                timeout=self.install_timeout
             )
             
             if response.status_code in [200, 201, 204]:
@@ -122,24 +130,53 @@ class IC3000UpgradeClient(IC3000APIClient):
         filename = os.path.basename(firmware_path)
         
         # Step 1: Upload
-        print(f"      [1/2] Uploading firmware...")
+        self.log(f"      [1/2] Uploading firmware...")
         success, message = self.upload_firmware(firmware_path)
         if not success:
             return False, f"Upload failed: {message}"
         
-        print(f"      ✓ {message}")
+        self.log(f"      ✓ {message}")
         
         # Step 2: Install
-        print(f"      [2/2] Triggering installation...")
+        self.log(f"      [2/2] Triggering installation...")
         success, message = self.install_firmware(filename)
         if not success:
             return False, f"Installation failed: {message}"
         
-        print(f"      ✓ {message}")
+        self.log(f"      ✓ {message}")
         
         return True, "Firmware upgrade completed successfully"
 
 
+def execute_batch_command(command: Dict) -> Tuple[bool, Any]:
+    """Run one --batch command: upgrade, upload (needs "firmware") or install (needs "filename" or "firmware")"""
+    action = command['action']
+    if action in ('upgrade', 'upload'):
+        firmware = command.get('firmware')
+        if not firmware or not os.path.exists(firmware):
+            return False, f"Firmware file not found: {firmware}"
+    elif action == 'install':
+        filename = command.get('filename') or os.path.basename(command.get('firmware') or '')
+        if not filename:
+            return False, 'Missing "filename"'
+    else:
+        return False, f"Unknown action: {action}"
+    
+    client = IC3000UpgradeClient(command['ip'], command.get('username', ''), command.get('password', ''))
+    # stdout carries the JSONL results; progress goes to stderr
+    client.log = lambda text: print(f"{command['ip']}: {text.strip()}", file=sys.stderr)
+    
+    success, message = client.login()
+    if not success:
+        return False, f"Auth: {message}"
+    
+    if action == 'upgrade':
+        return client.upgrade_firmware(command['firmware'])
+    if action == 'upload':
+        return client.upload_firmware(command['firmware'])
+    return client.install_firmware(filename)
+
+
 def main():
     import argparse
     
@@ -159,6 +196,9 @@ Examples:
   # Just install (already uploaded)
   python3 ic3000_upgrade_api.py 192.168.69.142 admin password \\
       --install IC3000-K9-1.5.1.SPA
+  
+  # Batch: JSONL commands (actions: upgrade, upload, install), JSONL results on stdout
+  python3 ic3000_upgrade_api.py --batch commands.jsonl --concurrency 3
 
 Warning:
   - Firmware upgrade will reboot the device!
@@ -168,17 +208,28 @@ Warning:
         """
     )
     
-    parser.add_argument('ip', help='Device IP address')
-    parser.add_argument('username', help='Username')
-    parser.add_argument('password', help='Password')
+    parser.add_argument('ip', nargs='?', help='Device IP address')
+    parser.add_argument('username', nargs='?', help='Username')
+    parser.add_argument('password', nargs='?', help='Password')
     
     parser.add_argument('--firmware', help='Path to firmware .bin file')
     parser.add_argument('--upload-only', action='store_true',
                        help='Only upload, do not trigger installation')
     parser.add_argument('--install', help='Install already uploaded firmware (filename)')
+    parser.add_argument('--batch', metavar='FILE',
+                       help='Read JSONL commands from FILE ("-" for stdin), write JSONL results to stdout')
+    parser.add_argument('--concurrency', type=int, default=3,
+                       help='Parallel devices in --batch mode (default: 3)')
     
     args = parser.parse_args()
     
+    if args.batch:
+        failed = run_jsonl_batch(open_batch_source(args.batch), execute_batch_command, args.concurrency)
+        sys.exit(1 if failed else 0)
+    
+    if not args.ip or not args.username or not args.password:
+        parser.error('ip, username and password are required unless --batch is used')
+    
     # Validate arguments
     if not args.firmware and not args.install:
         print("✗ Error: Must specify --firmware or --install")
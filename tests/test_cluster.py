@@ -0,0 +1,40 @@
+"""Cluster coordinator: unit packing, lease expiry and --listen parsing"""
+
+import time
+
+import pytest
+
+from ic3000_cluster import Coordinator, parse_listen
+from ic3000_records import Device, FAILED
+
+
+def device(ip, **extra):
+    return Device(ip, 'admin', 'secret', extra=extra or None)
+
+
+def test_groups_are_never_split_across_units():
+    devices = [device('10.0.0.1', Group='a'), device('10.0.0.2', Group='b'), device('10.0.0.3', Group='a'),
+               device('10.0.0.4'), device('10.0.0.5', Group='b')]
+    coordinator = Coordinator(devices, 'upgrade', unit_size=2, group_by='Group')
+    units = [unit.ips for unit in coordinator.units.values()]
+    assert units == [['10.0.0.1', '10.0.0.3'], ['10.0.0.2', '10.0.0.5'], ['10.0.0.4']]
+
+
+def test_expired_units_are_abandoned_without_any_worker():
+    coordinator = Coordinator([device('10.0.0.1')], 'ntp', lease_timeout=0.05, max_attempts=1)
+    assert coordinator.lease('w1', None) is not None
+    time.sleep(0.1)
+    coordinator.expire()
+    assert coordinator.done
+    results = coordinator.completed.get_nowait()
+    assert [r.status for r in results] == [FAILED]
+
+
+@pytest.mark.parametrize('listen, expected', [
+    ('0.0.0.0:8770', ('0.0.0.0', 8770)),
+    ('127.0.0.1', ('127.0.0.1', 8770)),
+    ('[::1]:9000', ('::1', 9000)),
+    (':9000', ('0.0.0.0', 9000)),
+])
+def test_parse_listen(listen, expected):
+    assert parse_listen(listen) == expected
@@ -0,0 +1,67 @@
+"""Agent session pool, job eviction and inventory credentials"""
+
+import time
+
+from ic3000_daemon import IC3000Agent, SessionPool, load_credentials
+from ic3000_upgrade_api import IC3000UpgradeClient
+
+
+def fake_login(self):
+    self.authenticated = True
+    return True, 'Authentication successful'
+
+
+def test_password_change_closes_the_old_session(monkeypatch):
+    monkeypatch.setattr(IC3000UpgradeClient, 'login', fake_login)
+    monkeypatch.setattr(IC3000UpgradeClient, 'get_system_info', lambda self: (True, {}))
+    pool = SessionPool()
+    pool.call('10.0.0.1', 'admin', 'old', 'get_system_info')
+    old = pool._entries[('10.0.0.1', 'admin')]['client']
+    closed = []
+    monkeypatch.setattr(old.session, 'close', lambda: closed.append(True))
+
+    pool.call('10.0.0.1', 'admin', 'new', 'get_system_info')
+    assert closed == [True]
+    assert pool.size() == 1
+
+
+def test_relogin_on_401_status(monkeypatch):
+    monkeypatch.setattr(IC3000UpgradeClient, 'login', fake_login)
+    calls = []
+
+    def get_ntp_config(self):
+        calls.append(self.authenticated)
+        if len(calls) == 1:
+            self.last_status = 401
+            return False, 'Token rejected'
+        return True, {'servers': []}
+
+    monkeypatch.setattr(IC3000UpgradeClient, 'get_ntp_config', get_ntp_config)
+    pool = SessionPool()
+    assert pool.call('10.0.0.1', 'admin', 'secret', 'get_ntp_config') == (True, {'servers': []})
+    assert pool.stats['refreshes'] == 1
+
+
+def test_no_relogin_for_a_message_mentioning_401(monkeypatch):
+    monkeypatch.setattr(IC3000UpgradeClient, 'login', fake_login)
+    monkeypatch.setattr(IC3000UpgradeClient, 'get_ntp_config', lambda self: (False, 'Server 10.0.0.401 invalid'))
+    pool = SessionPool()
+    pool.call('10.0.0.1', 'admin', 'secret', 'get_ntp_config')
+    assert pool.stats['refreshes'] == 0
+
+
+def test_finished_jobs_are_evicted_after_ttl():
+    agent = IC3000Agent(SessionPool(), job_ttl=60)
+    agent.jobs = {
+        '1': {'state': 'done', 'finished': time.time() - 120},
+        '2': {'state': 'failed', 'finished': time.time() - 10},
+        '3': {'state': 'running'},
+    }
+    agent.evict_jobs()
+    assert sorted(agent.jobs) == ['2', '3']
+
+
+def test_credentials_read_like_the_cli(tmp_path):
+    inventory = tmp_path / 'devices.csv'
+    inventory.write_text('Hostname,IPAddress,Username,Password\nic1, 10.0.0.1 ,admin,p@ss \n')
+    assert load_credentials(str(inventory)) == {'10.0.0.1': ('admin', 'p@ss ')}
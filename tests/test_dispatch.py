@@ -0,0 +1,39 @@
+"""Dispatcher: rows recorded by process_batch itself carry the device's target"""
+
+import time
+from datetime import datetime, timedelta
+
+import ic3000_auto
+from ic3000_records import Device, SKIPPED, TIMEOUT
+
+
+def make_manager(tmp_path):
+    config = ic3000_auto.IC3000Config(str(tmp_path / 'missing.yaml'))
+    config.config['output']['results_dir'] = str(tmp_path)
+    config.config['output']['verbose'] = 0
+    config.config['output']['show_progress'] = False
+    config.config['history']['enabled'] = False
+    config.config['ntp']['default_server'] = '10.0.0.250'
+    return ic3000_auto.IC3000Manager(config)
+
+
+def test_timeout_rows_carry_the_ntp_target(tmp_path, monkeypatch):
+    manager = make_manager(tmp_path)
+    monkeypatch.setattr(manager, 'configure_ntp', lambda device: time.sleep(5))
+    devices = [Device('10.0.0.1', ntp_server='10.0.0.1, 10.0.0.2'), Device('10.0.0.2')]
+    results = manager.process_batch(devices, 'ntp', max_workers=2, device_timeout=0.2)
+    assert {(r.status, r.target) for r in results} == {(TIMEOUT, '10.0.0.1, 10.0.0.2'), (TIMEOUT, '10.0.0.250')}
+
+
+def test_skipped_rows_carry_the_firmware_name(tmp_path):
+    manager = make_manager(tmp_path)
+    devices = [Device('10.0.0.1'), Device('10.0.0.2')]
+    results = manager.process_batch(devices, 'stage', firmware_path='/srv/fw/IC3000-K9-1.5.1.SPA',
+                                    until=datetime.now() - timedelta(minutes=1))
+    assert [(r.status, r.target) for r in results] == [(SKIPPED, 'IC3000-K9-1.5.1.SPA')] * 2
+
+
+def test_apply_target_lists_ntp_and_firmware(tmp_path):
+    manager = make_manager(tmp_path)
+    device = Device('10.0.0.1', firmware='/srv/fw/IC3000-K9-1.5.1.SPA')
+    assert manager.operation_target(device, 'apply') == 'NTP=10.0.0.250; FW=IC3000-K9-1.5.1.SPA'
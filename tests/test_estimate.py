@@ -0,0 +1,30 @@
+"""Run-time estimate: scheduler simulation and worker recommendation"""
+
+from ic3000_estimate import format_duration, percentile, recommend, simulate
+
+
+def test_simulate_list_scheduling_and_batches():
+    # Two workers: 4 on one slot, 3 then 2 on the other -> 5s; second batch 5s after a 10s delay
+    assert simulate([4, 3, 2, 5], workers=2, batch_sizes=[3, 1], batch_delay=10) == 5 + 10 + 5
+
+
+def test_simulate_caps_durations_at_the_device_timeout():
+    assert simulate([100, 1], workers=2, batch_sizes=[2], batch_delay=0, device_timeout=30) == 30
+
+
+def test_recommend_smallest_worker_count_that_fits():
+    totals = {1: [100.0, 110.0], 2: [55.0, 60.0], 4: [30.0, 31.0]}
+    assert recommend(totals, window_seconds=60) == 2
+    assert recommend(totals, window_seconds=10) is None
+
+
+def test_percentile_nearest_rank():
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 0.9) == 5.0
+    assert percentile([1.0, 2.0, 3.0, 4.0, 5.0], 0.5) == 3.0
+    assert percentile([], 0.9) == 0.0
+
+
+def test_format_duration():
+    assert format_duration(42) == '42s'
+    assert format_duration(125) == '2m05s'
+    assert format_duration(3720) == '1h02m'
@@ -0,0 +1,21 @@
+"""Firmware version parsing and comparison"""
+
+from ic3000_firmware import compare_versions, parse_version, running_version
+
+
+def test_parse_version():
+    assert parse_version('IC3000-K9-1.5.1.SPA') == (1, 5, 1)
+    assert parse_version('1.5') == (1, 5)
+    assert parse_version('no version here') is None
+    assert parse_version(None) is None
+
+
+def test_compare_versions_pads_the_shorter_one():
+    assert compare_versions((1, 5), (1, 5, 0)) == 0
+    assert compare_versions((1, 5), (1, 5, 1)) == -1
+    assert compare_versions((1, 10), (1, 9, 9)) == 1
+
+
+def test_running_version_from_system_info():
+    assert running_version({'system': {'firmware_version': '1.4.2'}}) == (1, 4, 2)
+    assert running_version('IOx version 1.5.0') == (1, 5, 0)
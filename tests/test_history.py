@@ -0,0 +1,41 @@
+"""Run history: failure selection for --retry-failed and --failing"""
+
+from ic3000_history import RunHistory, default_db_path
+from ic3000_records import Device, DeviceResult
+
+
+def record_run(history, outcomes):
+    run_id = history.start_run('Upgrade', len(outcomes))
+    results = []
+    for ip, status in outcomes.items():
+        result = DeviceResult(Device(ip), 'Upgrade', status=status)
+        result.finished_at = f'2024-05-01T00:00:{run_id:02d}'
+        results.append(result)
+    history.record(run_id, results)
+    history.finish_run(run_id)
+
+
+def test_only_attempted_failures_are_selected(tmp_path):
+    history = RunHistory(str(tmp_path / 'history.db'))
+    record_run(history, {'10.0.0.1': 'Failed', '10.0.0.2': 'Skipped', '10.0.0.3': 'Cancelled',
+                         '10.0.0.4': 'SiteUnreachable', '10.0.0.5': 'Timeout', '10.0.0.6': 'Warning',
+                         '10.0.0.7': 'Success'})
+    assert sorted(history.last_run_failures('Upgrade')) == ['10.0.0.1', '10.0.0.5', '10.0.0.6']
+
+
+def test_skipped_runs_neither_count_nor_break_a_streak(tmp_path):
+    history = RunHistory(str(tmp_path / 'history.db'))
+    record_run(history, {'10.0.0.1': 'Failed', '10.0.0.2': 'Skipped'})
+    record_run(history, {'10.0.0.1': 'Skipped', '10.0.0.2': 'Skipped'})
+    record_run(history, {'10.0.0.1': 'Timeout', '10.0.0.2': 'Cancelled'})
+    assert history.consecutive_failures('Upgrade', 2) == {'10.0.0.1': 2}
+
+
+class Config(dict):
+    def get(self, key, default=None):
+        return super().get(key) or default
+
+
+def test_default_db_path_follows_the_configuration():
+    assert default_db_path(Config({'output.results_dir': '/srv/ic3000'})) == '/srv/ic3000/ic3000_history.db'
+    assert default_db_path(Config({'history.db': '/var/lib/h.db', 'output.results_dir': '/srv'})) == '/var/lib/h.db'
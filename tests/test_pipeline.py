@@ -0,0 +1,89 @@
+"""Pipelined upgrades: stage limits and in-flight accounting"""
+
+import threading
+import time
+
+import pytest
+
+import ic3000_auto
+from ic3000_upgrade_api import IC3000UpgradeClient
+from ic3000_pipeline import StageCancelled, StageGate
+from ic3000_records import Device, SUCCESS
+
+UPLOAD_SECONDS = 0.1
+REBOOT_SECONDS = 1.0
+
+
+def make_manager(tmp_path):
+    config = ic3000_auto.IC3000Config(str(tmp_path / 'missing.yaml'))
+    config.config['output']['results_dir'] = str(tmp_path)
+    config.config['output']['verbose'] = 0
+    config.config['output']['show_progress'] = False
+    config.config['history']['enabled'] = False
+    return ic3000_auto.IC3000Manager(config)
+
+
+def test_upload_stage_stays_busy_while_devices_reboot(tmp_path, monkeypatch):
+    uploads = []
+    lock = threading.Lock()
+
+    def upload_firmware(self, firmware_path):
+        time.sleep(UPLOAD_SECONDS)
+        with lock:
+            uploads.append(time.monotonic())
+        return True, 'Uploaded'
+
+    monkeypatch.setattr(IC3000UpgradeClient, 'check_reachable', lambda self: (True, 'Port 8443 reachable'))
+    monkeypatch.setattr(IC3000UpgradeClient, 'login', lambda self: (True, 'Authenticated'))
+    monkeypatch.setattr(IC3000UpgradeClient, 'upload_firmware', upload_firmware)
+    monkeypatch.setattr(IC3000UpgradeClient, 'install_firmware', lambda self, name: (True, 'Installing'))
+
+    manager = make_manager(tmp_path)
+    monkeypatch.setattr(manager, '_verify_after_install',
+                        lambda client, timeout, expected=None: (time.sleep(REBOOT_SECONDS), (True, 'back'))[1])
+
+    devices = [Device(f'10.0.0.{i}', 'admin', 'secret', name=f'ic{i}') for i in range(1, 13)]
+    limits = {'login': 2, 'upload': 2}
+    start = time.monotonic()
+    results = manager.process_batch(devices, 'upgrade', firmware_path='/fw/ic3000-1.2.0.SPA', pipeline=True,
+                                    stage_limits=limits, max_workers=limits['login'] + limits['upload'])
+    elapsed = time.monotonic() - start
+
+    assert [r.status for r in results] == [SUCCESS] * len(devices)
+    # 12 uploads, 2 at a time: 0.6s of upload work. Had rebooting devices held their
+    # in-flight place, uploads would stall for a reboot after every 4 devices (~3s)
+    assert uploads[-1] - start < 6 * UPLOAD_SECONDS + 0.6
+    assert elapsed < uploads[-1] - start + REBOOT_SECONDS + 0.6
+
+
+def test_stage_gate_limits_concurrency():
+    gate = StageGate('upload', 2)
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def device():
+        gate.acquire()
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+        gate.release()
+
+    threads = [threading.Thread(target=device) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
+    assert gate.passed == 6
+
+
+def test_cancelled_while_queued():
+    gate = StageGate('upload', 1)
+    gate.acquire()
+    with pytest.raises(StageCancelled):
+        gate.acquire(cancelled=lambda: True)
+    assert gate.active == 1
@@ -0,0 +1,37 @@
+"""Run profiler: per-thread profiles merged into one pstats"""
+
+import pstats
+import sys
+import threading
+import time
+
+import pytest
+
+from ic3000_profile import RunProfiler
+
+
+def work():
+    return sum(i * i for i in range(2000))
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 12), reason='one profile covers every thread from 3.12')
+def test_finished_threads_merged_live_threads_left_out(tmp_path):
+    profiler = RunProfiler(str(tmp_path), 'run')
+    profiler.start()
+    stop = threading.Event()
+    try:
+        threads = [threading.Thread(target=work, name=f'ic3000-device-10.0.0.{i}') for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        live = threading.Thread(target=lambda: stop.wait(5), name='ic3000-device-10.0.0.99', daemon=True)
+        live.start()
+        time.sleep(0.05)
+        paths = profiler.stop()
+    finally:
+        stop.set()
+
+    assert profiler.unmerged_threads == 1
+    calls = {key[2]: value[1] for key, value in pstats.Stats(paths['pstats']).stats.items()}
+    assert calls['work'] == 5
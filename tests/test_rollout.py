@@ -0,0 +1,121 @@
+"""Site breaker and availability groups"""
+
+from ic3000_records import Device, DeviceResult, FAILED, SUCCESS, TIMEOUT, WARNING
+from ic3000_rollout import AvailabilityGroups, SiteBreaker
+
+
+def device(ip, site='S1'):
+    return Device(ip, 'admin', 'secret', extra={'Site': site})
+
+
+def failure(dev, unreachable=True):
+    result = DeviceResult(dev, 'NTP Configuration', status=FAILED, message='Unreachable: connection timeout')
+    result.unreachable = unreachable
+    return result
+
+
+def open_breaker(breaker, now=0.0):
+    for i in range(breaker.threshold):
+        breaker.record(device(f'10.0.0.{i}'), failure(device(f'10.0.0.{i}')), now)
+
+
+def test_opens_after_consecutive_connection_failures():
+    breaker = SiteBreaker(threshold=3, cooldown=10)
+    open_breaker(breaker)
+    assert not breaker.admit(device('10.0.0.9'))
+    assert breaker.admit(device('10.0.1.9', site='S2'))
+    assert breaker.held_count == 1
+
+
+def test_only_unreachable_failures_count():
+    breaker = SiteBreaker(threshold=2, cooldown=10)
+    for i in range(5):
+        dev = device(f'10.0.0.{i}')
+        # Same message, but the client connected: not a connection failure
+        breaker.record(dev, failure(dev, unreachable=False), 0.0)
+    assert breaker.admit(device('10.0.0.9'))
+
+
+def test_probe_respects_cooldown_and_eligibility():
+    breaker = SiteBreaker(threshold=3, cooldown=10)
+    open_breaker(breaker)
+    outside, inside = device('10.0.0.8'), device('10.0.0.9')
+    breaker.admit(outside)
+    breaker.admit(inside)
+    assert breaker.next_probe(5.0) is None
+    assert breaker.next_probe(11.0, lambda d: False) is None
+    assert breaker.seconds_until_probe(11.0, lambda d: False) is None
+    assert breaker.next_probe(11.0, lambda d: d is inside) is inside
+
+
+def test_successful_probe_releases_held_devices():
+    breaker = SiteBreaker(threshold=3, cooldown=10)
+    open_breaker(breaker)
+    held = [device('10.0.0.8'), device('10.0.0.9')]
+    for dev in held:
+        breaker.admit(dev)
+    probe = breaker.next_probe(11.0)
+    event, released = breaker.record(probe, DeviceResult(probe, 'NTP Configuration', status=SUCCESS), 12.0)
+    assert 'breaker closed' in event
+    assert released == [d for d in held if d is not probe]
+    assert breaker.admit(device('10.0.0.7'))
+
+
+def grouped(ip, group):
+    return Device(ip, 'admin', 'secret', extra={'Group': group} if group else None)
+
+
+def installed(dev, status):
+    result = DeviceResult(dev, 'Upgrade', status=status)
+    result.phases = {'login': 0.1, 'upload': 1.0, 'install': 0.2}
+    return result
+
+
+def test_group_admits_up_to_its_limit_and_holds_the_rest():
+    groups = AvailabilityGroups(max_unavailable=1, limits={'pair-b': 2})
+    a1, a2, b1, b2, lone = (grouped('10.0.0.1', 'pair-a'), grouped('10.0.0.2', 'pair-a'),
+                            grouped('10.0.0.3', 'pair-b'), grouped('10.0.0.4', 'pair-b'), grouped('10.0.0.5', None))
+    assert groups.admit(a1)
+    assert not groups.admit(a2)
+    assert groups.admit(b1) and groups.admit(b2)
+    assert groups.admit(lone)
+    assert groups.held_count == 1
+    assert groups.capacity([a1, a2, b1, b2, lone]) == 4
+
+
+def test_release_on_success_queues_the_next_member():
+    groups = AvailabilityGroups()
+    first, second = grouped('10.0.0.1', 'pair'), grouped('10.0.0.2', 'pair')
+    groups.admit(first)
+    groups.admit(second)
+    event, released = groups.release(first, installed(first, SUCCESS))
+    assert event is None
+    assert released == [second]
+    assert groups.admit(second)
+
+
+def test_failure_after_install_keeps_the_member_unavailable():
+    groups = AvailabilityGroups()
+    first, second = grouped('10.0.0.1', 'pair'), grouped('10.0.0.2', 'pair')
+    groups.admit(first)
+    groups.admit(second)
+    event, released = groups.release(first, installed(first, WARNING))
+    assert 'not back in service' in event
+    assert released == []
+    assert groups.give_up() == [('pair', second)]
+    assert groups.held_count == 0
+
+
+def test_failure_before_install_and_timeout():
+    groups = AvailabilityGroups()
+    first, second, third = grouped('10.0.0.1', 'g'), grouped('10.0.0.2', 'g'), grouped('10.0.0.3', 'g')
+    for dev in (first, second, third):
+        groups.admit(dev)
+    # Login failed: nothing was installed, so the device is back in service
+    _, released = groups.release(first, DeviceResult(first, 'Upgrade', status=FAILED, message='Auth: denied'))
+    assert released == [second]
+    groups.admit(second)
+    # A timeout may have hit mid-install: assume the device is down
+    event, released = groups.release(second, DeviceResult(second, 'Upgrade', status=TIMEOUT))
+    assert event is not None and released == []
+    assert groups.lost == {'g': {'10.0.0.2'}}
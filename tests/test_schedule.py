@@ -0,0 +1,65 @@
+"""Maintenance windows, priorities and the --until cut-off"""
+
+from datetime import datetime
+
+from ic3000_records import Device
+from ic3000_schedule import DeviceScheduler
+
+
+def device(ip, window=None, priority=0):
+    return Device(ip, 'admin', 'secret', window=window, priority=priority)
+
+
+def test_eligible_follows_window_and_until():
+    night = device('10.0.0.1', window='22:00-04:00')
+    scheduler = DeviceScheduler([night], until=datetime(2024, 5, 2, 3, 0))
+    assert scheduler.eligible(night, datetime(2024, 5, 1, 23, 30))
+    assert not scheduler.eligible(night, datetime(2024, 5, 1, 12, 0))
+    assert not scheduler.eligible(night, datetime(2024, 5, 2, 3, 30))
+    # A device that was never queued (e.g. held by a site breaker) is checked too
+    assert scheduler.eligible(device('10.0.0.2', window='12:00-13:00'), datetime(2024, 5, 1, 12, 15))
+
+
+def test_highest_priority_first_ties_in_csv_order():
+    devices = [device('10.0.0.1'), device('10.0.0.2', priority=5), device('10.0.0.3'), device('10.0.0.4', priority=5)]
+    scheduler = DeviceScheduler(devices)
+    now = datetime(2024, 5, 1, 12, 0)
+    order = [scheduler.pop_next(now).ip for _ in range(len(devices))]
+    assert order == ['10.0.0.2', '10.0.0.4', '10.0.0.1', '10.0.0.3']
+    assert scheduler.pop_next(now) is None
+
+
+def test_closed_windows_are_passed_over():
+    devices = [device('10.0.0.1', window='22:00-04:00', priority=9), device('10.0.0.2', window='12:00-13:00'),
+               device('10.0.0.3')]
+    scheduler = DeviceScheduler(devices)
+    noon = datetime(2024, 5, 1, 12, 30)
+    assert [scheduler.pop_next(noon).ip, scheduler.pop_next(noon).ip] == ['10.0.0.2', '10.0.0.3']
+    assert scheduler.pop_next(noon) is None
+    assert len(scheduler) == 1
+    assert scheduler.seconds_until_eligible(noon) == 9.5 * 3600
+    assert scheduler.pop_next(datetime(2024, 5, 1, 23, 0)).ip == '10.0.0.1'
+
+
+def test_window_wrapping_midnight():
+    night = device('10.0.0.1', window='22:00-04:00')
+    scheduler = DeviceScheduler([night])
+    assert scheduler.pop_next(datetime(2024, 5, 2, 3, 59)) is night
+
+
+def test_until_expires_the_queue():
+    devices = [device('10.0.0.1'), device('10.0.0.2', window='23:00-23:30')]
+    scheduler = DeviceScheduler(devices, until=datetime(2024, 5, 1, 6, 0))
+    assert scheduler.expire(datetime(2024, 5, 1, 5, 0)) == []
+    assert scheduler.pop_next(datetime(2024, 5, 1, 6, 0)) is None
+    assert {d.ip for d in scheduler.expire(datetime(2024, 5, 1, 6, 0))} == {'10.0.0.1', '10.0.0.2'}
+    assert len(scheduler) == 0
+
+
+def test_pushed_device_queues_behind_equal_priority():
+    first, second = device('10.0.0.1'), device('10.0.0.2')
+    scheduler = DeviceScheduler([first, second])
+    now = datetime(2024, 5, 1, 12, 0)
+    assert scheduler.pop_next(now) is first
+    scheduler.push(first)
+    assert [scheduler.pop_next(now), scheduler.pop_next(now)] == [second, first]